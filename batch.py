@@ -0,0 +1,234 @@
+# Description: Parallel batch compile and run of Tau programs
+#
+# Every .tau file under the paths given is compiled with tauc.build()
+# and run on the interpreter by a pool of worker processes.  A
+# <name>.expected file next to a program holds what it should print; a
+# program without one only has to compile and run.  Each program ends up
+# as one of
+#   pass       printed what was expected
+#   unchecked  ran, and has no .expected file
+#   fail       printed something else
+#   error      did not compile, or the machine stopped with an error
+#   timeout    compiling and running took longer than --timeout seconds
+#
+# The workers are started once and import the compiler and hash it for
+# tauc's cache keys up front (tauc.warm()), so a job only pays for its own compile and
+# run.  A timeout is an alarm signal inside the worker, which abandons
+# the job and leaves the worker warm for the next one.  The workers share
+# tauc's stage cache; the hits and misses they report are added to its
+# stats.json once, at the end.
+#
+# The results are printed as a summary, and written as JSON (--json) and
+# as a JUnit XML report (--junit) for CI.
+#
+# usage: python batch.py [-j N] [--timeout S] [--json FILE] [--junit FILE] [tauc options] path ...
+
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import tauc
+
+TIMEOUT = 10.0
+STATUSES = ["pass", "unchecked", "fail", "error", "timeout"]
+
+_options: Optional[tauc.Options] = None
+_cache_dir: Optional[str] = None
+
+
+@dataclass
+class Outcome:
+    path: str
+    status: str
+    output: List[str] = field(default_factory=list)
+    expected: Optional[List[str]] = None
+    message: str = ""
+    compile: float = 0.0  # seconds
+    run: float = 0.0
+    steps: int = 0
+    started: Optional[str] = None  # stage tauc started from, if cached
+    hits: Dict[str, int] = field(default_factory=dict)
+    misses: Dict[str, int] = field(default_factory=dict)
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise _Timeout()
+
+
+# Runs once in every worker.
+def _start(options: tauc.Options, cache_dir: Optional[str]):
+    global _options, _cache_dir
+    _options = options
+    _cache_dir = cache_dir
+    tauc.warm()
+    signal.signal(signal.SIGALRM, _alarm)
+
+
+def _job(path: str, timeout: float) -> Outcome:
+    import bytecode
+    import interp
+
+    outcome = Outcome(path, "error")
+    expected = path[:-4] + ".expected"
+    if os.path.exists(expected):
+        with open(expected) as f:
+            outcome.expected = f.read().splitlines()
+    cache = tauc.Cache(_cache_dir)
+    begin = time.perf_counter()
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    # The timer is disarmed before any handler runs, and an alarm that
+    # fires before it is disarmed is still caught as a timeout.
+    try:
+        try:
+            with open(path) as f:
+                source = f.read()
+            start = time.perf_counter()
+            built = tauc.build(source, _options, cache)
+            outcome.compile = time.perf_counter() - start
+            outcome.started = built.started
+            start = time.perf_counter()
+            result = interp.run(bytecode.loads(built.data).image())
+            outcome.run = time.perf_counter() - start
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        outcome.output = result.output
+        outcome.steps = result.steps
+        if outcome.expected is None:
+            outcome.status = "unchecked"
+        elif outcome.output == outcome.expected:
+            outcome.status = "pass"
+        else:
+            outcome.status = "fail"
+            outcome.message = "output differs from " + os.path.basename(expected)
+    except _Timeout:
+        outcome.status = "timeout"
+        outcome.message = f"took longer than {timeout:g}s"
+        outcome.run = time.perf_counter() - begin - outcome.compile
+    except Exception as e:
+        outcome.status = "error"
+        outcome.message = f"{type(e).__name__}: {e}"
+    outcome.hits = cache.hits
+    outcome.misses = cache.misses
+    return outcome
+
+
+def run(
+    paths: List[str],
+    options: tauc.Options,
+    cache_dir: Optional[str] = tauc.CACHE,
+    jobs: Optional[int] = None,
+    timeout: float = TIMEOUT,
+) -> List[Outcome]:
+    from difftest import programs
+
+    files = programs(paths)
+    with ProcessPoolExecutor(jobs, initializer=_start, initargs=(options, cache_dir)) as pool:
+        futures = [pool.submit(_job, path, timeout) for path in files]
+        outcomes = []
+        for path, future in zip(files, futures):
+            try:
+                outcomes.append(future.result())
+            except Exception as e:  # the worker died
+                outcomes.append(Outcome(path, "error", message=f"{type(e).__name__}: {e}"))
+    return outcomes
+
+
+def summary(outcomes: List[Outcome]) -> Dict[str, int]:
+    counts = {status: 0 for status in STATUSES}
+    for o in outcomes:
+        counts[o.status] += 1
+    counts["total"] = len(outcomes)
+    return counts
+
+
+def to_json(outcomes: List[Outcome], seconds: float) -> dict:
+    return {
+        "summary": {**summary(outcomes), "seconds": seconds},
+        "programs": [asdict(o) for o in outcomes],
+    }
+
+
+def junit(outcomes: List[Outcome], seconds: float, root: str = ".") -> ET.ElementTree:
+    counts = summary(outcomes)
+    suites = ET.Element("testsuites", tests=str(len(outcomes)), time=f"{seconds:.3f}")
+    suite = ET.SubElement(
+        suites,
+        "testsuite",
+        name="tau",
+        tests=str(len(outcomes)),
+        failures=str(counts["fail"]),
+        errors=str(counts["error"] + counts["timeout"]),
+        skipped="0",
+        time=f"{seconds:.3f}",
+    )
+    for o in outcomes:
+        rel = os.path.relpath(o.path, root)
+        case = ET.SubElement(
+            suite,
+            "testcase",
+            classname=os.path.dirname(rel).replace(os.sep, ".") or "tau",
+            name=os.path.splitext(os.path.basename(rel))[0],
+            time=f"{o.compile + o.run:.3f}",
+        )
+        match o.status:
+            case "fail":
+                failure = ET.SubElement(case, "failure", message=o.message)
+                failure.text = "expected:\n" + "\n".join(o.expected) + "\nprinted:\n" + "\n".join(o.output)
+            case "error" | "timeout":
+                ET.SubElement(case, "error", type=o.status, message=o.message)
+        if o.output:
+            ET.SubElement(case, "system-out").text = "\n".join(o.output)
+    ET.indent(suites)
+    return ET.ElementTree(suites)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Compile and run Tau programs in parallel.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="seconds allowed per program")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE")
+    parser.add_argument("--junit", metavar="FILE", help="write a JUnit XML report to FILE")
+    tauc.add_options(parser)
+    args = parser.parse_args(argv)
+    options = tauc.parse_options(parser, args)
+    cache_dir = None if args.no_cache else args.cache_dir
+    start = time.perf_counter()
+    outcomes = run(args.paths, options, cache_dir, args.jobs, args.timeout)
+    seconds = time.perf_counter() - start
+
+    cache = tauc.Cache(cache_dir)
+    for o in outcomes:
+        for stage in tauc.STAGES:
+            cache.hits[stage] += o.hits.get(stage, 0)
+            cache.misses[stage] += o.misses.get(stage, 0)
+    cache.save_stats()
+
+    for o in outcomes:
+        if o.status not in ("pass", "unchecked"):
+            print(f"{o.path}: {o.status}: {o.message}")
+    counts = summary(outcomes)
+    found = ", ".join(f"{counts[s]} {s}" for s in STATUSES if counts[s]) or "none"
+    print(f"{found} of {len(outcomes)} programs in {seconds:.2f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(to_json(outcomes, seconds), f, indent=1)
+    if args.junit:
+        root = args.paths[0] if len(args.paths) == 1 and os.path.isdir(args.paths[0]) else "."
+        junit(outcomes, seconds, root).write(args.junit, encoding="unicode", xml_declaration=True)
+    return 1 if counts["fail"] or counts["error"] or counts["timeout"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+# Description: Compile-time benchmarks over generated programs
+#
+# Generates programs with progen, growing one Shape parameter over a
+# sweep of sizes, compiles each (pipeline.compile, then link) and
+# measures every stage with instrument: the best wall time of --repeat
+# runs without tracemalloc, and the peak memory of one more run with it.
+#
+# For each stage the times are fitted against the size of the program,
+# in AST nodes after parse, on a log-log scale; a slope above SUPERLINEAR
+# means the stage grows faster than the program and is flagged.  Stages
+# that never take MIN_TIME are too noisy to judge and are left out.
+#
+# --save writes the measurements as JSON; --baseline compares against
+# such a file (same shape and sweep) and flags every stage whose time or
+# peak memory grew by more than --tolerance.  The exit status is 1 if
+# anything was flagged.
+#
+# usage: python bench_compile.py [--vary PARAM] [--sizes N,N,...] [--repeat N]
+#                                [--save FILE] [--baseline FILE] [--tolerance F] [shape options]
+
+import argparse
+import json
+import math
+import sys
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, List, Optional
+
+import instrument
+import link
+import pipeline
+import progen
+
+STAGES = ["parse", "scan", "bindings", "typecheck", "offsets", "codegen", "link"]
+SIZES = [4, 8, 16, 32, 64]
+SUPERLINEAR = 1.25
+MIN_TIME = 1e-3  # seconds
+TOLERANCE = 0.2
+
+
+@dataclass
+class Point:
+    size: int  # value of the swept Shape parameter
+    nodes: int = 0
+    tokens: int = 0
+    wall: Dict[str, float] = field(default_factory=dict)  # seconds, best of the repeats
+    peak: Dict[str, int] = field(default_factory=dict)  # bytes
+
+
+def _compile(source: str, memory: bool) -> instrument.Recorder:
+    with instrument.recording(memory) as rec:
+        code = pipeline.compile(source)
+        with instrument.phase("link"):
+            link.link(code)
+    return rec
+
+
+def measure(source: str, size: int, repeat: int = 3) -> Point:
+    point = Point(size)
+    for _ in range(repeat):
+        for p in _compile(source, memory=False).phases:
+            point.wall[p.name] = min(point.wall.get(p.name, math.inf), p.wall)
+    for p in _compile(source, memory=True).phases:
+        point.peak[p.name] = p.peak
+        if p.name == "parse":
+            point.nodes = p.nodes
+        if p.name == "scan":
+            point.tokens = p.tokens
+    return point
+
+
+def sweep(shape: progen.Shape, vary: str, sizes: List[int], repeat: int = 3) -> List[Point]:
+    points = []
+    for size in sizes:
+        setattr(shape, vary, size)
+        points.append(measure(progen.generate(shape), size, repeat))
+    return points
+
+
+# Least-squares slope of log(y) against log(x).
+def slope(xs: List[float], ys: List[float]) -> float:
+    lx = [math.log(x) for x in xs]
+    ly = [math.log(y) for y in ys]
+    mx = sum(lx) / len(lx)
+    my = sum(ly) / len(ly)
+    var = sum((x - mx) ** 2 for x in lx)
+    return sum((x - mx) * (y - my) for x, y in zip(lx, ly)) / var if var else 0.0
+
+
+# The scaling exponent of every stage that takes long enough to judge.
+def scaling(points: List[Point]) -> Dict[str, float]:
+    found = {}
+    for stage in STAGES:
+        ys = [p.wall.get(stage, 0.0) for p in points]
+        if len(points) > 1 and max(ys) >= MIN_TIME and min(ys) > 0:
+            found[stage] = slope([p.nodes for p in points], ys)
+    return found
+
+
+def compare(points: List[Point], baseline: List[Point], tolerance: float = TOLERANCE) -> List[str]:
+    problems = []
+    base = {p.size: p for p in baseline}
+    for p in points:
+        if p.size not in base:
+            continue
+        b = base[p.size]
+        for stage in STAGES:
+            if stage in p.wall and stage in b.wall and max(p.wall[stage], b.wall[stage]) >= MIN_TIME:
+                if p.wall[stage] > b.wall[stage] * (1 + tolerance):
+                    problems.append(
+                        f"size {p.size}: {stage} took {p.wall[stage] * 1e3:.2f} ms, "
+                        f"baseline {b.wall[stage] * 1e3:.2f} ms"
+                    )
+            if p.peak.get(stage) and b.peak.get(stage) and p.peak[stage] > b.peak[stage] * (1 + tolerance):
+                problems.append(
+                    f"size {p.size}: {stage} peaked at {p.peak[stage] / 1024:.1f} KiB, "
+                    f"baseline {b.peak[stage] / 1024:.1f} KiB"
+                )
+    return problems
+
+
+def report(points: List[Point], vary: str) -> str:
+    lines = [f"{vary:>10} {'nodes':>8} {'tokens':>8} " + " ".join(f"{s:>9}" for s in STAGES) + "   (ms)"]
+    for p in points:
+        times = " ".join(f"{p.wall.get(s, 0.0) * 1e3:>9.2f}" for s in STAGES)
+        lines.append(f"{p.size:>10} {p.nodes:>8} {p.tokens:>8} {times}")
+    lines.append(f"{'':>10} {'':>8} {'':>8} " + " ".join(f"{s:>9}" for s in STAGES) + "   (peak KiB)")
+    for p in points:
+        peaks = " ".join(f"{p.peak.get(s, 0) / 1024:>9.1f}" for s in STAGES)
+        lines.append(f"{p.size:>10} {p.nodes:>8} {p.tokens:>8} {peaks}")
+    return "\n".join(lines) + "\n"
+
+
+def save(path: str, shape: progen.Shape, vary: str, points: List[Point]):
+    with open(path, "w") as f:
+        json.dump({"shape": asdict(shape), "vary": vary, "points": [asdict(p) for p in points]}, f, indent=1)
+
+
+def load(path: str, shape: progen.Shape, vary: str) -> List[Point]:
+    with open(path) as f:
+        data = json.load(f)
+    if data["vary"] != vary or {**data["shape"], vary: None} != {**asdict(shape), vary: None}:
+        raise ValueError(f"{path} was measured with another shape or sweep")
+    return [Point(**p) for p in data["points"]]
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Tau compiler on generated programs.")
+    parser.add_argument("--vary", default="functions", choices=[f.name for f in fields(progen.Shape) if f.type is int])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma-separated values of the varied parameter")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="FILE", help="write the measurements to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with measurements saved earlier")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="growth over the baseline that is flagged")
+    for f in fields(progen.Shape):
+        parser.add_argument(f"--{f.name.replace('_', '-')}", type=type(f.default), default=f.default)
+    args = parser.parse_args(argv)
+    shape = progen.Shape(**{f.name: getattr(args, f.name) for f in fields(progen.Shape)})
+    sizes = [int(s) for s in args.sizes.split(",")]
+    baseline: Optional[List[Point]] = load(args.baseline, shape, args.vary) if args.baseline else None
+
+    points = sweep(shape, args.vary, sizes, args.repeat)
+    print(report(points, args.vary))
+    flagged = []
+    for stage, k in scaling(points).items():
+        print(f"{stage:<10} scales as nodes^{k:.2f}")
+        if k > SUPERLINEAR:
+            flagged.append(f"{stage} is super-linear: time grows as nodes^{k:.2f}")
+    if baseline is not None:
+        flagged += compare(points, baseline, args.tolerance)
+    if args.save:
+        save(args.save, shape, args.vary, points)
+    for problem in flagged:
+        print(f"flagged: {problem}")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,230 @@
+# Description: Runtime benchmarks for compiled Tau programs
+#
+# Each benchmarks/<name>.tau is compiled, linked and run on the
+# interpreter, checked against benchmarks/<name>.expected, and timed.
+# With --stock the program is also run on the stock vm, whose output
+# must match the interpreter's.  With --register it is also compiled for
+# the register vm, and the dynamic instruction counts and times of the
+# two targets are compared.  --fuse runs the stack code after
+# superinstruction selection, --lean compiles it with codegen's lean
+# calling convention (the stock vm still runs the plain code).  --memo N
+# memoizes calls of pure recursive functions in a table of N entries and
+# reports how often it hit.
+#
+# --matrix instead compiles every benchmark once per configuration in
+# CONFIGS (tauc options; --configs picks some) and reports, for each,
+# the instructions executed, the best time of the interpreter, and the
+# deepest the eval stack got and the highest SP, measured by vmprofile;
+# with --register the register vm too, with its deepest call nesting
+# and most live registers in those columns.  --opcodes adds the
+# executed instructions by opcode, one column per configuration, and
+# --json writes all of it to a file.
+#
+# usage: python bench_runtime.py [--stock] [--register] [--fuse] [--lean] [--memo N] [--repeat N] [name ...]
+#        python bench_runtime.py --matrix [--configs C,C,...] [--register] [--opcodes] [--json FILE] [name ...]
+
+import argparse
+import json
+import os
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import bytecode
+import fuse
+import insns
+import interp
+import link
+import memo as memoize
+import offsets
+import pipeline
+import regcodegen
+import regvm
+import stackdepth
+import tauc
+import vmprofile
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+CONFIGS: Dict[str, tauc.Options] = {
+    "plain": tauc.Options(),
+    "fold": tauc.Options(fold=True),
+    "schedule": tauc.Options(schedule=True),
+    "cfg": tauc.Options(cfg=True),
+    "fuse": tauc.Options(fuse=True),
+    "lean": tauc.Options(lean=True),
+    "memo": tauc.Options(memo=True),
+    "O1": tauc.Options(level=1),
+    "O2": tauc.Options(level=2),
+}
+
+
+@dataclass
+class Measurement:
+    name: str
+    steps: int
+    seconds: float  # best of the repeats
+    memo: Optional[memoize.Memo] = None
+
+    def rate(self) -> float:
+        return self.steps / self.seconds if self.seconds else 0.0
+
+
+def names() -> List[str]:
+    return sorted(f[:-4] for f in os.listdir(BENCHMARKS) if f.endswith(".tau"))
+
+
+def source(name: str) -> str:
+    with open(os.path.join(BENCHMARKS, name + ".tau")) as f:
+        return f.read()
+
+
+def expected(name: str) -> List[str]:
+    with open(os.path.join(BENCHMARKS, name + ".expected")) as f:
+        return f.read().splitlines()
+
+
+# Runs run() repeat times and returns its last result and the best time.
+def _best(run: Callable, repeat: int) -> Tuple[object, float]:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def measure(
+    name: str,
+    repeat: int = 3,
+    stock: bool = False,
+    fused: bool = False,
+    lean: bool = False,
+    capacity: Optional[int] = None,
+) -> Measurement:
+    code = pipeline.compile(source(name), lean, capacity is not None)
+    if fused:
+        code = fuse.select(code, insns.LEAN_EFFECTS if lean else insns.EFFECTS)
+    image = link.link(code)
+    stackdepth.annotate(image, stackdepth.analyze(code, insns.LEAN_EFFECTS if lean else insns.EFFECTS))
+    table = (lambda: memoize.Memo(capacity)) if capacity is not None else (lambda: None)
+    result, best = _best(lambda: interp.run(image, memo=table()), repeat)
+    if result.output != expected(name):
+        raise AssertionError(f"{name}: printed {result.output}, expected {expected(name)}")
+    if stock and pipeline.run_stock(pipeline.compile(source(name))) != result.output:
+        raise AssertionError(f"{name}: stock vm output differs from the interpreter")
+    return Measurement(name, result.steps, best, result.memo if capacity is not None else None)
+
+
+def measure_register(name: str, repeat: int = 3) -> Measurement:
+    ast = pipeline.front(source(name))
+    offsets.process(ast)
+    program = regcodegen.generate(ast)
+    result, best = _best(lambda: regvm.run(program), repeat)
+    if result.output != expected(name):
+        raise AssertionError(f"{name}: register vm printed {result.output}, expected {expected(name)}")
+    return Measurement(name, result.steps, best)
+
+
+@dataclass
+class Detail:
+    name: str
+    config: str
+    steps: int
+    seconds: float  # best of the repeats
+    depth: int  # eval-stack entries, or call nesting on the register vm
+    frame: int  # highest SP, or live registers on the register vm
+    opcodes: Dict[str, int] = field(default_factory=dict)  # executed instructions by opcode
+
+
+def detail(name: str, config: str, repeat: int = 3) -> Detail:
+    built = tauc.build(source(name), CONFIGS[config], tauc.Cache(None))
+    image = bytecode.loads(built.data).image()
+    result, best = _best(lambda: interp.run(image), repeat)
+    if result.output != expected(name):
+        raise AssertionError(f"{name}: {config} printed {result.output}, expected {expected(name)}")
+    prof = vmprofile.run(image)
+    opcodes: Dict[str, int] = {}
+    for op, n in zip(image.ops, prof.counts):
+        if n:
+            opcodes[insns.OPCODES[op]] = opcodes.get(insns.OPCODES[op], 0) + n
+    return Detail(name, config, result.steps, best, prof.depth, prof.frame, opcodes)
+
+
+def detail_register(name: str, repeat: int = 3) -> Detail:
+    ast = pipeline.front(source(name))
+    offsets.process(ast)
+    program = regcodegen.generate(ast)
+    result, best = _best(lambda: regvm.run(program), repeat)
+    if result.output != expected(name):
+        raise AssertionError(f"{name}: register vm printed {result.output}, expected {expected(name)}")
+    return Detail(name, "register", result.steps, best, result.depth, result.registers)
+
+
+def opcode_table(details: List[Detail]) -> str:
+    ops = sorted({op for d in details for op in d.opcodes}, key=lambda op: -details[0].opcodes.get(op, 0))
+    lines = [f"  {'opcode':<24}" + "".join(f" {d.config:>10}" for d in details)]
+    for op in ops:
+        lines.append(f"  {op:<24}" + "".join(f" {d.opcodes.get(op, 0):>10}" for d in details))
+    return "\n".join(lines) + "\n"
+
+
+def matrix(names: List[str], configs: List[str], register: bool, repeat: int, opcodes: bool) -> List[Detail]:
+    print(f"{'benchmark':<12} {'config':<10} {'insns':>12} {'seconds':>9} {'stack':>6} {'frame':>8}")
+    found = []
+    for name in names:
+        details = [detail(name, config, repeat) for config in configs]
+        if register:
+            details.append(detail_register(name, repeat))
+        for d in details:
+            print(f"{d.name:<12} {d.config:<10} {d.steps:>12} {d.seconds:>9.3f} {d.depth:>6} {d.frame:>8}")
+        if opcodes:
+            print(opcode_table([d for d in details if d.opcodes]))
+        found += details
+    return found
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Run the Tau runtime benchmarks.")
+    parser.add_argument("names", nargs="*")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stock", action="store_true", help="compare with the stock vm")
+    parser.add_argument("--register", action="store_true", help="compare with the register vm")
+    parser.add_argument("--fuse", action="store_true", help="use superinstructions")
+    parser.add_argument("--lean", action="store_true", help="use the lean calling convention")
+    parser.add_argument("--memo", type=int, metavar="N", help="memoize pure recursive functions in N entries")
+    parser.add_argument("--matrix", action="store_true", help="compare the configurations in CONFIGS")
+    parser.add_argument("--configs", default=",".join(CONFIGS), help="comma-separated configurations for --matrix")
+    parser.add_argument("--opcodes", action="store_true", help="with --matrix, count instructions by opcode")
+    parser.add_argument("--json", metavar="FILE", help="with --matrix, write the results to FILE")
+    args = parser.parse_args(argv)
+    if args.matrix:
+        configs = args.configs.split(",")
+        for config in configs:
+            if config not in CONFIGS:
+                parser.error(f"unknown configuration {config}; choose from {', '.join(CONFIGS)}")
+        details = matrix(args.names or names(), configs, args.register, args.repeat, args.opcodes)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump([asdict(d) for d in details], f, indent=1)
+        return 0
+    print(f"{'benchmark':<12} {'insns':>12} {'seconds':>9} {'insns/s':>12}", end="")
+    print(f" {'reg insns':>12} {'seconds':>9} {'insns':>6} {'time':>6}" if args.register else "")
+    for name in args.names or names():
+        m = measure(name, args.repeat, args.stock, args.fuse, args.lean, args.memo)
+        print(f"{m.name:<12} {m.steps:>12} {m.seconds:>9.3f} {m.rate():>12.0f}", end="")
+        if args.register:
+            r = measure_register(name, args.repeat)
+            # Register vm figures as a fraction of the stack vm's.
+            print(f" {r.steps:>12} {r.seconds:>9.3f} {r.steps / m.steps:>6.2f} {r.seconds / m.seconds:>6.2f}")
+        else:
+            print()
+        if m.memo is not None:
+            print(f"  {m.memo.report()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
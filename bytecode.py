@@ -0,0 +1,198 @@
+# Description: Versioned binary bytecode format
+#
+# A file holds one linked Image (see link.py):
+#
+#   header    magic "TAUB", version, flags, the size of every section and
+#             the eval stack the program needs (0 if unknown)
+#   ops       one opcode byte per instruction (insns.OPCODES numbering)
+#   args      one little-endian int64 operand per instruction
+#   labels    uint32 instruction index of every label, by label number
+#   relocs    uint32 index of every instruction whose operand is a code
+#             address, so the code can be moved or concatenated
+#   entries   uint32 label number and uint32 maximum eval-stack depth
+#             followed by the NUL-terminated name, for every function
+#             entry point
+#   debug     optional: the NUL-terminated name of every label
+#
+# Sections start on 8-byte boundaries.  load() maps the file and wraps
+# the sections in memoryviews, so nothing is decoded until it is used.
+
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict, List, Optional
+
+from tau.vm.vm import Insn
+import insns
+import link
+from link import Image
+
+MAGIC = b"TAUB"
+VERSION = 2  # 2 added the stack sizes
+FLAG_DEBUG = 1
+
+_header = struct.Struct("<4sHHIIIIII")
+_entry = struct.Struct("<II")
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+
+def _pad(data: bytearray):
+    data += bytes(-len(data) % 8)
+
+
+def encode(code: List[Insn], debug: bool = False) -> bytes:
+    return encode_image(link.link(code), debug)
+
+
+def encode_image(image: Image, debug: bool = False) -> bytes:
+    addresses = {insns.OPCODE[op] for op in insns.LABELLED}
+    relocs = [i for i, op in enumerate(image.ops) if op in addresses]
+    entries = bytearray()
+    for name, n in sorted(image.entries.items(), key=lambda e: e[1]):
+        entries += _entry.pack(n, image.depths.get(name, 0)) + name.encode() + b"\0"
+    names = b"".join(name.encode() + b"\0" for name in image.names) if debug else b""
+    sections = [
+        bytes(image.ops),
+        operands(image),
+        _little(array("I", image.labels)),
+        _little(array("I", relocs)),
+        bytes(entries),
+        names,
+    ]
+    data = bytearray(
+        _header.pack(
+            MAGIC,
+            VERSION,
+            FLAG_DEBUG if debug else 0,
+            len(image.ops),
+            len(image.labels),
+            len(relocs),
+            len(entries),
+            len(names),
+            image.stack,
+        )
+    )
+    for section in sections:
+        _pad(data)
+        data += section
+    return bytes(data)
+
+
+# The args section.  Tau integers are unbounded, but operands are stored
+# as int64, so a constant that does not fit is rejected here rather than
+# by array() with an OverflowError that does not say which one.
+def operands(image: Image) -> bytes:
+    for i, arg in enumerate(image.args):
+        if not _INT64_MIN <= arg <= _INT64_MAX:
+            op = insns.OPCODES[image.ops[i]]
+            raise ValueError(f"operand {arg} of instruction {i} ({op}) does not fit in 64 bits")
+    return _little(array("q", image.args))
+
+
+def _little(a: array) -> bytes:
+    if sys.byteorder != "little":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def write(path: str, code: List[Insn], debug: bool = False):
+    with open(path, "wb") as f:
+        f.write(encode(code, debug))
+
+
+class Module:
+    def __init__(self, buffer):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        magic, version, flags, n, nlabels, nrelocs, nentries, ndebug, stack = _header.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("not a tau bytecode file")
+        if version != VERSION:
+            raise ValueError(f"unsupported bytecode version {version}")
+        offset = _header.size
+        sizes = [n, 8 * n, 4 * nlabels, 4 * nrelocs, nentries, ndebug]
+        sections = []
+        for size in sizes:
+            offset += -offset % 8
+            sections.append(view[offset:offset + size])
+            offset += size
+        ops, args, labels, relocs, entries, debug = sections
+        self.version = version
+        self.debug = bool(flags & FLAG_DEBUG)
+        self.stack = stack
+        self.ops = ops
+        self.args = _native(args, "q")
+        self.labels = _native(labels, "I")
+        self.relocs = _native(relocs, "I")
+        self._entries = entries
+        self._debug = debug
+        self._image: Optional[Image] = None
+        self._decoded: Dict[int, Insn] = {}
+        self._at: Optional[Dict[int, str]] = None  # instruction index -> first label there
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    # Decode one instruction, with jump targets given as label names.
+    def __getitem__(self, i: int) -> Insn:
+        if i not in self._decoded:
+            op = insns.OPCODES[self.ops[i]]
+            arg = self.args[i]
+            if op in insns.LABELLED:
+                arg = self._name_at(arg)
+            self._decoded[i] = insns.make(op, arg)
+        return self._decoded[i]
+
+    def _name_at(self, address: int) -> str:
+        if self._at is None:
+            names = self.image().names
+            self._at = {}
+            for n, index in enumerate(self.labels):
+                self._at.setdefault(index, names[n])
+        return self._at[address]
+
+    # The whole module as an Image; the arrays stay views on the file.
+    def image(self) -> Image:
+        if self._image is None:
+            entries = {}
+            depths = {}
+            data = bytes(self._entries)
+            i = 0
+            while i < len(data):
+                n, depth = _entry.unpack_from(data, i)
+                end = data.index(b"\0", i + _entry.size)
+                name = data[i + _entry.size:end].decode()
+                entries[name] = n
+                if depth:
+                    depths[name] = depth
+                i = end + 1
+            if self.debug:
+                names = bytes(self._debug).decode().split("\0")[:-1]
+            else:
+                names = [f"L{n}" for n in range(len(self.labels))]
+                for name, n in entries.items():
+                    names[n] = name
+            self._image = Image(self.ops, self.args, self.labels, names, entries, depths, self.stack)
+        return self._image
+
+
+def _native(view: memoryview, typecode: str):
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    a = array(typecode, view.tobytes())
+    a.byteswap()
+    return a
+
+
+def load(path: str) -> Module:
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0:
+            raise ValueError("not a tau bytecode file")
+        return Module(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def loads(data: bytes) -> Module:
+    return Module(data)
@@ -0,0 +1,316 @@
+# Description: Control-flow graph, jump threading and block layout
+#
+# build() splits the List[Insn] from codegen into basic blocks.  Each
+# block keeps its labels separately from its instructions and knows its
+# jump target and its fall-through successor.  Functions are only
+# connected through Call, so the roots of the graph are the first block
+# and every block whose label is pushed by a PushLabel.
+#
+# optimize() threads jumps through blocks that only jump elsewhere,
+# drops unreachable and empty blocks, lays the blocks out so the most
+# frequent edges fall through, and emits the code again with only the
+# labels that are still referenced.
+#
+# Without a profile, block frequencies are estimated as 10 ** loop depth;
+# Report.dynamic_* are jump executions estimated that way.
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from tau.vm.vm import Insn, Jump, Label, Pop
+import insns
+
+
+class Block:
+    def __init__(self, index: int):
+        self.index = index
+        self.labels: List[str] = []
+        self.insns: List[Insn] = []  # labels excluded, terminator included
+        self.target: Optional[Block] = None  # destination of the final jump
+        self.fall: Optional[Block] = None  # next block if control falls through
+        self.depth = 0  # loop nesting depth
+
+    def jump(self) -> Optional[str]:
+        if self.insns and insns.name(self.insns[-1]) in insns.JUMPS:
+            return insns.name(self.insns[-1])
+        return None
+
+    def succs(self) -> List["Block"]:
+        return [b for b in (self.target, self.fall) if b is not None]
+
+    # Jumps executed each time the block runs.
+    def jumps(self) -> int:
+        return sum(1 for insn in self.insns if insns.name(insn) in insns.JUMPS)
+
+
+class Cfg:
+    def __init__(self):
+        self.blocks: List[Block] = []  # in layout order
+        self.pinned: Set[str] = set()  # labels pushed by PushLabel
+
+    def roots(self) -> List[Block]:
+        return [b for b in self.blocks if b is self.blocks[0] or self.pinned & set(b.labels)]
+
+
+@dataclass
+class Report:
+    insns_before: int = 0
+    insns_after: int = 0
+    jumps_before: int = 0
+    jumps_after: int = 0
+    dynamic_before: int = 0
+    dynamic_after: int = 0
+    threaded: int = 0
+    blocks_removed: int = 0
+    labels_removed: int = 0
+
+
+def build(code: List[Insn]) -> Cfg:
+    cfg = Cfg()
+    block = None
+    for insn in code:
+        op = insns.name(insn)
+        if op == "PushLabel":
+            cfg.pinned.add(insns.operand(insn))
+        if op == "Label":
+            if block is None or block.insns:
+                block = _new(cfg)
+            block.labels.append(insns.operand(insn))
+            continue
+        if block is None:
+            block = _new(cfg)
+        block.insns.append(insn)
+        if op in insns.ENDS or op in insns.JUMPS:
+            block = None
+    by_label = {label: b for b in cfg.blocks for label in b.labels}
+    for i, b in enumerate(cfg.blocks):
+        following = cfg.blocks[i + 1] if i + 1 < len(cfg.blocks) else None
+        if b.jump() is not None:
+            b.target = by_label[insns.operand(b.insns[-1])]
+        if not b.insns or insns.name(b.insns[-1]) not in insns.ENDS:
+            b.fall = following
+    _depths(cfg)
+    return cfg
+
+
+def _new(cfg: Cfg) -> Block:
+    b = Block(len(cfg.blocks))
+    cfg.blocks.append(b)
+    return b
+
+
+# Loop depth of every block: each back edge found by a depth-first walk
+# from the roots closes a natural loop around its header.
+def _depths(cfg: Cfg):
+    preds = _preds(cfg)
+    loops: Dict[Block, Set[Block]] = {}
+    state: Dict[Block, int] = {}  # 1 while on the walk, 2 once finished
+    for root in cfg.roots():
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(root.succs()))]
+        while stack:
+            b, succs = stack[-1]
+            s = next(succs, None)
+            if s is None:
+                state[b] = 2
+                stack.pop()
+            elif s not in state:
+                state[s] = 1
+                stack.append((s, iter(s.succs())))
+            elif state[s] == 1:
+                loops.setdefault(s, {s}).update(_body(preds, b, s))
+    for b in cfg.blocks:
+        b.depth = sum(1 for body in loops.values() if b in body)
+
+
+def _body(preds: Dict[Block, List[Block]], tail: Block, header: Block) -> Set[Block]:
+    body = {header, tail}
+    work = [tail]
+    while work:
+        b = work.pop()
+        if b is header:
+            continue
+        for p in preds.get(b, []):
+            if p not in body:
+                body.add(p)
+                work.append(p)
+    return body
+
+
+def _preds(cfg: Cfg) -> Dict[Block, List[Block]]:
+    preds: Dict[Block, List[Block]] = {}
+    for b in cfg.blocks:
+        for s in b.succs():
+            preds.setdefault(s, []).append(b)
+    return preds
+
+
+def _frequency(b: Block, freq: Optional[Dict[int, int]]) -> int:
+    if freq is not None:
+        return freq.get(b.index, 0)
+    return 10 ** b.depth
+
+
+def dynamic_jumps(cfg: Cfg, freq: Optional[Dict[int, int]] = None) -> int:
+    return sum(_frequency(b, freq) * b.jumps() for b in cfg.blocks)
+
+
+# freq, if given, maps the index of each block of build(code) to the
+# number of times it ran.
+def optimize(code: List[Insn], freq: Optional[Dict[int, int]] = None) -> Tuple[List[Insn], Report]:
+    report = Report()
+    cfg = build(code)
+    report.insns_before = len(code)
+    report.jumps_before = sum(b.jumps() for b in cfg.blocks)
+    report.dynamic_before = dynamic_jumps(cfg, freq)
+    labels = sum(len(b.labels) for b in cfg.blocks)
+    blocks = len(cfg.blocks)
+    report.threaded = thread(cfg)
+    prune(cfg)
+    report.blocks_removed = blocks - len(cfg.blocks)
+    layout(cfg, freq)
+    result = emit(cfg)
+    after = build(result)
+    report.insns_after = len(result)
+    report.jumps_after = sum(b.jumps() for b in after.blocks)
+    report.labels_removed = labels - sum(len(b.labels) for b in after.blocks)
+    if freq is None:
+        report.dynamic_after = dynamic_jumps(after)
+    else:
+        # Block frequencies carry over; only the jumps each block ends with
+        # have changed.
+        following = dict(zip(cfg.blocks, cfg.blocks[1:]))
+        report.dynamic_after = sum(
+            _frequency(b, freq) * _emitted(b, following.get(b), cfg) for b in cfg.blocks
+        )
+    return result, report
+
+
+# Follow empty blocks and blocks that only jump elsewhere.
+def _destination(b: Block) -> Block:
+    seen = set()
+    while b not in seen:
+        seen.add(b)
+        if not b.insns and b.fall is not None:
+            b = b.fall
+        elif len(b.insns) == 1 and b.jump() == "Jump":
+            b = b.target
+        else:
+            break
+    return b
+
+
+def thread(cfg: Cfg) -> int:
+    threaded = 0
+    for b in cfg.blocks:
+        if b.target is not None:
+            dest = _destination(b.target)
+            if dest is not b.target:
+                b.target = dest
+                threaded += 1
+        if b.fall is not None:
+            b.fall = _destination(b.fall)
+        if b.jump() in insns.BRANCHES and b.target is b.fall:
+            # Both ways lead to the same place; only the operands are left.
+            pops, _ = insns.EFFECTS[b.jump()]
+            b.insns[-1:] = [Pop() for _ in range(pops)]
+            b.target = None
+            threaded += 1
+    return threaded
+
+
+# Drop blocks that cannot be reached from a root.
+def prune(cfg: Cfg):
+    reached = set()
+    work = list(cfg.roots())
+    while work:
+        b = work.pop()
+        if b in reached:
+            continue
+        reached.add(b)
+        work += b.succs()
+    cfg.blocks = [b for b in cfg.blocks if b in reached]
+    _depths(cfg)
+
+
+# Greedy chaining: take edges from most to least frequent and make each
+# one a fall-through when it joins the end of one chain to the start of
+# another.  The chains are then placed in their original order.
+def layout(cfg: Cfg, freq: Optional[Dict[int, int]] = None):
+    chain = {b: [b] for b in cfg.blocks}
+    edges = []
+    for b in cfg.blocks:
+        for s in b.succs():
+            if s is not b:
+                weight = min(_frequency(b, freq), _frequency(s, freq))
+                edges.append((-weight, b.index, s.index, b, s))
+    edges.sort(key=lambda e: e[:3])
+    roots = set(cfg.roots())
+    for _, _, _, b, s in edges:
+        if s in roots or chain[b] is chain[s]:
+            continue
+        if chain[b][-1] is not b or chain[s][0] is not s:
+            continue
+        joined = chain[b] + chain[s]
+        for x in joined:
+            chain[x] = joined
+    first = cfg.blocks[0]
+    order = []
+    placed = set()
+    for b in [first] + cfg.blocks:
+        if b not in placed:
+            order += chain[b]
+            placed.update(chain[b])
+    cfg.blocks = order
+
+
+def _name(b: Block, cfg: Cfg) -> str:
+    for label in b.labels:
+        if label in cfg.pinned:
+            return label
+    if b.labels:
+        return b.labels[0]
+    return f".bb{b.index}"  # cannot clash with a scanned ID
+
+
+# The jump instructions a block ends with once laid out.
+def _tail(b: Block, following: Optional[Block], cfg: Cfg) -> List[Insn]:
+    op = b.jump()
+    if op == "Jump":
+        return [] if b.target is following else [Jump(_name(b.target, cfg))]
+    if op in insns.BRANCHES:
+        if b.fall is following:
+            return [insns.make(op, _name(b.target, cfg))]
+        if b.target is following:
+            return [insns.make(insns.INVERSE[op], _name(b.fall, cfg))]
+        return [insns.make(op, _name(b.target, cfg)), Jump(_name(b.fall, cfg))]
+    if b.fall is not None and b.fall is not following:
+        return [Jump(_name(b.fall, cfg))]
+    return []
+
+
+def _emitted(b: Block, following: Optional[Block], cfg: Cfg) -> int:
+    return b.jumps() - (1 if b.jump() else 0) + len(_tail(b, following, cfg))
+
+
+def emit(cfg: Cfg) -> List[Insn]:
+    tails = []
+    used = set(cfg.pinned)
+    for i, b in enumerate(cfg.blocks):
+        following = cfg.blocks[i + 1] if i + 1 < len(cfg.blocks) else None
+        tail = _tail(b, following, cfg)
+        used.update(insns.operand(insn) for insn in tail)
+        tails.append(tail)
+    code = []
+    for b, tail in zip(cfg.blocks, tails):
+        name = _name(b, cfg)
+        for label in b.labels:
+            if label in cfg.pinned or (label == name and name in used):
+                code.append(Label(label))
+        if not b.labels and name in used:
+            code.append(Label(name))
+        code += b.insns[:-1] if b.jump() else b.insns
+        code += tail
+    return code
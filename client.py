@@ -0,0 +1,99 @@
+# Description: Thin client of the compile server
+#
+# Sends one request to server.py over its Unix socket and prints the
+# answer.  It imports nothing of the compiler, so it starts in the time
+# the interpreter takes to; the compiling happens in the server's warm
+# workers.
+#
+# The protocol is one JSON object per line each way.  A request has an
+# "id", an "op" (compile, check, run, stats or shutdown), and for the
+# first three the program's "source" and the compiler "options"
+# (tauc.Options fields).  The response carries the same id, "ok", and
+# either "error" or the op's results: the bytecode file and debug info,
+# base64 encoded, for compile; the printed lines and the instructions
+# executed for run.  Every response to a compile, check or run also
+# tells the stage the build started from ("started") and how long the
+# server took ("seconds").
+#
+# usage: python client.py [--socket PATH] compile|check|run|stats|shutdown [file] [-o FILE] [options]
+
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from typing import List
+
+SOCKET = os.environ.get("TAUC_SOCKET") or os.path.join(tempfile.gettempdir(), f"tauc-{os.getuid()}.sock")
+
+
+def request(message: dict, path: str = SOCKET) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(message).encode() + b"\n")
+        with s.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("the server closed the connection")
+    return json.loads(line)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Send a request to the Tau compile server.")
+    parser.add_argument("op", choices=["compile", "check", "run", "stats", "shutdown"])
+    parser.add_argument("file", nargs="?")
+    parser.add_argument("-o", "--output", help="bytecode file compile writes (default: file with .taub)")
+    parser.add_argument("--socket", default=SOCKET)
+    parser.add_argument("--time", action="store_true", help="report the round trip time")
+    parser.add_argument("-g", "--debug", action="store_true", help="write debug info next to the bytecode")
+    parser.add_argument("-O", dest="level", type=int, choices=[0, 1, 2], default=0, help="as for tauc.py")
+    for flag in ["fold", "schedule", "lean", "memo", "fuse", "cfg"]:
+        parser.add_argument(f"--{flag}", action="store_true", help="as for tauc.py")
+    parser.add_argument("--profile", metavar="FILE", help="as for tauc.py")
+    args = parser.parse_args(argv)
+    message = {"id": 1, "op": args.op}
+    if args.op in ("compile", "check", "run"):
+        if args.file is None:
+            parser.error(f"{args.op} needs a file")
+        with open(args.file) as f:
+            message["source"] = f.read()
+        message["options"] = {
+            flag: getattr(args, flag) for flag in ["fold", "schedule", "lean", "memo", "fuse", "cfg", "debug"]
+        }
+        message["options"]["level"] = args.level
+        message["options"]["profile"] = os.path.abspath(args.profile) if args.profile else None
+    start = time.perf_counter()
+    try:
+        response = request(message, args.socket)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print(f"no compile server at {args.socket}; start one with python server.py", file=sys.stderr)
+        return 2
+    elapsed = time.perf_counter() - start
+    if not response["ok"]:
+        print(f"{args.file or args.op}: {response['error']}", file=sys.stderr)
+        return 1
+    match args.op:
+        case "compile":
+            output = args.output or os.path.splitext(args.file)[0] + ".taub"
+            with open(output, "wb") as f:
+                f.write(base64.b64decode(response["bytecode"]))
+            if response.get("debug") is not None:
+                with open(output + ".dbg", "wb") as f:  # debuginfo.sidecar()
+                    f.write(base64.b64decode(response["debug"]))
+        case "run":
+            for line in response["output"]:
+                print(line)
+        case "stats":
+            print(json.dumps(response["stats"], indent=1))
+    if args.time:
+        started = response.get("started")
+        cached = f", from cached {started}" if started else ""
+        print(f"{elapsed * 1e3:.1f} ms round trip{cached}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from tau.error import *
 from tau import asts, symbols
@@ -38,11 +38,84 @@ from tau.vm.vm import (
     Noop,
     Swap,
 )
+from insns import MemoCall, MemoSave
+
+
+# With generate(ast, lean=True) functions use a leaner calling
+# convention.  The frame layout is the same (argument i at FP-2-i, the
+# return address and the old FP at FP+0 and FP+1, locals from FP+3), but
+#  - the caller stores the arguments straight into their slots above its
+#    SP and leaves SP alone; the callee sets FP to SP+1+n itself,
+#  - the old SP is not saved: it is FP-1-n, and the callee's SP is
+#    FP+ast.size,
+#  - the result is returned on the eval stack instead of in the FP-1 slot,
+#  - a leaf function without locals gets no frame at all.  SP does not
+#    move while it runs, so it addresses its parameters from SP and
+#    returns with a bare JumpIndirect.
+# Functions of the two conventions cannot call each other.
+#
+# Calls of the functions named in generate(ast, memo=...) consult a memo
+# table first (see memo.py).  Only the usual convention supports that.
+#
+# generate(ast, spans=[]) fills the list with the span of the innermost
+# AST node each instruction was generated for (None for the code before
+# the first function).
+#
+# For profile-guided optimization (see pgo.py), probes=True adds labels
+# that link() drops again: str(id(stmt)) + "probe" in front of every
+# statement, and the "then" and "body" labels of every if and while even
+# where nothing jumps to them.  feedback, if given, decides per statement
+#  - feedback.invert(if_stmt): test for the then branch and put the else
+#    branch first, so that the Jump over the other branch is paid by the
+#    else branch instead,
+#  - feedback.rotate(while_stmt): test at the bottom of the loop, which
+#    saves the Jump back to the top on every iteration at the cost of one
+#    Jump into the loop.
+_lean = False
+_frame = None  # (parameter count, frameless) of the function being generated
+_memo = frozenset()
+_spans: Optional[Dict[int, Tuple[Insn, object]]] = None  # id(insn) -> (insn, span)
+_probes = False
+_feedback = None
 
 
 # This is the entry point for the visitor.
-def generate(ast: asts.Program) -> List[Insn]:
-    return _Program(ast)
+def generate(
+    ast: asts.Program,
+    lean: bool = False,
+    memo: Iterable[str] = (),
+    spans: Optional[list] = None,
+    probes: bool = False,
+    feedback=None,
+) -> List[Insn]:
+    global _lean, _memo, _spans, _probes, _feedback
+    assert not (lean and memo), "memoized calls need the usual calling convention"
+    _lean = lean
+    _memo = frozenset(memo)
+    _spans = {} if spans is not None else None
+    _probes = probes
+    _feedback = feedback
+    try:
+        code = _Program(ast)
+        if spans is not None:
+            spans[:] = [_spans[id(insn)][1] if id(insn) in _spans else None for insn in code]
+        return code
+    finally:
+        _lean = False
+        _memo = frozenset()
+        _spans = None
+        _probes = False
+        _feedback = None
+
+
+# Records ast's span for the instructions that have none yet.  The
+# instruction is kept too, so that its id() is not reused.
+def _tag(stack: List[Insn], ast) -> List[Insn]:
+    if _spans is not None:
+        for insn in stack:
+            if id(insn) not in _spans:
+                _spans[id(insn)] = (insn, ast.span)
+    return stack
 
 
 def _Program(ast: asts.Program) -> List[Insn]:
@@ -51,13 +124,15 @@ def _Program(ast: asts.Program) -> List[Insn]:
     f.append(Call())
     f.append(Halt())
     for decl in ast.decls:
-        f += _FuncDecl(decl)
+        f += _tag(_FuncDecl(decl), decl)
     #instruction_dump(f)
     return(f)
 
 
 def _Stmt(ast: asts.Stmt) -> List[Insn]:
     stack = []
+    if _probes:
+        stack.append(Label(str(id(ast)) + "probe"))
     if isinstance(ast, asts.AssignStmt):
         stack += _AssignStmt(ast)
     elif isinstance(ast, asts.IfStmt):
@@ -74,10 +149,12 @@ def _Stmt(ast: asts.Stmt) -> List[Insn]:
         stack += _ReturnStmt(ast)
     else:
         assert False, f"_Stmt() not implemented for {type(ast)}"
-    return(stack)
+    return _tag(stack, ast)
 
 
 def rval_CallExpr(ast: asts.CallExpr) -> List[Insn]:
+    if _lean:
+        return _lean_CallExpr(ast)
     stack = []
     # do pre-call stuff
     stack.append(PushSP(1 + len(ast.args)))
@@ -88,8 +165,13 @@ def rval_CallExpr(ast: asts.CallExpr) -> List[Insn]:
         stack.append(PushSP(-(i)-2))
         stack += rval(arg)
         stack.append(Store()) 
-    stack += (lval(ast.fn))
-    stack.append(Call())
+    if ast.fn.id.token.value in _memo:
+        stack.append(PushImmediate(len(ast.args)))
+        stack += lval(ast.fn)
+        stack += [MemoCall(), MemoSave()]
+    else:
+        stack += (lval(ast.fn))
+        stack.append(Call())
     # do post-call stuff
     stack.append(PushSP(-1))
     stack.append(Load())
@@ -98,6 +180,67 @@ def rval_CallExpr(ast: asts.CallExpr) -> List[Insn]:
     return(stack)
 
 
+def _lean_CallExpr(ast: asts.CallExpr) -> List[Insn]:
+    stack = []
+    n = len(ast.args)
+    # The frame of a call made while evaluating an argument would overwrite
+    # the slots already stored, so those arguments are evaluated first, onto
+    # the eval stack.  The others only read variables, so evaluating them
+    # afterwards cannot be observed.
+    nested = [i for i, arg in enumerate(ast.args) if _calls(arg)]
+    for i in nested:
+        stack += rval(ast.args[i])
+    for i, arg in enumerate(ast.args):
+        if i not in nested:
+            stack.append(PushSP(n - 1 - i))
+            stack += rval(arg)
+            stack.append(Store())
+    for i in reversed(nested):
+        stack.append(PushSP(n - 1 - i))
+        stack.append(Swap())
+        stack.append(Store())
+    stack += lval(ast.fn)
+    stack.append(Call())
+    return(stack)
+
+
+def _calls(e: asts.Expr) -> bool:
+    match e:
+        case asts.CallExpr():
+            return True
+        case asts.BinaryOp():
+            return _calls(e.left) or _calls(e.right)
+        case asts.UnaryOp():
+            return _calls(e.expr)
+        case asts.ArrayCell():
+            return _calls(e.arr) or _calls(e.idx)
+        case _:
+            return False
+
+
+# A statement of a leaf function without locals.
+def _frameless(s: asts.Stmt) -> bool:
+    match s:
+        case asts.CompoundStmt():
+            return not s.decls and all(_frameless(t) for t in s.stmts)
+        case asts.AssignStmt():
+            return not _calls(s.lhs) and not _calls(s.rhs)
+        case asts.IfStmt():
+            return (
+                not _calls(s.expr)
+                and _frameless(s.thenStmt)
+                and (s.elseStmt is None or _frameless(s.elseStmt))
+            )
+        case asts.WhileStmt():
+            return not _calls(s.expr) and _frameless(s.stmt)
+        case asts.PrintStmt():
+            return not _calls(s.expr)
+        case asts.ReturnStmt():
+            return s.expr is None or not _calls(s.expr)
+        case _:
+            return False
+
+
 def _AssignStmt(ast: asts.AssignStmt) -> List[Insn]:
     stack = []
     # do something with ast.lhs
@@ -120,10 +263,22 @@ def _PrintStmt(ast: asts.PrintStmt) -> List[Insn]:
 
 def _IfStmt(ast: asts.IfStmt) -> List[Insn]:
     stack = []
+    label_then = str(id(ast)) + "then"
     label_else = str(id(ast)) + "else"
     label_exit = str(id(ast)) + "exit"
+    if _feedback is not None and _feedback.invert(ast):
+        stack += control(ast.expr, label_then, True)
+        if(ast.elseStmt is not None):
+            stack += _Stmt(ast.elseStmt)
+        stack.append(Jump(label_exit))
+        stack.append(Label(label_then))
+        stack += _Stmt(ast.thenStmt)
+        stack.append(Label(label_exit))
+        return(stack)
     # do something with ast.expr
     stack += control(ast.expr, label_else, False)
+    if _probes:
+        stack.append(Label(label_then))
     # do something with ast.thenStmt
     stack += _Stmt(ast.thenStmt)
     stack.append(Jump(label_exit))
@@ -138,10 +293,21 @@ def _IfStmt(ast: asts.IfStmt) -> List[Insn]:
 def _WhileStmt(ast: asts.WhileStmt) -> List[Insn]:
     stack = []
     label_top = str(id(ast)) + "top"
+    label_body = str(id(ast)) + "body"
     label_exit = str(id(ast)) + "exit"
+    if _feedback is not None and _feedback.rotate(ast):
+        stack.append(Jump(label_top))
+        stack.append(Label(label_body))
+        stack += _Stmt(ast.stmt)
+        stack.append(Label(label_top))
+        stack += control(ast.expr, label_body, True)
+        stack.append(Label(label_exit))
+        return(stack)
     stack.append(Label(label_top))
     # do something with ast.expr
     stack += control(ast.expr, label_exit, False)
+    if _probes:
+        stack.append(Label(label_body))
     # do something with ast.stmt
     stack += _Stmt(ast.stmt)
     stack.append(Jump(label_top))
@@ -167,7 +333,7 @@ def control(e: asts.Expr, label: str, sense: bool) -> List[Insn]:
                 stack.append(JumpIfNotZero(label))
             else:
                 stack.append(JumpIfZero(label))
-    return(stack)
+    return _tag(stack, e)
 
 
 def control_BoolLiteral(
@@ -209,7 +375,7 @@ def control_BinaryOp(e: asts.BinaryOp, label: str, sense: bool) -> List[Insn]:
                 stack.append(JumpIfNotZero(label))
             else:
                 stack.append(JumpIfZero(label))
-    return(stack)
+    return _tag(stack, e)
 
 
 def control_UnaryOp(e: asts.UnaryOp, label: str, sense: bool) -> List[Insn]:
@@ -240,6 +406,8 @@ def _CompoundStmt(ast: asts.CompoundStmt) -> List[Insn]:
 
 
 def _FuncDecl(ast: asts.FuncDecl) -> List[Insn]:
+    if _lean:
+        return _lean_FuncDecl(ast)
     # do something for prologue
     stack = []
     stack.append(Label(ast.id.token.value)) #label for func dec
@@ -272,7 +440,51 @@ def _FuncDecl(ast: asts.FuncDecl) -> List[Insn]:
     return(stack)
 
 
+def _lean_FuncDecl(ast: asts.FuncDecl) -> List[Insn]:
+    global _frame
+    n = len(ast.params)
+    _frame = (n, _frameless(ast.body))
+    stack = []
+    stack.append(Label(ast.id.token.value))
+    if not _frame[1]:
+        stack.append(PushSP(1 + n))
+        stack.append(Swap())
+        stack.append(Store()) #return address at the new fp
+        stack.append(PushSP(2 + n))
+        stack.append(PushFP(0))
+        stack.append(Store()) #old fp at the new fp + 1
+        stack.append(PushSP(1 + n))
+        stack.append(PopFP())
+        stack.append(PushFP(ast.size))
+        stack.append(PopSP())
+    stack += _CompoundStmt(ast.body)
+    stack.append(PushImmediate(0)) #result of falling off the end
+    stack += _lean_return()
+    _frame = None
+    return(stack)
+
+
+# Returns to the caller with the result on top of the eval stack.
+def _lean_return() -> List[Insn]:
+    n, frameless = _frame
+    if frameless:
+        return [Swap(), JumpIndirect()]
+    stack = []
+    stack.append(PushFP(0))
+    stack.append(Load()) #return address above the result
+    stack.append(PushFP(-1 - n))
+    stack.append(PopSP())
+    stack.append(PushFP(1))
+    stack.append(Load())
+    stack.append(PopFP())
+    stack.append(JumpIndirect())
+    return(stack)
+
+
 def _ReturnStmt(ast: asts.ReturnStmt) -> List[Insn]:
+    if _lean:
+        value = rval(ast.expr) if ast.expr is not None else [PushImmediate(0)]
+        return value + _lean_return()
     # do something with ast.expr, if present
     stack = []
     if(ast.expr is not None):
@@ -295,7 +507,7 @@ def _ReturnStmt(ast: asts.ReturnStmt) -> List[Insn]:
 def lval(e: asts.Expr) -> List[Insn]:
     match e:
         case asts.IdExpr():
-            return lval_IdExpr(e)
+            return _tag(lval_IdExpr(e), e)
         case _:
             assert False, f"lval() not implemented for {type(e)}"
 
@@ -310,12 +522,12 @@ def lval_IdExpr(e: asts.IdExpr) -> List[Insn]:
         case symbols.LocalScope:
             # TODO: implement
             local_offset = e.id.symbol.offset
-            stack.append(PushFP(local_offset))
+            stack.append(_slot(local_offset))
 
         case symbols.FuncScope:
             # TODO: implement
             func_offset = e.id.symbol.offset
-            stack.append(PushFP(func_offset))
+            stack.append(_slot(func_offset))
         case _:
             assert (
                 False
@@ -340,7 +552,7 @@ def rval(e: asts.Expr) -> List[Insn]:
             stack += rval_BoolLiteral(e)
         case _:
             assert False, f"rval() not implemented for {type(e)}"
-    return(stack)
+    return _tag(stack, e)
 
 
 def rval_BoolLiteral(e: asts.BoolLiteral) -> List[Insn]:
@@ -363,11 +575,18 @@ def rval_IntLiteral(e: asts.IntLiteral) -> List[Insn]:
 def rval_IdExpr(e: asts.IdExpr) -> List[Insn]:
     # TODO: implement
     stack = []
-    stack.append(PushFP(e.id.symbol.offset))
+    stack.append(_slot(e.id.symbol.offset))
     stack.append(Load())
     return(stack)
 
 
+# Pushes the address of the frame slot at offset.
+def _slot(offset: int) -> Insn:
+    if _frame is not None and _frame[1]:
+        return PushSP(_frame[0] + 1 + offset)
+    return PushFP(offset)
+
+
 def rval_BinaryOp(e: asts.BinaryOp) -> List[Insn]:
     stack = []
     match e.op.kind:
@@ -0,0 +1,245 @@
+# Description: Compile-time evaluation of calls to pure functions
+#
+# A CallExpr whose callee is pure (see purity.py) and whose arguments
+# are all literals, after folding the arguments themselves, is run by a
+# small evaluator over the typed AST and replaced by an IntLiteral or
+# BoolLiteral holding the result.  A CallStmt of such a call that runs
+# to completion has no effect and is dropped.
+#
+# Each call gets FUEL steps (statements and expressions evaluated) and
+# at most DEPTH nested calls.  A call that runs out of either, divides
+# by zero or reads a local before assigning it is left for run time, so
+# the program behaves exactly as it did.  Arithmetic follows the vm:
+# ints are unbounded and / floors.
+#
+# Runs on the typed AST, after typecheck and before offsets.
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+from tau import asts
+from tau.symbols import *
+from tau.tokens import Token
+import purity
+
+FUEL = 100000
+DEPTH = 64
+
+Value = Union[int, bool]
+
+
+@dataclass
+class Stats:
+    folded: int = 0  # calls replaced by their value
+    dropped: int = 0  # call statements removed
+    out_of_fuel: int = 0
+    failed: int = 0  # other calls that had to be left alone
+
+
+class _GiveUp(Exception):
+    pass
+
+
+class _OutOfFuel(_GiveUp):
+    pass
+
+
+class _Done:
+    def __init__(self, value: Optional[Value]):
+        self.value = value
+
+
+class _Evaluator:
+    def __init__(self, decls: Dict[str, asts.FuncDecl], fuel: int):
+        self.decls = decls
+        self.fuel = fuel
+        self.depth = 0
+
+    def call(self, name: str, args: List[Value]) -> Optional[Value]:
+        if self.depth == DEPTH:
+            raise _OutOfFuel()
+        decl = self.decls[name]
+        env = {id(p.id.symbol): v for p, v in zip(decl.params, args)}
+        self.depth += 1
+        done = self.stmt(decl.body, env)
+        self.depth -= 1
+        if done is not None:
+            return done.value
+        return None if isinstance(decl.ret_type_ast, asts.VoidType) else 0
+
+    def tick(self):
+        self.fuel -= 1
+        if self.fuel < 0:
+            raise _OutOfFuel()
+
+    # Returns a _Done once a return statement has run.
+    def stmt(self, ast: asts.Stmt, env: Dict[int, Value]) -> Optional[_Done]:
+        self.tick()
+        match ast:
+            case asts.CompoundStmt():
+                for s in ast.stmts:
+                    done = self.stmt(s, env)
+                    if done is not None:
+                        return done
+            case asts.AssignStmt():
+                env[id(ast.lhs.id.symbol)] = self.expr(ast.rhs, env)
+            case asts.IfStmt():
+                if self.expr(ast.expr, env):
+                    return self.stmt(ast.thenStmt, env)
+                if ast.elseStmt is not None:
+                    return self.stmt(ast.elseStmt, env)
+            case asts.WhileStmt():
+                while self.expr(ast.expr, env):
+                    done = self.stmt(ast.stmt, env)
+                    if done is not None:
+                        return done
+            case asts.CallStmt():
+                self.expr(ast.call, env)
+            case asts.ReturnStmt():
+                return _Done(None if ast.expr is None else self.expr(ast.expr, env))
+            case _:
+                raise _GiveUp()
+        return None
+
+    def expr(self, e: asts.Expr, env: Dict[int, Value]) -> Value:
+        self.tick()
+        match e:
+            case asts.IntLiteral():
+                return int(e.token.value)
+            case asts.BoolLiteral():
+                return e.value
+            case asts.IdExpr():
+                if id(e.id.symbol) not in env:
+                    raise _GiveUp()  # whatever the slot last held
+                return env[id(e.id.symbol)]
+            case asts.CallExpr():
+                return self.call(e.fn.id.token.value, [self.expr(arg, env) for arg in e.args])
+            case asts.UnaryOp():
+                value = self.expr(e.expr, env)
+                return not value if e.op.kind == "not" else -value
+            case asts.BinaryOp():
+                left = self.expr(e.left, env)
+                match e.op.kind:
+                    case "and":
+                        return left and self.expr(e.right, env)
+                    case "or":
+                        return left or self.expr(e.right, env)
+                right = self.expr(e.right, env)
+                match e.op.kind:
+                    case "+":
+                        return left + right
+                    case "-":
+                        return left - right
+                    case "*":
+                        return left * right
+                    case "/":
+                        if right == 0:
+                            raise _GiveUp()
+                        return left // right
+                    case "<":
+                        return left < right
+                    case "<=":
+                        return left <= right
+                    case ">":
+                        return left > right
+                    case ">=":
+                        return left >= right
+                    case "==":
+                        return left == right
+                    case "!=":
+                        return left != right
+        raise _GiveUp()
+
+
+class _Folder:
+    def __init__(self, ast: asts.Program, fuel: int):
+        self.decls = {decl.id.token.value: decl for decl in ast.decls}
+        self.pure = purity.pure(ast)
+        self.fuel = fuel
+        self.stats = Stats()
+
+    # Runs the call if it can be, and returns whether it completed and
+    # what it returned.
+    def run(self, e: asts.CallExpr) -> Optional[_Done]:
+        name = e.fn.id.token.value
+        if name not in self.pure:
+            return None
+        if not all(isinstance(arg, (asts.IntLiteral, asts.BoolLiteral)) for arg in e.args):
+            return None
+        evaluator = _Evaluator(self.decls, self.fuel)
+        args = [evaluator.expr(arg, {}) for arg in e.args]
+        try:
+            return _Done(evaluator.call(name, args))
+        except _OutOfFuel:
+            self.stats.out_of_fuel += 1
+        except (_GiveUp, RecursionError):
+            self.stats.failed += 1
+        return None
+
+    def stmt(self, ast: asts.Stmt):
+        match ast:
+            case asts.CompoundStmt():
+                stmts = []
+                for s in ast.stmts:
+                    if isinstance(s, asts.CallStmt):
+                        s.call.args = [self.expr(arg) for arg in s.call.args]
+                        if self.run(s.call) is not None:
+                            self.stats.dropped += 1
+                            continue
+                    else:
+                        self.stmt(s)
+                    stmts.append(s)
+                ast.stmts = stmts
+            case asts.AssignStmt():
+                ast.lhs = self.expr(ast.lhs)
+                ast.rhs = self.expr(ast.rhs)
+            case asts.IfStmt():
+                ast.expr = self.expr(ast.expr)
+                self.stmt(ast.thenStmt)
+                if ast.elseStmt is not None:
+                    self.stmt(ast.elseStmt)
+            case asts.WhileStmt():
+                ast.expr = self.expr(ast.expr)
+                self.stmt(ast.stmt)
+            case asts.PrintStmt():
+                ast.expr = self.expr(ast.expr)
+            case asts.ReturnStmt():
+                if ast.expr is not None:
+                    ast.expr = self.expr(ast.expr)
+
+    def expr(self, e: asts.Expr) -> asts.Expr:
+        match e:
+            case asts.CallExpr():
+                e.args = [self.expr(arg) for arg in e.args]
+                done = self.run(e)
+                if done is not None and done.value is not None:
+                    self.stats.folded += 1
+                    return _literal(done.value, e)
+            case asts.BinaryOp():
+                e.left = self.expr(e.left)
+                e.right = self.expr(e.right)
+            case asts.UnaryOp():
+                e.expr = self.expr(e.expr)
+            case asts.ArrayCell():
+                e.arr = self.expr(e.arr)
+                e.idx = self.expr(e.idx)
+        return e
+
+
+def _literal(value: Value, e: asts.Expr) -> asts.Expr:
+    if isinstance(e.semantic_type, BoolType):
+        value = bool(value)
+        word = "true" if value else "false"
+        literal = asts.BoolLiteral(Token(word, word, e.span), value, e.span)
+        literal.semantic_type = BoolType()
+    else:
+        literal = asts.IntLiteral(Token("INT", str(value), e.span), e.span)
+        literal.semantic_type = IntType()
+    return literal
+
+
+def process(ast: asts.Program, fuel: int = FUEL) -> Stats:
+    folder = _Folder(ast, fuel)
+    for decl in ast.decls:
+        folder.stmt(decl.body)
+    return folder.stats
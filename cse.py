@@ -0,0 +1,343 @@
+# Description: Common-subexpression elimination within basic blocks
+#
+# Each maximal run of straight-line statements in a CompoundStmt is value
+# numbered.  An expression that is computed more than once in a run, with
+# the same operand values, is evaluated once into a temporary and every
+# occurrence reads the temporary instead.
+#
+# An AssignStmt to a variable (or to a cell of an array) gives that
+# variable a new version, so expressions reading it afterwards get new
+# value numbers.  Statements containing a CallExpr end the run, as do
+# if/while/nested blocks, which are processed on their own.
+#
+# The right operand of "and"/"or" is only evaluated when the left one does
+# not decide the result, so nothing inside it is numbered or rewritten:
+# hoisting it into a temporary ahead of the statement would evaluate it
+# unconditionally (and fault where the left operand guards a division).
+# The left operand is always evaluated and is treated like any other.
+#
+# Temporaries are declared as VarDecls of the enclosing CompoundStmt, so
+# this pass must run after typecheck and before offsets, which allocates
+# their frame slots along with the other locals.
+
+from typing import Dict, List, Optional, Tuple
+
+from tau import asts
+from tau.symbols import *
+from tau.tokens import Token
+
+# Operators whose operands may be swapped without changing the value.
+commutative = {"+", "*", "==", "!="}
+
+# Operators whose right operand is evaluated only on demand.
+short_circuit = {"and", "or"}
+
+
+class _Run:
+    def __init__(self):
+        self.numbers: Dict[tuple, int] = {}  # value key -> value number
+        self.versions: Dict[int, int] = {}  # id(symbol) -> version
+        self.nodes: Dict[int, List[asts.Expr]] = {}  # value number -> occurrences
+        self.size: Dict[int, int] = {}  # value number -> expression size
+        self.inner: Dict[int, List[int]] = {}  # value number -> candidate subexpressions
+        self.cost: Dict[int, int] = {}  # value number -> rval instruction count
+        self.temps: Dict[int, asts.IdExpr] = {}  # selected value number -> temporary
+        self.of: Dict[int, int] = {}  # id(candidate node) -> value number
+
+    def number(self, key: tuple) -> int:
+        if key not in self.numbers:
+            self.numbers[key] = len(self.numbers)
+        return self.numbers[key]
+
+    def version(self, sym) -> int:
+        return self.versions.get(id(sym), 0)
+
+    def write(self, sym):
+        self.versions[id(sym)] = self.version(sym) + 1
+
+
+class _State:
+    def __init__(self):
+        self.temps = 0
+        self.eliminated = 0
+
+
+def process(ast: asts.Program):
+    program(ast)
+
+
+def program(ast: asts.Program):
+    for decl in ast.decls:
+        funcdecl(decl)
+
+
+def funcdecl(ast: asts.FuncDecl) -> int:
+    state = _State()
+    compoundstmt(ast.body, state)
+    return state.eliminated
+
+
+def compoundstmt(ast: asts.CompoundStmt, state: _State):
+    stmts = []
+    run = []
+    for s in ast.stmts:
+        if _straight(s):
+            run.append(s)
+            continue
+        stmts += _block(run, ast, state)
+        run = []
+        match s:
+            case asts.CompoundStmt():
+                compoundstmt(s, state)
+            case asts.IfStmt():
+                compoundstmt(s.thenStmt, state)
+                if s.elseStmt is not None:
+                    compoundstmt(s.elseStmt, state)
+            case asts.WhileStmt():
+                compoundstmt(s.stmt, state)
+        stmts.append(s)
+    stmts += _block(run, ast, state)
+    ast.stmts = stmts
+
+
+# A statement belongs to a run if it does not transfer control and does
+# not call a function.
+def _straight(s: asts.Stmt) -> bool:
+    match s:
+        case asts.AssignStmt():
+            return not _calls(s.lhs) and not _calls(s.rhs)
+        case asts.PrintStmt():
+            return not _calls(s.expr)
+        case asts.ReturnStmt():
+            return s.expr is None or not _calls(s.expr)
+        case _:
+            return False
+
+
+def _calls(e: asts.Expr) -> bool:
+    match e:
+        case asts.CallExpr():
+            return True
+        case asts.BinaryOp():
+            return _calls(e.left) or _calls(e.right)
+        case asts.UnaryOp():
+            return _calls(e.expr)
+        case asts.ArrayCell():
+            return _calls(e.arr) or _calls(e.idx)
+        case _:
+            return False
+
+
+def _block(stmts: List[asts.Stmt], scope: asts.CompoundStmt, state: _State) -> List[asts.Stmt]:
+    if len(stmts) < 2:
+        return stmts
+    run = _Run()
+    for s in stmts:
+        _count(s, run)
+    selected = _select(run)
+    if not selected:
+        return stmts
+    result = []
+    for s in stmts:
+        pending = []
+        match s:
+            case asts.AssignStmt():
+                if isinstance(s.lhs, asts.ArrayCell):
+                    s.lhs.idx = _rewrite(s.lhs.idx, selected, run, scope, state, pending)
+                s.rhs = _rewrite(s.rhs, selected, run, scope, state, pending)
+            case asts.PrintStmt():
+                s.expr = _rewrite(s.expr, selected, run, scope, state, pending)
+            case asts.ReturnStmt():
+                if s.expr is not None:
+                    s.expr = _rewrite(s.expr, selected, run, scope, state, pending)
+        result += pending
+        result.append(s)
+    return result
+
+
+# First walk: give every subexpression a value number, and record where
+# the candidate (non-leaf) expressions occur.
+def _count(s: asts.Stmt, run: _Run):
+    match s:
+        case asts.AssignStmt():
+            if isinstance(s.lhs, asts.ArrayCell):
+                _value(s.lhs.idx, run)
+            _value(s.rhs, run)
+            match s.lhs:
+                case asts.IdExpr():
+                    run.write(s.lhs.id.symbol)
+                case asts.ArrayCell():
+                    run.write(s.lhs.arr.id.symbol)
+        case asts.PrintStmt():
+            _value(s.expr, run)
+        case asts.ReturnStmt():
+            if s.expr is not None:
+                _value(s.expr, run)
+
+
+def _value(e: asts.Expr, run: _Run) -> int:
+    vn, _, _ = _number(e, run)
+    return vn
+
+
+# Returns the value number, the size, and the rval instruction count of e.
+def _number(e: asts.Expr, run: _Run) -> Tuple[int, int, int]:
+    match e:
+        case asts.IntLiteral():
+            return run.number(("int", int(e.token.value))), 1, 1
+        case asts.BoolLiteral():
+            return run.number(("bool", e.value)), 1, 1
+        case asts.IdExpr():
+            sym = e.id.symbol
+            return run.number(("id", id(sym), run.version(sym))), 1, 2
+        case asts.BinaryOp() if e.op.kind in short_circuit:
+            # A value of its own, so no enclosing expression matches either.
+            _, lsize, lcost = _number(e.left, run)
+            vn = run.number((e.op.kind, id(e)))
+            return vn, lsize + _size(e.right) + 1, lcost + 4
+        case asts.BinaryOp():
+            left, lsize, lcost = _number(e.left, run)
+            right, rsize, rcost = _number(e.right, run)
+            operands = (left, right)
+            if e.op.kind in commutative:
+                operands = tuple(sorted(operands))
+            cost = lcost + rcost + 1
+            vn = run.number((e.op.kind,) + operands)
+            return _candidate(e, vn, lsize + rsize + 1, cost, [e.left, e.right], run)
+        case asts.UnaryOp():
+            operand, size, cost = _number(e.expr, run)
+            vn = run.number(("unary" + e.op.kind, operand))
+            return _candidate(e, vn, size + 1, cost + 1, [e.expr], run)
+        case asts.ArrayCell():
+            sym = e.arr.id.symbol
+            idx, size, cost = _number(e.idx, run)
+            vn = run.number(("[]", id(sym), run.version(sym), idx))
+            return _candidate(e, vn, size + 2, cost + 3, [e.idx], run)
+        case _:
+            raise NotImplementedError(f"_number() not implemented for {type(e)}")
+
+
+def _size(e: asts.Expr) -> int:
+    match e:
+        case asts.BinaryOp():
+            return _size(e.left) + _size(e.right) + 1
+        case asts.UnaryOp():
+            return _size(e.expr) + 1
+        case asts.ArrayCell():
+            return _size(e.idx) + 2
+        case _:
+            return 1
+
+
+def _candidate(e: asts.Expr, vn: int, size: int, cost: int, kids: List[asts.Expr], run: _Run) -> Tuple[int, int, int]:
+    run.nodes.setdefault(vn, []).append(e)
+    run.of[id(e)] = vn
+    run.size[vn] = size
+    run.cost[vn] = cost
+    if vn not in run.inner:
+        inner = []
+        for kid in kids:
+            _inner(kid, run, inner)
+        run.inner[vn] = inner
+    return vn, size, cost
+
+
+def _inner(e: asts.Expr, run: _Run, inner: List[int]):
+    match e:
+        case asts.BinaryOp() if e.op.kind in short_circuit:
+            _inner(e.left, run, inner)
+        case asts.BinaryOp():
+            inner.append(_lookup(e, run))
+            _inner(e.left, run, inner)
+            _inner(e.right, run, inner)
+        case asts.UnaryOp():
+            inner.append(_lookup(e, run))
+            _inner(e.expr, run, inner)
+        case asts.ArrayCell():
+            inner.append(_lookup(e, run))
+            _inner(e.idx, run, inner)
+
+
+def _lookup(e: asts.Expr, run: _Run) -> int:
+    return run.of[id(e)]
+
+
+# Pick the value numbers worth keeping in a temporary.  Larger expressions
+# are considered first; once one is reused, the occurrences of its
+# subexpressions inside the reused copies no longer count.
+def _select(run: _Run) -> set:
+    counts = {vn: len(nodes) for vn, nodes in run.nodes.items()}
+    selected = set()
+    for vn in sorted(counts, key=lambda vn: -run.size[vn]):
+        count = counts[vn]
+        # One store and count loads replace count evaluations.
+        if count < 2 or (count - 1) * run.cost[vn] <= 2 * count + 2:
+            continue
+        selected.add(vn)
+        for sub in run.inner[vn]:
+            counts[sub] -= count - 1
+    return selected
+
+
+# Second walk: replace selected expressions by their temporary, emitting
+# the temporary's assignment into pending at its first occurrence.
+def _rewrite(e: asts.Expr, selected: set, run: _Run, scope: asts.CompoundStmt, state: _State, pending: List[asts.Stmt]) -> asts.Expr:
+    vn = _find(e, run)
+    if vn is not None and vn in selected:
+        if vn in run.temps:
+            state.eliminated += 1
+            return _read(run.temps[vn])
+        _children(e, selected, run, scope, state, pending)
+        temp = _temp(e, scope, state)
+        run.temps[vn] = temp
+        pending.append(asts.AssignStmt(_read(temp), e, e.span))
+        return _read(temp)
+    _children(e, selected, run, scope, state, pending)
+    return e
+
+
+def _children(e: asts.Expr, selected: set, run: _Run, scope: asts.CompoundStmt, state: _State, pending: List[asts.Stmt]):
+    match e:
+        case asts.BinaryOp() if e.op.kind in short_circuit:
+            e.left = _rewrite(e.left, selected, run, scope, state, pending)
+        case asts.BinaryOp():
+            e.left = _rewrite(e.left, selected, run, scope, state, pending)
+            e.right = _rewrite(e.right, selected, run, scope, state, pending)
+        case asts.UnaryOp():
+            e.expr = _rewrite(e.expr, selected, run, scope, state, pending)
+        case asts.ArrayCell():
+            e.idx = _rewrite(e.idx, selected, run, scope, state, pending)
+
+
+def _find(e: asts.Expr, run: _Run) -> Optional[int]:
+    if not isinstance(e, (asts.BinaryOp, asts.UnaryOp, asts.ArrayCell)):
+        return None
+    if isinstance(e, asts.BinaryOp) and e.op.kind in short_circuit:
+        return None
+    return _lookup(e, run)
+
+
+def _temp(e: asts.Expr, scope: asts.CompoundStmt, state: _State) -> asts.IdExpr:
+    name = f"$cse{state.temps}"  # cannot clash with a scanned ID
+    state.temps += 1
+    if isinstance(e.semantic_type, BoolType):
+        type_ast = asts.BoolType(Token("bool", "bool", e.span))
+    else:
+        type_ast = asts.IntType(Token("int", "int", e.span))
+    type_ast.semantic_type = e.semantic_type
+    id = asts.Id(Token("ID", name, e.span))
+    sym = IdSymbol(name, scope.local_scope)
+    sym.set_type(e.semantic_type)
+    scope.local_scope.symtab[name] = sym
+    id.symbol = sym
+    id.semantic_type = e.semantic_type
+    decl = asts.VarDecl(id, type_ast, e.span)
+    decl.semantic_type = e.semantic_type
+    scope.decls.append(decl)
+    return asts.IdExpr(id, e.span)
+
+
+def _read(temp: asts.IdExpr) -> asts.IdExpr:
+    e = asts.IdExpr(temp.id, temp.span)
+    e.semantic_type = temp.id.semantic_type
+    return e
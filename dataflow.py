@@ -0,0 +1,224 @@
+# Description: Statement-level dataflow analysis for locals and parameters
+#
+# A function body is turned into a graph with one node per simple
+# statement (assign, print, call, return) and one node per if/while
+# condition.  Variables are identified by their frame slot, i.e. the
+# symbol.offset assigned by offsets.py, so this must run after offsets.
+# Arrays are treated as always live and never copied.
+#
+# solve() is a generic worklist solver; liveness(), reaching() and
+# copies() are the analyses built on it.
+
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from tau import asts
+from tau.symbols import *
+
+
+class Node:
+    def __init__(self, index: int, kind: str, ast, block: Optional[asts.CompoundStmt]):
+        self.index = index
+        self.kind = kind  # entry, exit, assign, print, call, return or cond
+        self.ast = ast  # the statement; the if/while statement for cond
+        self.block = block  # CompoundStmt whose stmts hold the statement
+        self.succs: List[Node] = []
+        self.preds: List[Node] = []
+        self.defs: Set[int] = set()
+        self.uses: Set[int] = set()
+        self.copy: Optional[Tuple[int, int]] = None  # (dst, src) for a = b
+
+
+class Graph:
+    def __init__(self, func: asts.FuncDecl):
+        self.func = func
+        self.nodes: List[Node] = []
+        self.vars: Dict[int, IdSymbol] = {}  # offset -> a symbol using the slot
+        self.entry = self.node("entry", None, None)
+        self.exit = self.node("exit", None, None)
+
+    def node(self, kind: str, ast, block: Optional[asts.CompoundStmt]) -> Node:
+        n = Node(len(self.nodes), kind, ast, block)
+        self.nodes.append(n)
+        return n
+
+
+class Result:
+    def __init__(self, before: Dict[Node, FrozenSet], after: Dict[Node, FrozenSet]):
+        self.before = before  # value on entry to each node, in program order
+        self.after = after  # value on exit from each node, in program order
+
+
+def _link(preds: List[Node], n: Node):
+    for p in preds:
+        p.succs.append(n)
+        n.preds.append(p)
+
+
+# Returns the frame slot read or written by e if it is a local or
+# parameter, and None for anything else (e.g. a function name).
+def slot(e: asts.IdExpr) -> Optional[int]:
+    sym = e.id.symbol
+    if isinstance(sym.scope, (FuncScope, LocalScope)):
+        return sym.offset
+    return None
+
+
+def scalar(e: asts.IdExpr) -> bool:
+    return slot(e) is not None and isinstance(e.id.symbol.get_type(), (IntType, BoolType))
+
+
+def build(func: asts.FuncDecl) -> Graph:
+    g = Graph(func)
+    for param in func.params:
+        g.vars[param.id.symbol.offset] = param.id.symbol
+        g.entry.defs.add(param.id.symbol.offset)
+    _link(_compound(func.body, [g.entry], g), g.exit)
+    return g
+
+
+def _compound(ast: asts.CompoundStmt, preds: List[Node], g: Graph) -> List[Node]:
+    for decl in ast.decls:
+        g.vars[decl.id.symbol.offset] = decl.id.symbol
+        g.entry.defs.add(decl.id.symbol.offset)
+    for s in ast.stmts:
+        preds = _stmt(s, ast, preds, g)
+    return preds
+
+
+def _stmt(ast: asts.Stmt, block: asts.CompoundStmt, preds: List[Node], g: Graph) -> List[Node]:
+    match ast:
+        case asts.CompoundStmt():
+            return _compound(ast, preds, g)
+        case asts.IfStmt():
+            cond = _simple(g.node("cond", ast, block), ast.expr, preds)
+            out = _compound(ast.thenStmt, [cond], g)
+            if ast.elseStmt is not None:
+                return out + _compound(ast.elseStmt, [cond], g)
+            return out + [cond]
+        case asts.WhileStmt():
+            cond = _simple(g.node("cond", ast, block), ast.expr, preds)
+            _link(_compound(ast.stmt, [cond], g), cond)
+            return [cond]
+        case asts.AssignStmt():
+            n = _simple(g.node("assign", ast, block), ast.rhs, preds)
+            match ast.lhs:
+                case asts.IdExpr():
+                    if slot(ast.lhs) is not None:
+                        n.defs.add(slot(ast.lhs))
+                        if isinstance(ast.rhs, asts.IdExpr) and scalar(ast.lhs) and scalar(ast.rhs):
+                            if slot(ast.lhs) != slot(ast.rhs):
+                                n.copy = (slot(ast.lhs), slot(ast.rhs))
+                case _:
+                    uses(ast.lhs, n.uses)
+            return [n]
+        case asts.PrintStmt():
+            return [_simple(g.node("print", ast, block), ast.expr, preds)]
+        case asts.CallStmt():
+            return [_simple(g.node("call", ast, block), ast.call, preds)]
+        case asts.ReturnStmt():
+            n = _simple(g.node("return", ast, block), ast.expr, preds)
+            _link([n], g.exit)
+            return []
+        case _:
+            raise NotImplementedError(f"_stmt() not implemented for {type(ast)}")
+
+
+def _simple(n: Node, e: Optional[asts.Expr], preds: List[Node]) -> Node:
+    if e is not None:
+        uses(e, n.uses)
+    _link(preds, n)
+    return n
+
+
+def uses(e: asts.Expr, acc: Set[int]):
+    match e:
+        case asts.IdExpr():
+            if slot(e) is not None:
+                acc.add(slot(e))
+        case asts.CallExpr():
+            for arg in e.args:
+                uses(arg, acc)
+        case asts.ArrayCell():
+            uses(e.arr, acc)
+            uses(e.idx, acc)
+        case asts.BinaryOp():
+            uses(e.left, acc)
+            uses(e.right, acc)
+        case asts.UnaryOp():
+            uses(e.expr, acc)
+
+
+# Iterates transfer over the graph until nothing changes.  For a backward
+# problem the flow runs from exit to entry; the returned Result is always
+# expressed in program order.
+def solve(
+    g: Graph,
+    forward: bool,
+    boundary: FrozenSet,
+    init: FrozenSet,
+    meet: Callable[[List[FrozenSet]], FrozenSet],
+    transfer: Callable[[Node, FrozenSet], FrozenSet],
+) -> Result:
+    start = g.entry if forward else g.exit
+    flow_in = {n: init for n in g.nodes}
+    flow_out = {n: init for n in g.nodes}
+    flow_in[start] = boundary
+    order = g.nodes if forward else list(reversed(g.nodes))
+    work = list(order)
+    queued = set(work)
+    while work:
+        n = work.pop(0)
+        queued.discard(n)
+        sources = n.preds if forward else n.succs
+        if n is not start:
+            flow_in[n] = meet([flow_out[s] for s in sources]) if sources else init
+        out = transfer(n, flow_in[n])
+        if out == flow_out[n]:
+            continue
+        flow_out[n] = out
+        for t in n.succs if forward else n.preds:
+            if t not in queued:
+                queued.add(t)
+                work.append(t)
+    if forward:
+        return Result(flow_in, flow_out)
+    return Result(flow_out, flow_in)
+
+
+def _union(values: List[FrozenSet]) -> FrozenSet:
+    return frozenset().union(*values)
+
+
+def _intersection(values: List[FrozenSet]) -> FrozenSet:
+    return frozenset.intersection(*values)
+
+
+# Slots that may be read before they are next written.
+def liveness(g: Graph) -> Result:
+    def transfer(n: Node, live: FrozenSet) -> FrozenSet:
+        return frozenset(n.uses) | (live - n.defs)
+
+    return solve(g, False, frozenset(), frozenset(), _union, transfer)
+
+
+# Definitions, as (slot, node index) pairs, that may reach each node.  The
+# entry node defines every parameter and local.
+def reaching(g: Graph) -> Result:
+    def transfer(n: Node, defs: FrozenSet) -> FrozenSet:
+        kept = frozenset(d for d in defs if d[0] not in n.defs)
+        return kept | frozenset((s, n.index) for s in n.defs)
+
+    return solve(g, True, frozenset(), frozenset(), _union, transfer)
+
+
+# Copies a = b, as (a, b) slot pairs, that hold on every path to each node.
+def copies(g: Graph) -> Result:
+    universe = frozenset(n.copy for n in g.nodes if n.copy is not None)
+
+    def transfer(n: Node, avail: FrozenSet) -> FrozenSet:
+        kept = frozenset(c for c in avail if c[0] not in n.defs and c[1] not in n.defs)
+        if n.copy is not None:
+            kept |= {n.copy}
+        return kept
+
+    return solve(g, True, frozenset(), universe, _intersection, transfer)
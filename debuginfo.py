@@ -0,0 +1,271 @@
+# Description: Out-of-line debug info for linked images
+#
+# The instructions themselves carry no source positions.  build() takes
+# the spans codegen.generate(ast, spans=...) recorded (and link() kept in
+# Image.spans) and the offsets offsets.py gave every symbol, and makes a
+# DebugInfo of
+#   - a line table from instruction index to (line, column), delta
+#     encoded: one entry per run of instructions with the same position,
+#     holding the run's length and the line and column change as
+#     zigzag varints (line 0 means no position), and
+#   - the frame layout of every function: its frame size and the FP
+#     offset of each parameter and local.
+#
+# The debug info lives in its own file next to the bytecode file,
+# sidecar(path) = path + ".dbg":
+#
+#   header    magic "TAUD", version, checksum of the code it describes,
+#             sizes of the two sections
+#   lines     the line table
+#   frames    per function: NUL-terminated name, frame size, parameter
+#             and local counts, then name and offset of each
+#
+# Nothing is read unless a debugger or profiler calls load() or
+# load_for(), and the line table is only decoded on the first lookup.
+# The checksum ties the file to one build; a mismatch is an error.
+# strip() removes the sidecar and the label names bytecode may carry.
+#
+# usage: python debuginfo.py dump|strip file
+
+import bisect
+import os
+import struct
+import sys
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from tau import asts
+import bytecode
+import insns
+from link import Image
+
+MAGIC = b"TAUD"
+VERSION = 1
+
+_header = struct.Struct("<4sHHIII")
+
+
+@dataclass
+class FrameLayout:
+    name: str
+    size: int  # from FP, as offsets.py computed it
+    params: List[Tuple[str, int]] = field(default_factory=list)  # (name, FP offset)
+    locals: List[Tuple[str, int]] = field(default_factory=list)
+
+
+class DebugInfo:
+    def __init__(self, checksum: int, lines: bytes, frames: Dict[str, FrameLayout]):
+        self.checksum = checksum
+        self.lines = lines
+        self.frames = frames
+        self._starts: Optional[List[int]] = None  # first instruction of each run
+        self._positions: List[Tuple[int, int]] = []
+
+    # The (line, column) instruction pc came from, or None.
+    def location(self, pc: int) -> Optional[Tuple[int, int]]:
+        if self._starts is None:
+            self._decode()
+        i = bisect.bisect_right(self._starts, pc) - 1
+        if i < 0 or self._positions[i][0] == 0:
+            return None
+        return self._positions[i]
+
+    def _decode(self):
+        self._starts = []
+        data = self.lines
+        i = pc = line = col = 0
+        while i < len(data):
+            (length, dline, dcol), i = _varints(data, i, 3)
+            line += _unzigzag(dline)
+            col += _unzigzag(dcol)
+            self._starts.append(pc)
+            self._positions.append((line, col))
+            pc += length
+
+
+def checksum(image: Image) -> int:
+    return zlib.crc32(bytecode.operands(image), zlib.crc32(bytes(image.ops)))
+
+
+def build(image: Image, ast: asts.Program) -> DebugInfo:
+    return DebugInfo(checksum(image), line_table(image.spans or [None] * len(image)), layouts(ast))
+
+
+# The encoded line table for the spans of an image's instructions.
+def line_table(spans: list) -> bytes:
+    positions = [(span.start.line, span.start.col) if span is not None else (0, 0) for span in spans]
+    lines = bytearray()
+    line = col = 0
+    i = 0
+    while i < len(positions):
+        j = i
+        while j < len(positions) and positions[j] == positions[i]:
+            j += 1
+        lines += _varint(j - i) + _varint(_zigzag(positions[i][0] - line)) + _varint(_zigzag(positions[i][1] - col))
+        line, col = positions[i]
+        i = j
+    return bytes(lines)
+
+
+def layouts(ast: asts.Program) -> Dict[str, FrameLayout]:
+    return {decl.id.token.value: _layout(decl) for decl in ast.decls}
+
+
+def _layout(decl: asts.FuncDecl) -> FrameLayout:
+    layout = FrameLayout(decl.id.token.value, decl.size)
+    layout.params = [(p.id.token.value, p.id.symbol.offset) for p in decl.params]
+    work = [decl.body]
+    while work:
+        s = work.pop()
+        match s:
+            case asts.CompoundStmt():
+                layout.locals += [(d.id.token.value, d.id.symbol.offset) for d in s.decls]
+                work += reversed(s.stmts)
+            case asts.IfStmt():
+                work += [s.elseStmt, s.thenStmt] if s.elseStmt is not None else [s.thenStmt]
+            case asts.WhileStmt():
+                work.append(s.stmt)
+    return layout
+
+
+def encode(info: DebugInfo) -> bytes:
+    frames = bytearray()
+    for f in info.frames.values():
+        frames += f.name.encode() + b"\0" + _varint(f.size) + _varint(len(f.params)) + _varint(len(f.locals))
+        for name, offset in f.params + f.locals:
+            frames += name.encode() + b"\0" + _varint(_zigzag(offset))
+    header = _header.pack(MAGIC, VERSION, 0, info.checksum, len(info.lines), len(frames))
+    return header + info.lines + bytes(frames)
+
+
+def decode(data: bytes) -> DebugInfo:
+    magic, version, _, check, nlines, nframes = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a tau debug info file")
+    if version != VERSION:
+        raise ValueError(f"unsupported debug info version {version}")
+    offset = _header.size
+    lines = bytes(data[offset:offset + nlines])
+    frames_data = bytes(data[offset + nlines:offset + nlines + nframes])
+    frames = {}
+    i = 0
+    while i < len(frames_data):
+        name, i = _name(frames_data, i)
+        (size, nparams, nlocals), i = _varints(frames_data, i, 3)
+        layout = FrameLayout(name, size)
+        for n in range(nparams + nlocals):
+            var, i = _name(frames_data, i)
+            (offset,), i = _varints(frames_data, i, 1)
+            (layout.params if n < nparams else layout.locals).append((var, _unzigzag(offset)))
+        frames[name] = layout
+    return DebugInfo(check, lines, frames)
+
+
+def sidecar(path: str) -> str:
+    return path + ".dbg"
+
+
+def write(path: str, info: DebugInfo):
+    with open(sidecar(path), "wb") as f:
+        f.write(encode(info))
+
+
+def load(path: str) -> DebugInfo:
+    with open(path, "rb") as f:
+        return decode(f.read())
+
+
+# The debug info of the bytecode file at path, checked against module,
+# or None if it has none.
+def load_for(path: str, module: bytecode.Module) -> Optional[DebugInfo]:
+    if not os.path.exists(sidecar(path)):
+        return None
+    info = load(sidecar(path))
+    if info.checksum != checksum(module.image()):
+        raise ValueError(f"{sidecar(path)} does not match {path}")
+    return info
+
+
+# Drops the sidecar and rewrites the bytecode file without label names.
+def strip(path: str):
+    if os.path.exists(sidecar(path)):
+        os.remove(sidecar(path))
+    # Read rather than mapped: the file is replaced below, which fails
+    # (or leaves a stale mapping) while a map of it is open.
+    with open(path, "rb") as f:
+        module = bytecode.loads(f.read())
+    if module.debug:
+        data = bytecode.encode_image(module.image(), debug=False)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n: int) -> int:
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _varints(data: bytes, i: int, count: int) -> Tuple[List[int], int]:
+    values = []
+    for _ in range(count):
+        n = shift = 0
+        while True:
+            b = data[i]
+            i += 1
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if b < 0x80:
+                break
+        values.append(n)
+    return values, i
+
+
+def _name(data: bytes, i: int) -> Tuple[str, int]:
+    end = data.index(b"\0", i)
+    return data[i:end].decode(), end + 1
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) != 2 or argv[0] not in ("dump", "strip"):
+        print("usage: python debuginfo.py dump|strip file", file=sys.stderr)
+        return 2
+    command, path = argv
+    if command == "strip":
+        strip(path)
+        return 0
+    module = bytecode.load(path)
+    info = load_for(path, module)
+    if info is None:
+        print(f"{path} has no debug info", file=sys.stderr)
+        return 1
+    for f in info.frames.values():
+        print(f"{f.name}: frame size {f.size}")
+        for name, offset in f.params:
+            print(f"  param {name} FP{offset:+d}")
+        for name, offset in f.locals:
+            print(f"  local {name} FP{offset:+d}")
+    for pc in range(len(module)):
+        insn = module[pc]
+        op = insns.name(insn)
+        text = f"{op} {insns.operand(insn)}" if op in insns.OPERANDS else op
+        where = info.location(pc)
+        print(f"{pc:6}  {text:<28} {'' if where is None else '%d:%d' % where}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,172 @@
+# Description: Differential testing of the backends
+#
+# Every program is compiled separately for each backend (the passes
+# change the AST in place) and what the backends print is compared with
+# the VM backend, i.e. codegen output run by the interpreter.  With
+# --stock the stock vm is compared too.  A <name>.expected file next to
+# a program is checked as well.  Without paths the programs under
+# benchmarks/ and regress/ are checked.
+#
+# usage: python difftest.py [--stock] [file-or-directory ...]
+
+import argparse
+import os
+import sys
+from typing import Callable, Dict, List, Tuple
+
+from tau.vm.vm import Insn
+import consteval
+import fuse
+import insns
+import interp
+import link
+import memo
+import offsets
+import passes
+import pipeline
+import pyback
+import regcodegen
+import regvm
+import schedule
+import stackdepth
+import tiered
+
+
+# Runs code on the interpreter once its eval-stack use has been verified.
+def _run(code: List[Insn], effects: Dict[str, Tuple[int, int]] = insns.EFFECTS) -> List[str]:
+    image = link.link(code)
+    stackdepth.annotate(image, stackdepth.analyze(code, effects))
+    return interp.run(image).output
+
+
+def _vm(source: str) -> List[str]:
+    return _run(pipeline.compile(source))
+
+
+def _fused(source: str) -> List[str]:
+    return _run(fuse.select(pipeline.compile(source)))
+
+
+def _lean(source: str) -> List[str]:
+    return _run(pipeline.compile(source, lean=True), insns.LEAN_EFFECTS)
+
+
+# A small table, so that evictions happen too.
+def _memoized(source: str) -> List[str]:
+    code = pipeline.compile(source, memo=True)
+    image = link.link(code)
+    stackdepth.annotate(image, stackdepth.analyze(code))
+    return interp.run(image, memo=memo.Memo(64)).output
+
+
+def _scheduled(source: str) -> List[str]:
+    ast = pipeline.front(source)
+    schedule.process(ast)
+    return _run(pipeline.back(ast))
+
+
+def _folded(source: str) -> List[str]:
+    ast = pipeline.front(source)
+    consteval.process(ast)
+    return _run(pipeline.back(ast))
+
+
+def _optimized(source: str) -> List[str]:
+    code, _ = passes.compile(pipeline.front(source), passes.LEVELS[2])
+    return _run(code)
+
+
+def _python(source: str) -> List[str]:
+    ast = pipeline.front(source)
+    offsets.process(ast)
+    return pyback.run(ast)
+
+
+def _register(source: str) -> List[str]:
+    ast = pipeline.front(source)
+    offsets.process(ast)
+    return regvm.run(regcodegen.generate(ast)).output
+
+
+# A low threshold, so that both tiers and the calls between them run.
+def _tiered(source: str) -> List[str]:
+    ast = pipeline.front(source)
+    offsets.process(ast)
+    return tiered.run(ast, threshold=5).output
+
+
+def _stock(source: str) -> List[str]:
+    return pipeline.run_stock(pipeline.compile(source))
+
+
+BACKENDS: Dict[str, Callable[[str], List[str]]] = {
+    "folded": _folded,
+    "fused": _fused,
+    "lean": _lean,
+    "memoized": _memoized,
+    "optimized": _optimized,
+    "python": _python,
+    "register": _register,
+    "scheduled": _scheduled,
+    "tiered": _tiered,
+}
+
+
+def _outcome(run: Callable[[str], List[str]], source: str) -> List[str]:
+    try:
+        return run(source)
+    except Exception as e:
+        return [f"error: {type(e).__name__}: {e}"]
+
+
+# Returns one line per backend that disagrees with the VM backend.
+def check(source: str, stock: bool = False) -> List[str]:
+    reference = _outcome(_vm, source)
+    backends = dict(BACKENDS)
+    if stock:
+        backends["stock"] = _stock
+    problems = []
+    for name, run in backends.items():
+        output = _outcome(run, source)
+        if output != reference:
+            problems.append(f"{name} printed {output}, vm printed {reference}")
+    return problems
+
+
+def programs(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in sorted(names) if n.endswith(".tau")]
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Compare the output of the Tau backends.")
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--stock", action="store_true", help="compare with the stock vm")
+    args = parser.parse_args(argv)
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = args.paths or [os.path.join(here, "benchmarks"), os.path.join(here, "regress")]
+    failed = 0
+    for path in programs(paths):
+        with open(path) as f:
+            source = f.read()
+        problems = check(source, args.stock)
+        expected = path[:-4] + ".expected"
+        if os.path.exists(expected):
+            with open(expected) as f:
+                if _outcome(_vm, source) != f.read().splitlines():
+                    problems.append(f"vm output differs from {expected}")
+        for problem in problems:
+            print(f"{path}: {problem}")
+        failed += bool(problems)
+    print(f"{failed} of {len(programs(paths))} programs differ")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+# Description: Superinstruction selection
+#
+# Rewrites codegen output (or cfg.optimize output) to use the fused
+# instructions defined in insns:
+#
+#   PushFP(k) Load                   -> LoadLocal(k)
+#   LoadLocal(k) Add / Sub / Mul     -> AddLocal(k) / SubLocal(k) / MulLocal(k)
+#   PushImmediate(n) Add / Sub       -> AddImmediate(n) / AddImmediate(-n)
+#   PushFP(k) ... Store              -> ... StoreLocal(k)
+#   <comparison> JumpIfNotZero(L)    -> JumpIf<comparison>(L)
+#   <comparison> JumpIfZero(L)       -> JumpIf<opposite comparison>(L)
+#
+# All but the Store rewrite are on adjacent instructions.  For that one
+# the eval stack is simulated with the index of the pushing instruction
+# in each slot, which tells which PushFP pushed the address a Store
+# pops.  A PushFP is dropped only if every instruction that can pop its
+# value is a Store taking it as the address.  Code generated with the
+# lean calling convention must be selected with insns.LEAN_EFFECTS.
+
+from typing import Dict, List, Optional, Set, Tuple
+
+from tau.vm.vm import Insn
+import insns
+
+_local_ops = {"Add": "AddLocal", "Sub": "SubLocal", "Mul": "MulLocal"}
+
+
+def select(code: List[Insn], effects: Dict[str, Tuple[int, int]] = insns.EFFECTS) -> List[Insn]:
+    stores = _fused_stores(code, effects)
+    addresses = {store: push for push, store in stores.items()}
+    out = []
+    i = 0
+    while i < len(code):
+        op = insns.name(code[i])
+        following = insns.name(code[i + 1]) if i + 1 < len(code) else None
+        if i in stores:
+            i += 1  # the address of a StoreLocal
+            continue
+        if i in addresses:
+            out.append(insns.make("StoreLocal", insns.operand(code[addresses[i]])))
+        elif op == "PushFP" and following == "Load":
+            k = insns.operand(code[i])
+            after = insns.name(code[i + 2]) if i + 2 < len(code) else None
+            if after in _local_ops:
+                out.append(insns.make(_local_ops[after], k))
+                i += 1
+            else:
+                out.append(insns.make("LoadLocal", k))
+            i += 1
+        elif op == "PushImmediate" and following in ("Add", "Sub"):
+            n = insns.operand(code[i])
+            out.append(insns.make("AddImmediate", n if following == "Add" else -n))
+            i += 1
+        elif op in insns.COMPARE_BRANCHES and following in ("JumpIfZero", "JumpIfNotZero"):
+            branch = insns.COMPARE_BRANCHES[op]
+            if following == "JumpIfZero":
+                branch = insns.INVERSE[branch]
+            out.append(insns.make(branch, insns.operand(code[i + 1])))
+            i += 1
+        else:
+            out.append(code[i])
+        i += 1
+    return out
+
+
+# Returns {index of PushFP: index of the Store that pops it}.
+def _fused_stores(code: List[Insn], effects: Dict[str, Tuple[int, int]]) -> Dict[int, int]:
+    labels = {insns.operand(insn): i for i, insn in enumerate(code) if insns.name(insn) == "Label"}
+    # Loop heads are not followed: whatever is on the stack there is given up.
+    backward = {
+        insns.operand(insn)
+        for i, insn in enumerate(code)
+        if insns.name(insn) in insns.JUMPS and labels.get(insns.operand(insn), i + 1) <= i
+    }
+    consumers: Dict[int, List[Tuple[int, int]]] = {}  # push -> [(popper, depth)]
+    escaped: Set[int] = set()  # pushes whose value may be popped where we cannot see
+    incoming: Dict[str, List[List[Optional[int]]]] = {}
+    stack: Optional[List[Optional[int]]] = []
+    for i, insn in enumerate(code):
+        op = insns.name(insn)
+        if op == "Label":
+            states = incoming.get(insns.operand(insn), [])
+            if stack is not None:
+                states.append(stack)
+            if insns.operand(insn) in backward:
+                for s in states:
+                    escaped.update(p for p in s if p is not None)
+                states = []
+            stack = _merge(states, escaped)
+            continue
+        if stack is None:
+            stack = []
+        if op not in effects:
+            escaped.update(p for p in stack if p is not None)
+            stack = []
+            continue
+        pops, pushes = effects[op]
+        for depth in range(pops):
+            push = stack.pop() if stack else None
+            if push is not None:
+                consumers.setdefault(push, []).append((i, depth))
+        # Swap's results are not tracked.
+        stack += [i if pushes == 1 else None] * pushes
+        if op in insns.JUMPS:
+            label = insns.operand(insn)
+            if label in backward or label not in labels:
+                escaped.update(p for p in stack if p is not None)
+            else:
+                incoming.setdefault(label, []).append(list(stack))
+        if op in insns.ENDS:
+            escaped.update(p for p in stack if p is not None)
+            stack = None
+    fused = {}
+    for push, pops in consumers.items():
+        if insns.name(code[push]) != "PushFP" or push in escaped or len(pops) != 1:
+            continue
+        (store, depth), = pops
+        if insns.name(code[store]) == "Store" and depth == 1:
+            fused[push] = store
+    return fused
+
+
+# The stack at a join: a slot keeps its pusher only if all paths agree.
+def _merge(states: List[List[Optional[int]]], escaped: Set[int]) -> List[Optional[int]]:
+    if not states:
+        return []
+    if any(len(s) != len(states[0]) for s in states):
+        for s in states:
+            escaped.update(p for p in s if p is not None)
+        return []
+    merged = []
+    for slots in zip(*states):
+        if all(p == slots[0] for p in slots):
+            merged.append(slots[0])
+        else:
+            escaped.update(p for p in slots if p is not None)
+            merged.append(None)
+    return merged
@@ -0,0 +1,294 @@
+# Description: Helpers for inspecting the vm instructions codegen emits
+#
+# Instructions are identified by their class name.  Every instruction
+# that takes an operand (a label name, an offset or an immediate) stores
+# its single constructor argument as its only attribute.
+#
+# OPCODES fixes a number for every instruction; it is the numbering used
+# by linked images and the bytecode format, so only append to it.
+#
+# Besides the vm's own instructions there are superinstructions, fused
+# forms of sequences codegen emits often.  fuse.select() introduces them
+# and interp runs them; the stock vm does not know them.  The same goes
+# for MemoCall and MemoSave, which codegen emits for memoized calls (see
+# memo.py).
+
+from typing import Optional, Union
+
+from tau.vm.vm import (
+    Add,
+    Call,
+    Div,
+    Equal,
+    GreaterThan,
+    GreaterThanEqual,
+    Halt,
+    Insn,
+    Jump,
+    JumpIfNotZero,
+    JumpIfZero,
+    JumpIndirect,
+    Label,
+    LessThan,
+    LessThanEqual,
+    Load,
+    Mul,
+    Negate,
+    Noop,
+    Not,
+    NotEqual,
+    Pop,
+    PopFP,
+    PopSP,
+    Print,
+    PushFP,
+    PushImmediate,
+    PushLabel,
+    PushSP,
+    RestoreEvalStack,
+    SaveEvalStack,
+    Store,
+    Sub,
+    Swap,
+)
+
+
+class LoadLocal(Insn):  # PushFP(offset) Load
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+class StoreLocal(Insn):  # PushFP(offset) before the value, Store after it
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+class AddImmediate(Insn):  # PushImmediate(value) Add
+    def __init__(self, value: int):
+        self.value = value
+
+
+class AddLocal(Insn):  # LoadLocal(offset) Add
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+class SubLocal(Insn):  # LoadLocal(offset) Sub
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+class MulLocal(Insn):  # LoadLocal(offset) Mul
+    def __init__(self, offset: int):
+        self.offset = offset
+
+
+# Compare-and-branch: pops both operands, jumps if the comparison holds.
+class JumpIfEqual(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class JumpIfNotEqual(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class JumpIfLessThan(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class JumpIfLessThanEqual(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class JumpIfGreaterThan(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class JumpIfGreaterThanEqual(Insn):
+    def __init__(self, label: str):
+        self.label = label
+
+
+class MemoCall(Insn):  # PushImmediate(argument count) PushLabel(f) before it
+    pass
+
+
+class MemoSave(Insn):  # right after a MemoCall, skipped on a hit
+    pass
+
+
+# Comparison operator -> its compare-and-branch form.
+COMPARE_BRANCHES = {
+    "Equal": "JumpIfEqual",
+    "NotEqual": "JumpIfNotEqual",
+    "LessThan": "JumpIfLessThan",
+    "LessThanEqual": "JumpIfLessThanEqual",
+    "GreaterThan": "JumpIfGreaterThan",
+    "GreaterThanEqual": "JumpIfGreaterThanEqual",
+}
+
+# Instructions that transfer control to a label.
+BRANCHES = {"JumpIfZero", "JumpIfNotZero"} | set(COMPARE_BRANCHES.values())
+JUMPS = {"Jump"} | BRANCHES
+
+# Instructions that never fall through to the next one.
+ENDS = {"Jump", "JumpIndirect", "Halt"}
+
+# Instructions whose operand names a label.
+LABELLED = {"Label", "PushLabel"} | JUMPS
+
+# Instructions that take an operand at all.
+OPERANDS = {
+    "PushImmediate",
+    "PushFP",
+    "PushSP",
+    "LoadLocal",
+    "StoreLocal",
+    "AddImmediate",
+    "AddLocal",
+    "SubLocal",
+    "MulLocal",
+} | LABELLED
+
+# The branch that is taken exactly when the given one is not.
+INVERSE = {
+    "JumpIfZero": "JumpIfNotZero",
+    "JumpIfNotZero": "JumpIfZero",
+    "JumpIfEqual": "JumpIfNotEqual",
+    "JumpIfNotEqual": "JumpIfEqual",
+    "JumpIfLessThan": "JumpIfGreaterThanEqual",
+    "JumpIfGreaterThanEqual": "JumpIfLessThan",
+    "JumpIfLessThanEqual": "JumpIfGreaterThan",
+    "JumpIfGreaterThan": "JumpIfLessThanEqual",
+}
+
+# (values popped, values pushed) on the eval stack, as seen by the
+# function executing the instruction: a Call's return address is popped
+# again by the callee, so Call just consumes the callee's address.
+# SaveEvalStack and RestoreEvalStack are not modelled.  LEAN_EFFECTS is
+# the same for code generated with codegen's lean calling convention,
+# where a call leaves its result on the stack.
+EFFECTS = {
+    "Halt": (0, 0),
+    "Noop": (0, 0),
+    "Label": (0, 0),
+    "PushImmediate": (0, 1),
+    "PushLabel": (0, 1),
+    "PushFP": (0, 1),
+    "PushSP": (0, 1),
+    "PopFP": (1, 0),
+    "PopSP": (1, 0),
+    "Load": (1, 1),
+    "Store": (2, 0),
+    "Pop": (1, 0),
+    "Swap": (2, 2),
+    "Add": (2, 1),
+    "Sub": (2, 1),
+    "Mul": (2, 1),
+    "Div": (2, 1),
+    "Negate": (1, 1),
+    "Not": (1, 1),
+    "Equal": (2, 1),
+    "NotEqual": (2, 1),
+    "LessThan": (2, 1),
+    "LessThanEqual": (2, 1),
+    "GreaterThan": (2, 1),
+    "GreaterThanEqual": (2, 1),
+    "Jump": (0, 0),
+    "JumpIfZero": (1, 0),
+    "JumpIfNotZero": (1, 0),
+    "JumpIndirect": (1, 0),
+    "Call": (1, 0),
+    "Print": (1, 0),
+    "LoadLocal": (0, 1),
+    "StoreLocal": (1, 0),
+    "AddImmediate": (1, 1),
+    "AddLocal": (1, 1),
+    "SubLocal": (1, 1),
+    "MulLocal": (1, 1),
+    "JumpIfEqual": (2, 0),
+    "JumpIfNotEqual": (2, 0),
+    "JumpIfLessThan": (2, 0),
+    "JumpIfLessThanEqual": (2, 0),
+    "JumpIfGreaterThan": (2, 0),
+    "JumpIfGreaterThanEqual": (2, 0),
+    "MemoCall": (2, 0),
+    "MemoSave": (0, 0),
+}
+LEAN_EFFECTS = {**EFFECTS, "Call": (1, 1)}
+
+CLASSES = {
+    cls.__name__: cls
+    for cls in [
+        Halt,
+        Noop,
+        Label,
+        PushImmediate,
+        PushLabel,
+        PushFP,
+        PushSP,
+        PopFP,
+        PopSP,
+        Load,
+        Store,
+        Pop,
+        Swap,
+        Add,
+        Sub,
+        Mul,
+        Div,
+        Negate,
+        Not,
+        Equal,
+        NotEqual,
+        LessThan,
+        LessThanEqual,
+        GreaterThan,
+        GreaterThanEqual,
+        Jump,
+        JumpIfZero,
+        JumpIfNotZero,
+        JumpIndirect,
+        Call,
+        Print,
+        SaveEvalStack,
+        RestoreEvalStack,
+        LoadLocal,
+        StoreLocal,
+        AddImmediate,
+        AddLocal,
+        SubLocal,
+        MulLocal,
+        JumpIfEqual,
+        JumpIfNotEqual,
+        JumpIfLessThan,
+        JumpIfLessThanEqual,
+        JumpIfGreaterThan,
+        JumpIfGreaterThanEqual,
+        MemoCall,
+        MemoSave,
+    ]
+}
+
+OPCODES = list(CLASSES)
+OPCODE = {op: i for i, op in enumerate(OPCODES)}
+
+
+def name(insn: Insn) -> str:
+    return type(insn).__name__
+
+
+def operand(insn: Insn) -> Union[int, str]:
+    (value,) = vars(insn).values()
+    return value
+
+
+def make(op: str, arg: Optional[Union[int, str]] = None) -> Insn:
+    if op in OPERANDS:
+        return CLASSES[op](arg)
+    return CLASSES[op]()
@@ -0,0 +1,256 @@
+# Description: Per-phase compiler instrumentation
+#
+# pipeline wraps each compiler phase in `with instrument.phase(name) as
+# p:` and hands what the phase produced to p.result().  Unless a
+# recording is active, phase() returns one shared context manager that
+# does nothing, so a disabled build pays a global lookup and two calls
+# per phase.  Within
+#
+#   with instrument.recording() as rec:
+#       pipeline.compile(source)
+#
+# every phase gets a Phase with its wall and CPU time, the peak of the
+# memory tracemalloc saw allocated during it (above what was allocated
+# when it started), and the number of AST nodes or instructions it
+# produced.  Phases may nest; an outer phase's peak includes its inner
+# ones'.
+#
+# The scanner has no phase of its own: the parser pulls tokens from it
+# as it goes.  scanner() wraps it so that the time spent in its peek()
+# and consume() is summed into a "scan" Phase inside "parse", along with
+# the number of tokens consumed.  The memory figures are not split that
+# way, scan's CPU time is its wall time, and in the trace it shows up as
+# one span of its summed time at the start of parse.
+#
+# rec.report() formats the phases as a table, rec.to_json() as plain
+# data, and rec.trace() as Chrome trace events (chrome://tracing,
+# Perfetto).
+#
+# usage: python instrument.py [--trace FILE] [--json] [--no-memory] file.tau
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List, Optional
+
+from tau import asts
+
+
+@dataclass
+class Phase:
+    name: str
+    start: float  # seconds since the recording started
+    wall: float = 0.0
+    cpu: float = 0.0
+    peak: Optional[int] = None  # bytes, None without tracemalloc
+    nodes: Optional[int] = None  # AST nodes after the phase
+    tokens: Optional[int] = None  # tokens scanned
+    insns: Optional[int] = None  # instructions it produced
+    parent: Optional[str] = None
+
+    # Counted once the phase's time has been taken.
+    def result(self, value):
+        self._result = value
+
+    def _count(self):
+        value = self.__dict__.pop("_result", None)
+        if isinstance(value, asts.Program):
+            self.nodes = count_nodes(value)
+        elif isinstance(value, list):
+            self.insns = len(value)
+
+
+class _Off:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def result(self, value):
+        pass
+
+
+_OFF = _Off()
+_recorder: Optional["Recorder"] = None
+
+
+class Recorder:
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.phases: List[Phase] = []
+        self.origin = time.perf_counter()
+        self._open: List[Phase] = []
+        self._base: Dict[int, int] = {}  # id(phase) -> memory at its start
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Phase]:
+        p = Phase(name, time.perf_counter() - self.origin, parent=self._open[-1].name if self._open else None)
+        self.phases.append(p)
+        if self.memory:
+            self._fold_peak()
+            tracemalloc.reset_peak()
+            self._base[id(p)] = tracemalloc.get_traced_memory()[0]
+            p.peak = 0
+        self._open.append(p)
+        cpu = time.process_time()
+        try:
+            yield p
+        finally:
+            p.cpu = time.process_time() - cpu
+            p.wall = time.perf_counter() - self.origin - p.start
+            if self.memory:
+                self._fold_peak()
+                del self._base[id(p)]
+            self._open.pop()
+            p._count()
+
+    # Raises the peak of every open phase to what tracemalloc has seen.
+    def _fold_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for p in self._open:
+            p.peak = max(p.peak, peak - self._base[id(p)])
+
+    def report(self) -> str:
+        lines = [f"{'phase':<16} {'wall ms':>9} {'cpu ms':>9} {'peak KiB':>9} {'tokens':>7} {'nodes':>7} {'insns':>7}"]
+        for p in self.phases:
+            name = ("  " if p.parent else "") + p.name
+            peak = "-" if p.peak is None else f"{p.peak / 1024:.1f}"
+            counts = ["-" if n is None else n for n in (p.tokens, p.nodes, p.insns)]
+            lines.append(f"{name:<16} {p.wall * 1e3:>9.3f} {p.cpu * 1e3:>9.3f} {peak:>9} " + " ".join(f"{n:>7}" for n in counts))
+        total = sum(p.wall for p in self.phases if p.parent is None)
+        lines.append(f"{'total':<16} {total * 1e3:>9.3f}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> List[dict]:
+        return [asdict(p) for p in self.phases]
+
+    # Chrome trace-event format: one complete ("X") event per phase, in
+    # microseconds.  Nested phases share the thread of their parent.
+    def trace(self) -> dict:
+        events = []
+        for p in self.phases:
+            fields = {"cpu_ms": p.cpu * 1e3, "peak_bytes": p.peak, "tokens": p.tokens, "nodes": p.nodes, "insns": p.insns}
+            events.append(
+                {
+                    "name": p.name,
+                    "cat": "compile",
+                    "ph": "X",
+                    "ts": p.start * 1e6,
+                    "dur": p.wall * 1e6,
+                    "pid": os.getpid(),
+                    "tid": 0,
+                    "args": {k: v for k, v in fields.items() if v is not None},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
+
+
+def phase(name: str):
+    if _recorder is None:
+        return _OFF
+    return _recorder.phase(name)
+
+
+@contextmanager
+def recording(memory: bool = True) -> Iterator[Recorder]:
+    global _recorder
+    outer = _recorder
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _recorder = Recorder(memory)
+    try:
+        yield _recorder
+    finally:
+        _recorder = outer
+        if started:
+            tracemalloc.stop()
+
+
+class _TimedScanner:
+    def __init__(self, scanner, p: Phase):
+        self.scanner = scanner
+        self.p = p
+        p.tokens = 0
+
+    def peek(self):
+        start = time.perf_counter()
+        token = self.scanner.peek()
+        self._add(time.perf_counter() - start)
+        return token
+
+    def consume(self):
+        start = time.perf_counter()
+        token = self.scanner.consume()
+        self._add(time.perf_counter() - start)
+        self.p.tokens += 1
+        return token
+
+    def _add(self, seconds: float):
+        self.p.wall += seconds
+        self.p.cpu += seconds
+
+    def __getattr__(self, attr):
+        return getattr(self.scanner, attr)
+
+
+# The scanner itself, or one that sums its time into a "scan" Phase of
+# the current recording.
+def scanner(s):
+    if _recorder is None:
+        return s
+    parent = _recorder._open[-1] if _recorder._open else None
+    p = Phase("scan", time.perf_counter() - _recorder.origin, parent=parent.name if parent else None)
+    _recorder.phases.append(p)
+    return _TimedScanner(s, p)
+
+
+def count_nodes(ast) -> int:
+    seen = set()
+    work = [ast]
+    while work:
+        node = work.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for value in vars(node).values():
+            for v in value if isinstance(value, list) else [value]:
+                if type(v).__module__ == asts.__name__:
+                    work.append(v)
+    return len(seen)
+
+
+def main(argv: List[str]) -> int:
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Time the compiler phases on a Tau program.")
+    parser.add_argument("file")
+    parser.add_argument("--trace", metavar="FILE", help="write Chrome trace events to FILE")
+    parser.add_argument("--json", action="store_true", help="print the phases as JSON")
+    parser.add_argument("--no-memory", action="store_true", help="do not trace allocations")
+    args = parser.parse_args(argv)
+    with open(args.file) as f:
+        source = f.read()
+    with recording(not args.no_memory) as rec:
+        pipeline.compile(source)
+    if args.json:
+        print(json.dumps(rec.to_json(), indent=2))
+    else:
+        print(rec.report(), end="")
+    if args.trace:
+        rec.write_trace(args.trace)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
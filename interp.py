@@ -0,0 +1,354 @@
+# Description: Array-backed interpreter for linked images
+#
+# Runs a link.Image (or the image of a bytecode.Module) without building
+# an object per instruction.  Opcodes and operands are read from flat
+# arrays, jump operands are already absolute, and the eval stack and the
+# frame memory are preallocated lists indexed by integer registers.
+#
+# The machine model is the one codegen targets: Call pops the callee's
+# address and pushes the return address, Store pops the value and then
+# the address, binary operators pop the right operand first.
+# Comparisons and Not push 1 or 0, and Div floors like Python's //.
+# Printed values are collected and returned rather than written as they
+# are produced.  The superinstructions fuse.select() introduces are run
+# too, and so are memoized calls, against the Memo table passed in (a
+# fresh one by default) that the Result then carries.
+#
+# run() is a Machine executed from the start.  A Machine can be given
+# Hooks that see calls, returns, taken jumps and frame changes as they
+# happen, which is how the tiered runner counts and redirects calls and
+# the profiler counts instructions without loops of their own; without
+# hooks, the only cost is a test on those instructions.
+#
+# The eval stack is allocated once.  Its size is the image's stack, as
+# computed by stackdepth, when that is known, and STACK otherwise; the
+# loop itself never checks or grows it.
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import insns
+from link import Image
+from memo import Memo
+
+MEMORY = 1 << 20
+STACK = 1 << 16
+
+HALT = insns.OPCODE["Halt"]
+NOOP = insns.OPCODE["Noop"]
+LABEL = insns.OPCODE["Label"]
+PUSHIMMEDIATE = insns.OPCODE["PushImmediate"]
+PUSHLABEL = insns.OPCODE["PushLabel"]
+PUSHFP = insns.OPCODE["PushFP"]
+PUSHSP = insns.OPCODE["PushSP"]
+POPFP = insns.OPCODE["PopFP"]
+POPSP = insns.OPCODE["PopSP"]
+LOAD = insns.OPCODE["Load"]
+STORE = insns.OPCODE["Store"]
+POP = insns.OPCODE["Pop"]
+SWAP = insns.OPCODE["Swap"]
+ADD = insns.OPCODE["Add"]
+SUB = insns.OPCODE["Sub"]
+MUL = insns.OPCODE["Mul"]
+DIV = insns.OPCODE["Div"]
+NEGATE = insns.OPCODE["Negate"]
+NOT = insns.OPCODE["Not"]
+EQUAL = insns.OPCODE["Equal"]
+NOTEQUAL = insns.OPCODE["NotEqual"]
+LESSTHAN = insns.OPCODE["LessThan"]
+LESSTHANEQUAL = insns.OPCODE["LessThanEqual"]
+GREATERTHAN = insns.OPCODE["GreaterThan"]
+GREATERTHANEQUAL = insns.OPCODE["GreaterThanEqual"]
+JUMP = insns.OPCODE["Jump"]
+JUMPIFZERO = insns.OPCODE["JumpIfZero"]
+JUMPIFNOTZERO = insns.OPCODE["JumpIfNotZero"]
+JUMPINDIRECT = insns.OPCODE["JumpIndirect"]
+CALL = insns.OPCODE["Call"]
+PRINT = insns.OPCODE["Print"]
+SAVEEVALSTACK = insns.OPCODE["SaveEvalStack"]
+RESTOREEVALSTACK = insns.OPCODE["RestoreEvalStack"]
+LOADLOCAL = insns.OPCODE["LoadLocal"]
+STORELOCAL = insns.OPCODE["StoreLocal"]
+ADDIMMEDIATE = insns.OPCODE["AddImmediate"]
+ADDLOCAL = insns.OPCODE["AddLocal"]
+SUBLOCAL = insns.OPCODE["SubLocal"]
+MULLOCAL = insns.OPCODE["MulLocal"]
+JUMPIFEQUAL = insns.OPCODE["JumpIfEqual"]
+JUMPIFNOTEQUAL = insns.OPCODE["JumpIfNotEqual"]
+JUMPIFLESSTHAN = insns.OPCODE["JumpIfLessThan"]
+JUMPIFLESSTHANEQUAL = insns.OPCODE["JumpIfLessThanEqual"]
+JUMPIFGREATERTHAN = insns.OPCODE["JumpIfGreaterThan"]
+JUMPIFGREATERTHANEQUAL = insns.OPCODE["JumpIfGreaterThanEqual"]
+MEMOCALL = insns.OPCODE["MemoCall"]
+MEMOSAVE = insns.OPCODE["MemoSave"]
+
+
+@dataclass
+class Result:
+    output: List[str] = field(default_factory=list)
+    steps: int = 0  # instructions executed
+    memo: Optional[Memo] = None
+
+
+class MachineError(Exception):
+    pass
+
+
+class Hooks:
+    """Events of a run, for callers that count or redirect what runs.
+
+    call() sees a Call at pc to target before it is made and returns True
+    if it has made the call itself, leaving the machine as the call and
+    its return would have; the machine's registers are up to date while
+    it runs and are read back afterwards.  It is also told of a MemoCall
+    that misses the table, which the machine makes itself whatever call()
+    returns, and without updating the registers first.  jump() sees
+    every taken jump or branch, and the instruction a MemoCall that hits
+    skips.  ret() sees a JumpIndirect, and frame() every new SP.  Between
+    them, the events give every place control does not fall through.
+    """
+
+    def call(self, pc: int, target: int, steps: int) -> bool:
+        return False
+
+    def jump(self, pc: int, target: int, steps: int):
+        pass
+
+    def ret(self, pc: int, target: int, steps: int):
+        pass
+
+    def frame(self, sp: int):
+        pass
+
+
+class Machine:
+    def __init__(
+        self,
+        image: Image,
+        memory: int = MEMORY,
+        stack: Optional[int] = None,
+        memo: Optional[Memo] = None,
+        hooks: Optional[Hooks] = None,
+    ):
+        self.table = memo if memo is not None else Memo()
+        self.pending = []  # keys of the memoized calls still running
+        self.ops = list(image.ops)
+        self.args = list(image.args)
+        self.mem = [0] * memory
+        self.st = [0] * (stack or image.stack or STACK)
+        self.out = []
+        self.top = -1
+        self.sp = self.fp = 0
+        self.pc = 0
+        self.steps = 0
+        self.hooks = hooks
+
+    # Runs from pc until Halt, or until a return to a negative address,
+    # which lets a caller run one function of the program on its own.
+    def execute(self, pc: int = 0):
+        table = self.table
+        pending = self.pending
+        ops = self.ops
+        args = self.args
+        mem = self.mem
+        st = self.st
+        out = self.out
+        hooks = self.hooks
+        top, sp, fp = self.top, self.sp, self.fp
+        steps = self.steps
+        try:
+            while True:
+                op = ops[pc]
+                arg = args[pc]
+                pc += 1
+                steps += 1
+                if op == LOADLOCAL:
+                    top += 1
+                    st[top] = mem[fp + arg]
+                elif op == PUSHFP:
+                    top += 1
+                    st[top] = fp + arg
+                elif op == LOAD:
+                    st[top] = mem[st[top]]
+                elif op == STORE:
+                    mem[st[top - 1]] = st[top]
+                    top -= 2
+                elif op == PUSHIMMEDIATE:
+                    top += 1
+                    st[top] = arg
+                elif op == STORELOCAL:
+                    mem[fp + arg] = st[top]
+                    top -= 1
+                elif op == ADDIMMEDIATE:
+                    st[top] += arg
+                elif op == JUMPIFLESSTHAN:
+                    top -= 2
+                    if st[top + 1] < st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == JUMPIFGREATERTHANEQUAL:
+                    top -= 2
+                    if st[top + 1] >= st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == ADDLOCAL:
+                    st[top] += mem[fp + arg]
+                elif op == SUBLOCAL:
+                    st[top] -= mem[fp + arg]
+                elif op == MULLOCAL:
+                    st[top] *= mem[fp + arg]
+                elif op == PUSHSP:
+                    top += 1
+                    st[top] = sp + arg
+                elif op == JUMPIFZERO:
+                    if st[top] == 0:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                    top -= 1
+                elif op == JUMP:
+                    if hooks is not None:
+                        hooks.jump(pc - 1, arg, steps)
+                    pc = arg
+                elif op == JUMPIFGREATERTHAN:
+                    top -= 2
+                    if st[top + 1] > st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == JUMPIFLESSTHANEQUAL:
+                    top -= 2
+                    if st[top + 1] <= st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == JUMPIFEQUAL:
+                    top -= 2
+                    if st[top + 1] == st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == JUMPIFNOTEQUAL:
+                    top -= 2
+                    if st[top + 1] != st[top + 2]:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                elif op == ADD:
+                    top -= 1
+                    st[top] += st[top + 1]
+                elif op == SUB:
+                    top -= 1
+                    st[top] -= st[top + 1]
+                elif op == LESSTHAN:
+                    top -= 1
+                    st[top] = 1 if st[top] < st[top + 1] else 0
+                elif op == POPSP:
+                    sp = st[top]
+                    top -= 1
+                    if hooks is not None:
+                        hooks.frame(sp)
+                elif op == POPFP:
+                    fp = st[top]
+                    top -= 1
+                elif op == JUMPIFNOTZERO:
+                    if st[top] != 0:
+                        if hooks is not None:
+                            hooks.jump(pc - 1, arg, steps)
+                        pc = arg
+                    top -= 1
+                elif op == MUL:
+                    top -= 1
+                    st[top] *= st[top + 1]
+                elif op == DIV:
+                    top -= 1
+                    st[top] //= st[top + 1]
+                elif op == LESSTHANEQUAL:
+                    top -= 1
+                    st[top] = 1 if st[top] <= st[top + 1] else 0
+                elif op == GREATERTHAN:
+                    top -= 1
+                    st[top] = 1 if st[top] > st[top + 1] else 0
+                elif op == GREATERTHANEQUAL:
+                    top -= 1
+                    st[top] = 1 if st[top] >= st[top + 1] else 0
+                elif op == EQUAL:
+                    top -= 1
+                    st[top] = 1 if st[top] == st[top + 1] else 0
+                elif op == NOTEQUAL:
+                    top -= 1
+                    st[top] = 1 if st[top] != st[top + 1] else 0
+                elif op == CALL:
+                    target = st[top]
+                    if hooks is not None:
+                        self.top, self.sp, self.fp, self.steps = top, sp, fp, steps
+                        made = hooks.call(pc - 1, target, steps)
+                        top, sp, fp, steps = self.top, self.sp, self.fp, self.steps
+                        if made:
+                            continue
+                    st[top] = pc
+                    pc = target
+                elif op == MEMOCALL:
+                    # The arguments are in their slots below the return slot.
+                    key = (st[top], *mem[sp - 1 - st[top - 1] : sp - 1])
+                    value = table.lookup(key)
+                    if value is None:
+                        pending.append(key)
+                        target = st[top]
+                        if hooks is not None:
+                            hooks.call(pc - 1, target, steps)
+                        top -= 1
+                        st[top] = pc
+                        pc = target
+                    else:
+                        mem[sp - 1] = value
+                        top -= 2
+                        if hooks is not None:
+                            hooks.jump(pc - 1, pc + 1, steps)
+                        pc += 1
+                elif op == MEMOSAVE:
+                    table.store(pending.pop(), mem[sp - 1])
+                elif op == JUMPINDIRECT:
+                    if hooks is not None:
+                        hooks.ret(pc - 1, st[top], steps)
+                    pc = st[top]
+                    top -= 1
+                    if pc < 0:
+                        break
+                elif op == PUSHLABEL:
+                    top += 1
+                    st[top] = arg
+                elif op == SWAP:
+                    st[top], st[top - 1] = st[top - 1], st[top]
+                elif op == POP:
+                    top -= 1
+                elif op == NEGATE:
+                    st[top] = -st[top]
+                elif op == NOT:
+                    st[top] = 1 if st[top] == 0 else 0
+                elif op == PRINT:
+                    out.append(str(st[top]))
+                    top -= 1
+                elif op == HALT:
+                    break
+                elif op == NOOP or op == LABEL:
+                    pass
+                else:
+                    raise MachineError(f"{insns.OPCODES[op]} is not supported")
+        except IndexError:
+            raise MachineError(f"stack or memory exhausted at instruction {pc - 1}")
+        finally:
+            self.top, self.sp, self.fp = top, sp, fp
+            self.pc = pc
+            self.steps = steps
+
+    def result(self) -> Result:
+        return Result(self.out, self.steps, self.table)
+
+
+def run(image: Image, memory: int = MEMORY, stack: Optional[int] = None, memo: Optional[Memo] = None) -> Result:
+    machine = Machine(image, memory, stack, memo)
+    machine.execute()
+    return machine.result()
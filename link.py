@@ -0,0 +1,103 @@
+# Description: Link step run after codegen.generate
+#
+# Codegen names labels after id() of AST nodes, so the same source gives
+# different code on every run.  link() drops the Label pseudo
+# instructions, numbers labels in the order they are defined, and
+# rewrites every Jump, JumpIfZero, JumpIfNotZero and PushLabel operand to
+# the absolute index of the instruction the label stood in front of.
+# The result only depends on the instruction stream, not on label names.
+#
+# Labels pushed by PushLabel are function entry points; they keep their
+# names, everything else is called L<number>.
+#
+# Given the spans codegen.generate(ast, spans=...) recorded, one per
+# instruction, link() keeps those of the instructions it keeps.
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from tau.vm.vm import Insn
+import insns
+
+
+@dataclass
+class Image:
+    ops: List[int] = field(default_factory=list)  # opcode of each instruction
+    args: List[int] = field(default_factory=list)  # its operand, 0 if it has none
+    labels: List[int] = field(default_factory=list)  # label number -> instruction index
+    names: List[str] = field(default_factory=list)  # label number -> label name
+    entries: Dict[str, int] = field(default_factory=dict)  # function name -> label number
+    # Filled in by stackdepth.annotate(): function name -> maximum eval-stack
+    # depth, and the eval stack the whole program needs (0 if unknown).
+    depths: Dict[str, int] = field(default_factory=dict)
+    stack: int = 0
+    spans: List[object] = field(default_factory=list)  # Span (or None) of each instruction, if known
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def address(self, name: str) -> int:
+        return self.labels[self.entries[name]]
+
+
+def link(code: List[Insn], spans: Optional[list] = None) -> Image:
+    image = Image()
+    number: Dict[str, int] = {}
+    pushed = set()
+    for i, insn in enumerate(code):
+        op = insns.name(insn)
+        if op == "Label":
+            number[insns.operand(insn)] = len(image.labels)
+            image.labels.append(len(image.ops))
+            continue
+        if op == "PushLabel":
+            pushed.add(insns.operand(insn))
+        if spans is not None:
+            image.spans.append(spans[i])
+        image.ops.append(insns.OPCODE[op])
+        image.args.append(insns.operand(insn) if op in insns.OPERANDS else 0)
+    for label, n in number.items():
+        if label in pushed:
+            image.names.append(label)
+            image.entries[label] = n
+        else:
+            image.names.append(f"L{n}")
+    labelled = {insns.OPCODE[op] for op in insns.LABELLED}
+    for i, op in enumerate(image.ops):
+        if op in labelled:
+            image.args[i] = image.labels[number[image.args[i]]]
+    return image
+
+
+# Rebuild a List[Insn] with the deterministic label names, for the stock
+# vm and anything else that works on instruction objects.
+def unlink(image: Image) -> List[Insn]:
+    at: Dict[int, List[str]] = {}
+    for n, index in enumerate(image.labels):
+        at.setdefault(index, []).append(image.names[n])
+    first = {index: names[0] for index, names in at.items()}
+    labelled = {insns.OPCODE[op] for op in insns.LABELLED}
+    code = []
+    for i, (op, arg) in enumerate(zip(image.ops, image.args)):
+        for name in at.get(i, []):
+            code.append(insns.make("Label", name))
+        if op in labelled:
+            arg = first[arg]
+        code.append(insns.make(insns.OPCODES[op], arg))
+    for name in at.get(len(image.ops), []):
+        code.append(insns.make("Label", name))
+    return code
+
+
+# One instruction per line, with jump targets as absolute indices.
+def dump(image: Image) -> str:
+    at: Dict[int, List[str]] = {}
+    for n, index in enumerate(image.labels):
+        at.setdefault(index, []).append(image.names[n])
+    lines = []
+    for i, (op, arg) in enumerate(zip(image.ops, image.args)):
+        for name in at.get(i, []):
+            lines.append(f"{name}:")
+        op = insns.OPCODES[op]
+        lines.append(f"{i:6}  {op} {arg}" if op in insns.OPERANDS else f"{i:6}  {op}")
+    return "\n".join(lines) + "\n"
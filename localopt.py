@@ -0,0 +1,170 @@
+# Description: Dead-store elimination and copy propagation on locals
+#
+# Built on the analyses in dataflow.py, so it runs after offsets and
+# before codegen.  The two transforms feed each other (propagating a copy
+# can leave the copy dead) and are repeated until neither changes the
+# function.  process() returns one FuncStats per function; report()
+# formats them.
+
+from dataclasses import dataclass
+from typing import Dict, List
+
+from tau import asts
+import dataflow
+
+
+@dataclass
+class FuncStats:
+    name: str
+    slots: int = 0
+    rounds: int = 0
+    stores_removed: int = 0
+    calls_kept: int = 0  # dead stores whose call was kept as a CallStmt
+    copies_propagated: int = 0
+    uninitialized_reads: int = 0
+
+
+def process(ast: asts.Program) -> List[FuncStats]:
+    return [funcdecl(decl) for decl in ast.decls]
+
+
+def funcdecl(ast: asts.FuncDecl) -> FuncStats:
+    stats = FuncStats(ast.id.token.value)
+    changed = True
+    while changed:
+        stats.rounds += 1
+        changed = _propagate(dataflow.build(ast), stats)
+        changed = _eliminate(dataflow.build(ast), stats) or changed
+    g = dataflow.build(ast)
+    stats.slots = len(g.vars)
+    stats.uninitialized_reads = uninitialized(g)
+    return stats
+
+
+def report(stats: List[FuncStats]) -> str:
+    lines = [f"{'function':<20} {'slots':>5} {'rounds':>6} {'stores':>6} {'calls':>6} {'copies':>6} {'uninit':>6}"]
+    for s in stats:
+        lines.append(
+            f"{s.name:<20} {s.slots:>5} {s.rounds:>6} {s.stores_removed:>6} "
+            f"{s.calls_kept:>6} {s.copies_propagated:>6} {s.uninitialized_reads:>6}"
+        )
+    return "\n".join(lines)
+
+
+# Replace reads of a with b wherever the copy a = b holds on every path.
+def _propagate(g: dataflow.Graph, stats: FuncStats) -> bool:
+    avail = dataflow.copies(g)
+    sources = {n.copy: n.ast.rhs for n in g.nodes if n.copy is not None}
+    before = stats.copies_propagated
+    for n in g.nodes:
+        if not avail.before[n]:
+            continue
+        subst = {dst: sources[(dst, src)] for dst, src in avail.before[n]}
+        match n.kind:
+            case "assign":
+                if isinstance(n.ast.lhs, asts.ArrayCell):
+                    n.ast.lhs.idx = _replace(n.ast.lhs.idx, subst, stats)
+                n.ast.rhs = _replace(n.ast.rhs, subst, stats)
+            case "cond":
+                n.ast.expr = _replace(n.ast.expr, subst, stats)
+            case "print":
+                n.ast.expr = _replace(n.ast.expr, subst, stats)
+            case "call":
+                _replace(n.ast.call, subst, stats)
+            case "return":
+                if n.ast.expr is not None:
+                    n.ast.expr = _replace(n.ast.expr, subst, stats)
+    return stats.copies_propagated != before
+
+
+def _replace(e: asts.Expr, subst: Dict[int, asts.IdExpr], stats: FuncStats) -> asts.Expr:
+    match e:
+        case asts.IdExpr():
+            slot = dataflow.slot(e)
+            if slot in subst:
+                stats.copies_propagated += 1
+                src = asts.IdExpr(subst[slot].id, e.span)
+                src.semantic_type = e.semantic_type
+                return src
+        case asts.CallExpr():
+            e.args = [_replace(arg, subst, stats) for arg in e.args]
+        case asts.ArrayCell():
+            e.idx = _replace(e.idx, subst, stats)
+        case asts.BinaryOp():
+            e.left = _replace(e.left, subst, stats)
+            e.right = _replace(e.right, subst, stats)
+        case asts.UnaryOp():
+            e.expr = _replace(e.expr, subst, stats)
+    return e
+
+
+# Remove assignments to scalar locals that are not live afterwards.  A
+# dead assignment of a call result still has to make the call, and one
+# that may divide by zero is kept so that the program still traps.
+def _eliminate(g: dataflow.Graph, stats: FuncStats) -> bool:
+    live = dataflow.liveness(g)
+    changed = False
+    for n in g.nodes:
+        if n.kind != "assign" or not isinstance(n.ast.lhs, asts.IdExpr):
+            continue
+        if not dataflow.scalar(n.ast.lhs) or dataflow.slot(n.ast.lhs) in live.after[n]:
+            continue
+        if isinstance(n.ast.rhs, asts.CallExpr):
+            replacement = [asts.CallStmt(n.ast.rhs, n.ast.span)]
+            stats.calls_kept += 1
+        elif _calls(n.ast.rhs) or _traps(n.ast.rhs):
+            continue
+        else:
+            replacement = []
+        i = next(i for i, s in enumerate(n.block.stmts) if s is n.ast)
+        n.block.stmts[i:i + 1] = replacement
+        stats.stores_removed += 1
+        changed = True
+    return changed
+
+
+def _calls(e: asts.Expr) -> bool:
+    match e:
+        case asts.CallExpr():
+            return True
+        case asts.ArrayCell():
+            return _calls(e.idx)
+        case asts.BinaryOp():
+            return _calls(e.left) or _calls(e.right)
+        case asts.UnaryOp():
+            return _calls(e.expr)
+        case _:
+            return False
+
+
+# Whether e divides by anything but a nonzero literal.
+def _traps(e: asts.Expr) -> bool:
+    match e:
+        case asts.BinaryOp() if e.op.kind == "/":
+            divisor = e.right
+            if not isinstance(divisor, asts.IntLiteral) or int(divisor.token.value) == 0:
+                return True
+            return _traps(e.left)
+        case asts.ArrayCell():
+            return _traps(e.idx)
+        case asts.BinaryOp():
+            return _traps(e.left) or _traps(e.right)
+        case asts.UnaryOp():
+            return _traps(e.expr)
+        case asts.CallExpr():
+            return any(_traps(arg) for arg in e.args)
+        case _:
+            return False
+
+
+# Reads of a local that the entry definition may reach, i.e. reads that
+# can see whatever an earlier frame left in the slot.
+def uninitialized(g: dataflow.Graph) -> int:
+    params = {param.id.symbol.offset for param in g.func.params}
+    defs = dataflow.reaching(g)
+    count = 0
+    for n in g.nodes:
+        for slot in n.uses:
+            if slot not in params and (slot, g.entry.index) in defs.before[n]:
+                count += 1
+    return count
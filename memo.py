@@ -0,0 +1,121 @@
+# Description: Memoization of pure recursive functions
+#
+# candidates() picks the functions worth memoizing: pure ones (see
+# purity.py) that can call themselves.  codegen.generate(ast, memo=...)
+# compiles every call of those functions as
+#
+#   PushImmediate(n) PushLabel(f) MemoCall MemoSave
+#
+# instead of PushLabel(f) Call, after the arguments have been stored in
+# their slots as usual.  MemoCall pops the function and the argument
+# count and looks the arguments up in the Memo table.  On a hit it puts
+# the result in the return slot and skips the MemoSave.  On a miss it
+# calls the function like Call does, and MemoSave stores the result
+# once it returns.  Only interp runs these instructions, and only with
+# codegen's usual calling convention.
+#
+# The table is shared by all functions, holds at most capacity results
+# and evicts the least recently used one.  A function that may read a
+# local before assigning it sees whatever the slot held, so its result
+# is not a function of its arguments; candidates() leaves such functions
+# out, using localopt's reaching-definitions check.  It needs the frame
+# offsets, so it runs after offsets.
+
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from tau import asts
+import dataflow
+import localopt
+import purity
+
+CAPACITY = 1 << 16
+
+
+class Memo:
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self.table: "OrderedDict[Tuple, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Tuple) -> Optional[int]:
+        value = self.table.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.table.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def store(self, key: Tuple, value: int):
+        self.table[key] = value
+        self.table.move_to_end(key)
+        if len(self.table) > self.capacity:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def report(self) -> str:
+        calls = self.hits + self.misses
+        rate = self.hits / calls if calls else 0.0
+        return (
+            f"memo: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), "
+            f"{len(self.table)}/{self.capacity} entries, {self.evictions} evictions"
+        )
+
+
+def candidates(ast: asts.Program) -> Set[str]:
+    pure = purity.pure(ast)
+    calls = {decl.id.token.value: callees(decl.body) for decl in ast.decls}
+    decls = {decl.id.token.value: decl for decl in ast.decls}
+    return {
+        name
+        for name in pure
+        if name in reachable(name, calls) and localopt.uninitialized(dataflow.build(decls[name])) == 0
+    }
+
+
+# The functions a call of name can lead to, not counting name itself
+# unless it is reached again.
+def reachable(name: str, calls: Dict[str, Set[str]]) -> Set[str]:
+    seen: Set[str] = set()
+    work = list(calls.get(name, ()))
+    while work:
+        f = work.pop()
+        if f not in seen:
+            seen.add(f)
+            work += calls.get(f, ())
+    return seen
+
+
+def callees(ast) -> Set[str]:
+    found = set()
+    match ast:
+        case asts.CallExpr():
+            found.add(ast.fn.id.token.value)
+            for arg in ast.args:
+                found |= callees(arg)
+        case asts.CompoundStmt():
+            for s in ast.stmts:
+                found |= callees(s)
+        case asts.AssignStmt():
+            found = callees(ast.lhs) | callees(ast.rhs)
+        case asts.IfStmt():
+            found = callees(ast.expr) | callees(ast.thenStmt)
+            if ast.elseStmt is not None:
+                found |= callees(ast.elseStmt)
+        case asts.WhileStmt():
+            found = callees(ast.expr) | callees(ast.stmt)
+        case asts.CallStmt():
+            found = callees(ast.call)
+        case asts.PrintStmt() | asts.ReturnStmt():
+            if ast.expr is not None:
+                found = callees(ast.expr)
+        case asts.BinaryOp():
+            found = callees(ast.left) | callees(ast.right)
+        case asts.UnaryOp():
+            found = callees(ast.expr)
+        case asts.ArrayCell():
+            found = callees(ast.arr) | callees(ast.idx)
+    return found
@@ -0,0 +1,242 @@
+# Description: Optimization levels and the pass manager
+#
+# The optimizations run at three points of a compile:
+#   ast    after typecheck, before offsets: consteval ("fold"), cse and
+#          schedule, which may add locals offsets has to allocate
+#   late   after offsets, before codegen: localopt, which works on frame
+#          slots
+#   code   after codegen, on the instruction list: cfg and fuse
+# and always in the order of PASSES.  LEVELS says which ones -O runs:
+#   -O0  none
+#   -O1  fold, localopt, cfg
+#   -O2  fold, cse, schedule, localopt, cfg, fuse
+# memo and lean change how calls work rather than the code of a
+# function, and stay options of their own.
+#
+# A Manager runs the passes of one point at a time, each timed and in an
+# instrument phase of its name.  With measure=True it also compiles and
+# runs the program before the first pass and after every pass, which
+# gives each pass's static delta (instructions, labels not counted), its
+# dynamic delta (instructions executed) and what the program printed.
+# After an AST pass, that is done on a copy of the AST.
+#
+# differential() compiles a program at -O0 and with the passes given,
+# runs both and compares what they print.  When they differ it measures
+# the passes to name the first one after which the output changed.
+#
+# usage: python passes.py [-O N] [--passes P,P,...] [--lean] [--memo] [--diff] file-or-directory ...
+
+import argparse
+import copy
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from tau import asts
+from tau.vm.vm import Insn
+import cfg
+import codegen
+import consteval
+import cse
+import fuse
+import insns
+import instrument
+import interp
+import link
+import localopt
+import memo as memoize
+import offsets
+import pipeline
+import schedule
+import stackdepth
+
+
+@dataclass
+class Pass:
+    name: str
+    point: str  # "ast", "late" or "code"
+    run: Callable  # ast -> None, or (code, effects) -> code for code passes
+
+
+PASSES: Dict[str, Pass] = {
+    p.name: p
+    for p in [
+        Pass("fold", "ast", consteval.process),
+        Pass("cse", "ast", cse.process),
+        Pass("schedule", "ast", schedule.process),
+        Pass("localopt", "late", localopt.process),
+        Pass("cfg", "code", lambda code, effects: cfg.optimize(code)[0]),
+        Pass("fuse", "code", fuse.select),
+    ]
+}
+
+LEVELS: Dict[int, List[str]] = {
+    0: [],
+    1: ["fold", "localopt", "cfg"],
+    2: ["fold", "cse", "schedule", "localopt", "cfg", "fuse"],
+}
+
+
+# The passes of level and the extra ones, in the order they run.
+def select(level: int, extra: Iterable[str] = ()) -> List[str]:
+    chosen = set(LEVELS[level]) | set(extra)
+    for name in chosen:
+        if name not in PASSES:
+            raise ValueError(f"unknown pass {name}")
+    return [name for name in PASSES if name in chosen]
+
+
+@dataclass
+class PassStats:
+    name: str
+    seconds: float = 0.0
+    insns: Optional[int] = None  # static instructions after the pass, with measure
+    steps: Optional[int] = None  # instructions executed after it
+    output: Optional[List[str]] = None  # what the program printed after it
+
+
+class Manager:
+    def __init__(self, names: Iterable[str], lean: bool = False, memo: bool = False, measure: bool = False):
+        self.passes = [PASSES[name] for name in names]
+        self.lean = lean
+        self.memo = memo
+        self.measure = measure
+        self.effects = insns.LEAN_EFFECTS if lean else insns.EFFECTS
+        self.stats: List[PassStats] = []
+
+    # Measures the program before any pass has run on it.
+    def begin(self, ast: asts.Program):
+        if self.measure:
+            s = PassStats("-O0")
+            self._measure(s, self._generate(ast, True))
+            self.stats.append(s)
+
+    def run(self, point: str, value):
+        for p in self.passes:
+            if p.point != point:
+                continue
+            with instrument.phase(p.name) as phase:
+                start = time.perf_counter()
+                if point == "code":
+                    value = p.run(value, self.effects)
+                else:
+                    p.run(value)
+                seconds = time.perf_counter() - start
+                phase.result(value)
+            s = PassStats(p.name, seconds)
+            if self.measure:
+                self._measure(s, value if point == "code" else self._generate(value, point == "ast"))
+            self.stats.append(s)
+        return value
+
+    def _generate(self, ast: asts.Program, fresh: bool) -> List[Insn]:
+        ast = copy.deepcopy(ast)
+        if fresh:
+            offsets.process(ast)
+        return codegen.generate(ast, self.lean, memoize.candidates(ast) if self.memo else ())
+
+    def _measure(self, s: PassStats, code: List[Insn]):
+        s.insns = sum(1 for insn in code if insns.name(insn) != "Label")
+        try:
+            result = run(code, self.effects)
+            s.steps = result.steps
+            s.output = result.output
+        except Exception as e:
+            s.output = [f"error: {type(e).__name__}: {e}"]
+
+
+def run(code: List[Insn], effects: Dict[str, Tuple[int, int]] = insns.EFFECTS) -> interp.Result:
+    image = link.link(code)
+    stackdepth.annotate(image, stackdepth.analyze(code, effects))
+    return interp.run(image)
+
+
+def compile(
+    ast: asts.Program, names: Iterable[str], lean: bool = False, memo: bool = False, measure: bool = False
+) -> Tuple[List[Insn], Manager]:
+    manager = Manager(names, lean, memo, measure)
+    manager.begin(ast)
+    manager.run("ast", ast)
+    offsets.process(ast)
+    manager.run("late", ast)
+    code = codegen.generate(ast, lean, memoize.candidates(ast) if memo else ())
+    return manager.run("code", code), manager
+
+
+def report(stats: List[PassStats]) -> str:
+    lines = [f"{'pass':<10} {'ms':>8} {'insns':>8} {'delta':>7} {'steps':>12} {'delta':>10}"]
+    before = None
+    for s in stats:
+        line = f"{s.name:<10} {s.seconds * 1e3:>8.2f}"
+        if s.insns is not None:
+            line += f" {s.insns:>8} {s.insns - before.insns if before else 0:>+7}"
+        if s.steps is not None:
+            delta = s.steps - before.steps if before and before.steps is not None else 0
+            line += f" {s.steps:>12} {delta:>+10}"
+        elif s.output is not None:
+            line += f" {s.output[0]}"
+        lines.append(line)
+        before = s
+    return "\n".join(lines) + "\n"
+
+
+# One line per difference between -O0 and the passes given.
+def differential(source: str, names: List[str], lean: bool = False, memo: bool = False) -> List[str]:
+    def output(chosen: List[str], measure: bool = False) -> Tuple[List[str], Manager]:
+        code, manager = compile(pipeline.front(source), chosen, lean, memo, measure)
+        try:
+            return run(code, manager.effects).output, manager
+        except Exception as e:
+            return [f"error: {type(e).__name__}: {e}"], manager
+
+    reference, _ = output([])
+    optimized, _ = output(names)
+    if optimized == reference:
+        return []
+    problem = f"printed {optimized}, -O0 printed {reference}"
+    _, manager = output(names, measure=True)
+    for s in manager.stats:
+        if s.output != reference:
+            return [f"{problem}; first differs after {s.name}"]
+    return [problem]
+
+
+def main(argv: List[str]) -> int:
+    from difftest import programs
+
+    parser = argparse.ArgumentParser(description="Run the optimization passes of a level and measure them.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("-O", dest="level", type=int, choices=sorted(LEVELS), default=2)
+    parser.add_argument("--passes", default="", help="comma-separated passes to run besides the level's")
+    parser.add_argument("--lean", action="store_true", help="use the lean calling convention")
+    parser.add_argument("--memo", action="store_true", help="memoize pure recursive functions")
+    parser.add_argument("--diff", action="store_true", help="compare the output with -O0 instead")
+    args = parser.parse_args(argv)
+    if args.lean and args.memo:
+        parser.error("--lean cannot be combined with --memo")
+    try:
+        names = select(args.level, [p for p in args.passes.split(",") if p])
+    except ValueError as e:
+        parser.error(str(e))
+    files = programs(args.paths)
+    failed = 0
+    for path in files:
+        with open(path) as f:
+            source = f.read()
+        if args.diff:
+            problems = differential(source, names, args.lean, args.memo)
+            for problem in problems:
+                print(f"{path}: {problem}")
+            failed += bool(problems)
+            continue
+        _, manager = compile(pipeline.front(source), names, args.lean, args.memo, measure=True)
+        print(f"{path}:")
+        print(report(manager.stats))
+    if args.diff:
+        print(f"{failed} of {len(files)} programs differ from -O0")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
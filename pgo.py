@@ -0,0 +1,310 @@
+# Description: Profile-guided optimization
+#
+# record() compiles a program with codegen's probe labels, runs it under
+# vmprofile and turns the counts into a Profile.  Nothing in it refers to
+# instruction addresses or id()s; every statement is named by a site,
+# "<function>:<kind><n>" with n its position in a preorder walk of the
+# function body (see sites()), so a profile stays valid for any later
+# compile of the same source.  It holds
+#   - the calls of every function,
+#   - the executions of every statement,
+#   - for every if, how often each branch ran,
+#   - for every while, how often it was entered and how often its body
+#     ran, which gives the average trip count,
+#   - for every JumpIfZero/JumpIfNotZero, how often it was taken and not
+#     taken, named by the statement whose condition it tests and its
+#     position among that statement's branches.
+#
+# optimize() compiles the program again with the profile fed back:
+#   - an if whose then branch ran more often than its else branch tests
+#     for the then branch (codegen's feedback.invert),
+#   - a while whose body ran more often than the loop was entered is
+#     rotated (feedback.rotate),
+#   - cfg.layout() orders the blocks by the measured statement counts
+#     instead of estimating them from loop depth.
+# Asked for spans, it maps them through the layout, so -g builds with a
+# profile still get a line table.
+# There is no inliner yet; inline_candidates() lists the small,
+# non-recursive functions that are called most, for when there is.
+#
+# usage: python pgo.py record file.tau [-o profile.json]
+#        python pgo.py report file.tau profile.json
+
+import argparse
+import json
+import sys
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from tau import asts
+from tau.vm.vm import Insn
+import cfg
+import codegen
+import insns
+import link
+import memo
+import vmprofile
+
+VERSION = 1
+
+_KINDS = {
+    asts.AssignStmt: "assign",
+    asts.IfStmt: "if",
+    asts.WhileStmt: "while",
+    asts.CallStmt: "call",
+    asts.CompoundStmt: "block",
+    asts.PrintStmt: "print",
+    asts.ReturnStmt: "return",
+}
+
+
+@dataclass
+class Profile:
+    calls: Dict[str, int] = field(default_factory=dict)
+    stmts: Dict[str, int] = field(default_factory=dict)
+    ifs: Dict[str, Tuple[int, int]] = field(default_factory=dict)  # (then, else)
+    loops: Dict[str, Tuple[int, int]] = field(default_factory=dict)  # (entries, iterations)
+    branches: Dict[str, Tuple[int, int]] = field(default_factory=dict)  # (taken, not taken)
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"version": VERSION, **asdict(self)}, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def load(path: str) -> "Profile":
+        with open(path) as f:
+            data = json.load(f)
+        if data.pop("version", None) != VERSION:
+            raise ValueError(f"{path}: unsupported profile version")
+        prof = Profile(**data)
+        prof.ifs = {k: tuple(v) for k, v in prof.ifs.items()}
+        prof.loops = {k: tuple(v) for k, v in prof.loops.items()}
+        prof.branches = {k: tuple(v) for k, v in prof.branches.items()}
+        return prof
+
+
+# Maps id() of every statement to its site.
+def sites(ast: asts.Program) -> Dict[int, str]:
+    names = {}
+    for decl in ast.decls:
+        fn = decl.id.token.value
+        work = [decl.body]
+        n = 0
+        while work:
+            s = work.pop()
+            names[id(s)] = f"{fn}:{_KINDS[type(s)]}{n}"
+            n += 1
+            match s:
+                case asts.CompoundStmt():
+                    work += reversed(s.stmts)
+                case asts.IfStmt():
+                    work += [s.elseStmt, s.thenStmt] if s.elseStmt is not None else [s.thenStmt]
+                case asts.WhileStmt():
+                    work.append(s.stmt)
+    return names
+
+
+# Image address of every label in code, as link() lays it out.
+def _addresses(code: List[Insn]) -> Dict[str, int]:
+    at = {}
+    pc = 0
+    for insn in code:
+        if insns.name(insn) == "Label":
+            at[insns.operand(insn)] = pc
+        else:
+            pc += 1
+    return at
+
+
+def record(ast: asts.Program) -> Profile:
+    names = sites(ast)
+    code = codegen.generate(ast, probes=True)
+    image = link.link(code)
+    counts = vmprofile.run(image)
+    at = _addresses(code)
+
+    def count(label: str) -> int:
+        pc = at[label]
+        return counts.counts[pc] if pc < len(image) else 0
+
+    prof = Profile(calls=dict(counts.calls))
+    nodes = {id(s): s for s in _statements(ast)}
+    bodies = {id(decl.body): decl.id.token.value for decl in ast.decls}  # generated without a probe
+    for key, site in names.items():
+        if key in bodies:
+            prof.stmts[site] = prof.calls.get(bodies[key], 0)
+            continue
+        prof.stmts[site] = count(f"{key}probe")
+        match nodes[key]:
+            case asts.WhileStmt():
+                tests = prof.stmts[site]
+                iterations = count(f"{key}body")
+                prof.loops[site] = (max(tests - iterations, 0), iterations)
+                prof.stmts[site] = prof.loops[site][0]
+            case asts.IfStmt():
+                taken = count(f"{key}then")
+                prof.ifs[site] = (taken, prof.stmts[site] - taken)
+    # A conditional branch tests the condition of the innermost statement
+    # whose probe precedes it.
+    pc = 0
+    site = None
+    seen: Dict[str, int] = {}
+    for insn in code:
+        op = insns.name(insn)
+        if op == "Label":
+            label = insns.operand(insn)
+            if label.endswith("probe"):
+                site = names[int(label[:-5])]
+            continue
+        if op in ("JumpIfZero", "JumpIfNotZero") and site is not None:
+            n = seen.get(site, 0)
+            seen[site] = n + 1
+            taken = counts.taken.get(pc, 0)
+            prof.branches[f"{site}#{n}"] = (taken, counts.counts[pc] - taken)
+        pc += 1
+    return prof
+
+
+def _statements(ast: asts.Program) -> List[asts.Stmt]:
+    return _below([decl.body for decl in ast.decls])
+
+
+def _below(work: List[asts.Stmt]) -> List[asts.Stmt]:
+    found = []
+    while work:
+        s = work.pop()
+        found.append(s)
+        match s:
+            case asts.CompoundStmt():
+                work += s.stmts
+            case asts.IfStmt():
+                work += [s.thenStmt] + ([s.elseStmt] if s.elseStmt is not None else [])
+            case asts.WhileStmt():
+                work.append(s.stmt)
+    return found
+
+
+# The decisions codegen asks for, made from a profile.
+class Feedback:
+    def __init__(self, ast: asts.Program, prof: Profile):
+        self.sites = sites(ast)
+        self.prof = prof
+
+    def invert(self, ast: asts.IfStmt) -> bool:
+        then, other = self.prof.ifs.get(self.sites[id(ast)], (0, 0))
+        return then > other
+
+    def rotate(self, ast: asts.WhileStmt) -> bool:
+        entries, iterations = self.prof.loops.get(self.sites[id(ast)], (0, 0))
+        return iterations > entries
+
+
+# Block frequencies of cfg.build(code) for code generated with probes:
+# a block with probe, then, body, loop top or function labels runs as
+# often as the profile says the most reached of them was reached, any
+# other as often as the block before it.
+def frequencies(code: List[Insn], ast: asts.Program, prof: Profile) -> Dict[int, int]:
+    names = sites(ast)
+    known: Dict[str, int] = dict(prof.calls)
+    for key, site in names.items():
+        known[f"{key}probe"] = prof.stmts.get(site, 0)
+        if site in prof.ifs:
+            known[f"{key}then"] = prof.ifs[site][0]
+        if site in prof.loops:
+            entries, iterations = prof.loops[site]
+            known[f"{key}body"] = iterations
+            known[f"{key}top"] = entries + iterations
+    freq = {}
+    last = 0
+    for b in cfg.build(code).blocks:
+        reached = [known[label] for label in b.labels if label in known]
+        if reached:
+            last = max(reached)
+        freq[b.index] = last
+    return freq
+
+
+# Given a list for spans, fills it in as codegen.generate does, for the
+# optimized code.  cfg keeps the instructions it does not replace, so
+# their spans are carried over; the jumps it makes at the end of a block
+# take the span of the instruction before them.
+def optimize(ast: asts.Program, prof: Profile, spans: Optional[list] = None) -> Tuple[List[Insn], cfg.Report]:
+    code = codegen.generate(ast, spans=spans, probes=True, feedback=Feedback(ast, prof))
+    optimized, report = cfg.optimize(code, frequencies(code, ast, prof))
+    if spans is not None:
+        by_id = {id(insn): span for insn, span in zip(code, spans)}
+        spans.clear()
+        for insn in optimized:
+            spans.append(by_id[id(insn)] if id(insn) in by_id else spans[-1] if spans else None)
+    return optimized, report
+
+
+# Functions of at most size statements (blocks not counted) that are
+# called and cannot call themselves, most called first.
+def inline_candidates(ast: asts.Program, prof: Profile, size: int = 8) -> List[Tuple[str, int]]:
+    calls = {decl.id.token.value: memo.callees(decl.body) for decl in ast.decls}
+    found = []
+    for decl in ast.decls:
+        name = decl.id.token.value
+        stmts = [s for s in _below([decl.body]) if not isinstance(s, asts.CompoundStmt)]
+        if name != "main" and len(stmts) <= size and name not in memo.reachable(name, calls) and prof.calls.get(name):
+            found.append((name, prof.calls[name]))
+    return sorted(found, key=lambda c: -c[1])
+
+
+def report(ast: asts.Program, prof: Profile) -> str:
+    feedback = Feedback(ast, prof)
+    lines = []
+    for s in _statements(ast):
+        site = feedback.sites[id(s)]
+        if isinstance(s, asts.IfStmt) and feedback.invert(s):
+            then, other = prof.ifs[site]
+            lines.append(f"{site}: then branch first ({then} then, {other} else)")
+        if isinstance(s, asts.WhileStmt) and feedback.rotate(s):
+            entries, iterations = prof.loops[site]
+            lines.append(f"{site}: rotated ({iterations / max(entries, 1):.1f} iterations per entry)")
+    lines.sort()
+    for name, n in inline_candidates(ast, prof):
+        lines.append(f"inline candidate {name}: {n} calls")
+    return "\n".join(lines) + "\n" if lines else "no decisions changed\n"
+
+
+def main(argv: List[str]) -> int:
+    import interp
+    import offsets
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Profile-guided optimization of Tau programs.")
+    parser.add_argument("command", choices=["record", "report"])
+    parser.add_argument("file")
+    parser.add_argument("profile", nargs="?")
+    parser.add_argument("-o", "--output", help="where record writes the profile")
+    args = parser.parse_args(argv)
+    with open(args.file) as f:
+        source = f.read()
+
+    def front() -> asts.Program:
+        ast = pipeline.front(source)
+        offsets.process(ast)
+        return ast
+
+    if args.command == "record":
+        prof = record(front())
+        prof.save(args.output or args.file + ".profile.json")
+        return 0
+    if args.profile is None:
+        parser.error("report needs a profile")
+    prof = Profile.load(args.profile)
+    ast = front()
+    print(report(ast, prof), end="")
+    plain = interp.run(link.link(codegen.generate(front())))
+    code, _ = optimize(ast, prof)
+    tuned = interp.run(link.link(code))
+    if tuned.output != plain.output:
+        raise AssertionError("the optimized program printed something else")
+    print(f"{plain.steps} instructions before, {tuned.steps} after")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,58 @@
+# Description: Runs the compiler stages in order
+#
+# front() takes source text to a bound and typechecked Program, which is
+# where the AST optimizations run; compile() finishes with offsets and
+# codegen, optionally with codegen's lean calling convention or with
+# calls of memo.candidates() memoized.  Each phase is timed when an
+# instrument.recording() is active.  run_stock() executes a List[Insn] on the stock tau vm and
+# returns what it printed, one entry per line.
+
+import io
+from contextlib import redirect_stdout
+from typing import List
+
+from tau import asts
+from tau.vm import vm
+from tau.vm.vm import Insn
+from scanner import Scanner
+from parse import Parser
+import bindings
+import typecheck
+import offsets
+import codegen
+import instrument
+import memo as memoize
+
+
+def front(source: str) -> asts.Program:
+    with instrument.phase("parse") as p:
+        ast = Parser(instrument.scanner(Scanner(source))).parse()
+        p.result(ast)
+    with instrument.phase("bindings") as p:
+        bindings.process(ast)
+        p.result(ast)
+    with instrument.phase("typecheck") as p:
+        typecheck.process(ast)
+        p.result(ast)
+    return ast
+
+
+def back(ast: asts.Program, lean: bool = False, memo: bool = False) -> List[Insn]:
+    with instrument.phase("offsets") as p:
+        offsets.process(ast)
+        p.result(ast)
+    with instrument.phase("codegen") as p:
+        code = codegen.generate(ast, lean, memoize.candidates(ast) if memo else ())
+        p.result(code)
+    return code
+
+
+def compile(source: str, lean: bool = False, memo: bool = False) -> List[Insn]:
+    return back(front(source), lean, memo)
+
+
+def run_stock(code: List[Insn]) -> List[str]:
+    out = io.StringIO()
+    with redirect_stdout(out):
+        vm.run(code)
+    return out.getvalue().splitlines()
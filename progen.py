@@ -0,0 +1,216 @@
+# Description: Random generator of valid Tau programs
+#
+# generate(shape) writes a program that parses, binds and typechecks,
+# for the compile-time benchmarks.  It follows grammar.ebnf, one method
+# per production it uses (function_dec, nest, if, while, equation, the
+# expression_* levels, term), but picks only what the checker accepts:
+# every expression is generated for the type its context needs, `not`
+# and comparisons get a parenthesized operand so the grammar's
+# precedence cannot change their type, and arrays are left out because
+# codegen has none.
+#
+# Shape sets the size: the number of functions, how deep nest, if and
+# while statements nest, the statements per nest, the operators per
+# expression and how deeply its parentheses nest, the locals and
+# parameters of each function, and how often a term is a call.
+#
+# The programs terminate: every while counts a variable of its own up to
+# a small bound, and a function only calls the ones declared before it.
+# They are not meant to be fast to run; calls in loops multiply.  The
+# same Shape and seed always give the same program.
+#
+# usage: python progen.py [--functions N] [--depth N] ... [--seed N]
+
+import argparse
+import random
+import sys
+from dataclasses import dataclass, fields
+from typing import List, Optional, Tuple
+
+TYPES = ["int", "bool"]
+
+
+@dataclass
+class Shape:
+    functions: int = 8
+    depth: int = 2  # nest/if/while nesting in a function body
+    statements: int = 4  # per nest
+    expr_length: int = 3  # binary operators per expression, at most
+    expr_depth: int = 2  # parentheses nesting in an expression
+    locals: int = 3  # per function, besides loop counters
+    params: int = 2  # per function, at most
+    calls: float = 0.2  # chance that a term is a call
+    seed: int = 0
+
+
+@dataclass
+class _Function:
+    name: str
+    params: List[str]  # parameter types
+    ret: str
+
+
+class _Generator:
+    def __init__(self, shape: Shape):
+        self.shape = shape
+        self.rng = random.Random(shape.seed)
+        self.functions: List[_Function] = []
+        self.vars: List[Tuple[str, str]] = []  # (name, type) in scope, assignable
+        self.counters = 0  # loop counters used by the current function
+
+    def program(self) -> str:
+        decls = [self.function_dec(f"f{n}") for n in range(self.shape.functions)]
+        return "\n".join(decls + [self.main()])
+
+    def function_dec(self, name: str) -> str:
+        rng = self.rng
+        params = [rng.choice(TYPES) for _ in range(rng.randint(0, self.shape.params))]
+        ret = rng.choice(TYPES + ["void"])
+        self.vars = [(f"p{i}", t) for i, t in enumerate(params)]
+        self.vars += [(f"v{i}", rng.choice(TYPES)) for i in range(self.shape.locals)]
+        self.counters = 0
+        head = ", ".join(f"p{i}: {t}" for i, t in enumerate(params))
+        # The locals start out assigned, so that nothing reads garbage.
+        stmts = [f"{v} = {self.literal(t)}" for v, t in self.vars[len(params):]]
+        stmts += [self.statement(self.shape.depth) for _ in range(self.shape.statements)]
+        if ret != "void":
+            stmts.append(f"return {self.expression_or(ret, self.shape.expr_depth)}")
+        locals_ = [f"var {v}: {t}" for v, t in self.vars[len(params):]]
+        locals_ += [f"var c{i}: int" for i in range(self.counters)]
+        self.functions.append(_Function(name, params, ret))
+        return f"func {name}({head}): {ret} " + self.nest(locals_ + stmts, 0) + "\n"
+
+    # Prints what every int function returns for some arguments.
+    def main(self) -> str:
+        self.vars = []
+        stmts = []
+        for f in self.functions:
+            args = ", ".join(self.literal(t) for t in f.params)
+            if f.ret == "int":
+                stmts.append(f"print {f.name}({args})")
+            elif f.ret == "void":
+                stmts.append(f"call {f.name}({args})")
+        return "func main(): void " + self.nest(stmts, 0) + "\n"
+
+    def nest(self, lines: List[str], indent: int) -> str:
+        pad = "    " * (indent + 1)
+        body = "".join(f"{pad}{line}\n" for line in lines)
+        return "{\n" + body + "    " * indent + "}"
+
+    def statement(self, depth: int, indent: int = 0) -> str:
+        rng = self.rng
+        kinds = ["equation"] * 4
+        if depth > 0:
+            kinds += ["if", "while", "nest"]
+        if any(f.ret == "void" for f in self.functions) and rng.random() < self.shape.calls:
+            kinds.append("call")
+        match rng.choice(kinds):
+            case "equation":
+                return self.equation()
+            case "if":
+                return self.if_(depth, indent)
+            case "while":
+                return self.while_(depth, indent)
+            case "nest":
+                return self.block(depth, indent)
+            case "call":
+                f = rng.choice([f for f in self.functions if f.ret == "void"])
+                return f"call {self.func_call(f, self.shape.expr_depth)}"
+
+    def block(self, depth: int, indent: int) -> str:
+        return self.nest([self.statement(depth - 1, indent + 1) for _ in range(self.shape.statements)], indent + 1)
+
+    def if_(self, depth: int, indent: int) -> str:
+        text = f"if {self.expression_or('bool', self.shape.expr_depth)} " + self.block(depth, indent)
+        if self.rng.random() < 0.5:
+            text += " else " + self.block(depth, indent)
+        return text
+
+    # Counts c<n> from 0 to a small bound; nothing else assigns it.
+    def while_(self, depth: int, indent: int) -> str:
+        c = f"c{self.counters}"
+        self.counters += 1
+        body = [self.statement(depth - 1, indent + 1) for _ in range(self.shape.statements)]
+        body.append(f"{c} = {c} + 1")
+        return f"{c} = 0\n" + "    " * (indent + 1) + f"while {c} < {self.rng.randint(2, 4)} " + self.nest(body, indent + 1)
+
+    def equation(self) -> str:
+        if not self.vars:
+            return "print 0"
+        v, t = self.rng.choice(self.vars)
+        return f"{v} = {self.expression_or(t, self.shape.expr_depth)}"
+
+    def expression_or(self, t: str, depth: int, length: Optional[int] = None) -> str:
+        rng = self.rng
+        n = rng.randint(0, self.shape.expr_length if length is None else length)
+        if t == "int":
+            return self.expression_as(n, depth)
+        # A bool is an and/or of comparisons and bool terms.
+        ops = rng.randint(0, min(n, 2))
+        parts = [self.expression_comp(depth, (n - ops) // (ops + 1)) for _ in range(ops + 1)]
+        return "".join(part if i == 0 else f" {rng.choice(['and', 'or'])} {part}" for i, part in enumerate(parts))
+
+    def expression_comp(self, depth: int, n: int) -> str:
+        if self.rng.random() < 0.3:
+            return self.expression_biop("bool", depth)
+        op = self.rng.choice(["<", ">", "<=", ">=", "==", "!="])
+        return f"{self.expression_as(n // 2, depth)} {op} {self.expression_as(n - n // 2, depth)}"
+
+    # n binary operators of + - * /; division is by a nonzero literal.
+    def expression_as(self, n: int, depth: int) -> str:
+        rng = self.rng
+        text = self.expression_biop("int", depth)
+        for _ in range(n):
+            op = rng.choice(["+", "-", "*", "/"])
+            operand = str(rng.randint(1, 9)) if op == "/" else self.expression_biop("int", depth)
+            text += f" {op} {operand}"
+        return text
+
+    def expression_biop(self, t: str, depth: int) -> str:
+        rng = self.rng
+        r = rng.random()
+        if depth > 0 and r < 0.2:
+            inner = f"({self.expression_or(t, depth - 1)})"
+            if t == "bool" and rng.random() < 0.5:
+                return f"not {inner}"
+            if t == "int" and rng.random() < 0.3:
+                return f"-{inner}"
+            return inner
+        return self.term(t, depth)
+
+    def term(self, t: str, depth: int) -> str:
+        rng = self.rng
+        callable_ = [f for f in self.functions if f.ret == t]
+        if callable_ and rng.random() < self.shape.calls:
+            return self.func_call(rng.choice(callable_), depth - 1)
+        names = [v for v, vt in self.vars if vt == t]
+        if names and rng.random() < 0.7:
+            return rng.choice(names)
+        return self.literal(t)
+
+    def func_call(self, f: _Function, depth: int) -> str:
+        # Arguments are kept short, or calls nested in calls explode.
+        args = ", ".join(self.expression_or(t, max(depth, 0), 1) for t in f.params)
+        return f"{f.name}({args})"
+
+    def literal(self, t: str) -> str:
+        if t == "bool":
+            return self.rng.choice(["true", "false"])
+        return str(self.rng.randint(0, 99))
+
+
+def generate(shape: Shape) -> str:
+    return _Generator(shape).program()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Generate a random valid Tau program.")
+    for f in fields(Shape):
+        parser.add_argument(f"--{f.name.replace('_', '-')}", type=type(f.default), default=f.default)
+    args = parser.parse_args(argv)
+    print(generate(Shape(**{f.name: getattr(args, f.name) for f in fields(Shape)})), end="")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,97 @@
+# Description: Purity analysis of functions
+#
+# A function is pure when calling it has no effect besides its result,
+# so a call with known arguments can be replaced by the value it
+# returns.  A function is impure if it
+#   - prints,
+#   - takes, declares or indexes an array (arrays are shared with the
+#     caller), or
+#   - calls a function that is impure.
+# The last rule is applied until nothing changes, so functions that only
+# call each other recursively stay pure.  Whether a pure function
+# terminates is not decided here; consteval bounds the evaluation.
+
+from typing import Dict, List, Set
+
+from tau import asts
+
+
+# Maps each impure function to the reason it is impure.
+def analyze(ast: asts.Program) -> Dict[str, str]:
+    impure: Dict[str, str] = {}
+    calls: Dict[str, Set[str]] = {}
+    for decl in ast.decls:
+        name = decl.id.token.value
+        reasons: List[str] = []
+        calls[name] = set()
+        if any(isinstance(p.type_ast, asts.ArrayType) for p in decl.params):
+            reasons.append("takes an array")
+        _stmt(decl.body, reasons, calls[name])
+        if reasons:
+            impure[name] = reasons[0]
+    changed = True
+    while changed:
+        changed = False
+        for name, callees in calls.items():
+            if name in impure:
+                continue
+            for callee in sorted(callees):
+                if callee in impure:
+                    impure[name] = f"calls {callee}"
+                    changed = True
+                    break
+    return impure
+
+
+def pure(ast: asts.Program) -> Set[str]:
+    impure = analyze(ast)
+    return {decl.id.token.value for decl in ast.decls} - set(impure)
+
+
+def _stmt(ast: asts.Stmt, reasons: List[str], calls: Set[str]):
+    match ast:
+        case asts.CompoundStmt():
+            if any(isinstance(d.type_ast, asts.ArrayType) for d in ast.decls):
+                reasons.append("declares an array")
+            for s in ast.stmts:
+                _stmt(s, reasons, calls)
+        case asts.AssignStmt():
+            _expr(ast.lhs, reasons, calls)
+            _expr(ast.rhs, reasons, calls)
+        case asts.IfStmt():
+            _expr(ast.expr, reasons, calls)
+            _stmt(ast.thenStmt, reasons, calls)
+            if ast.elseStmt is not None:
+                _stmt(ast.elseStmt, reasons, calls)
+        case asts.WhileStmt():
+            _expr(ast.expr, reasons, calls)
+            _stmt(ast.stmt, reasons, calls)
+        case asts.CallStmt():
+            _expr(ast.call, reasons, calls)
+        case asts.PrintStmt():
+            reasons.append("prints")
+            _expr(ast.expr, reasons, calls)
+        case asts.ReturnStmt():
+            if ast.expr is not None:
+                _expr(ast.expr, reasons, calls)
+        case _:
+            reasons.append(f"contains {type(ast).__name__}")
+
+
+def _expr(e: asts.Expr, reasons: List[str], calls: Set[str]):
+    match e:
+        case asts.CallExpr():
+            calls.add(e.fn.id.token.value)
+            for arg in e.args:
+                _expr(arg, reasons, calls)
+        case asts.BinaryOp():
+            _expr(e.left, reasons, calls)
+            _expr(e.right, reasons, calls)
+        case asts.UnaryOp():
+            _expr(e.expr, reasons, calls)
+        case asts.ArrayCell():
+            reasons.append("indexes an array")
+        case asts.IdExpr() | asts.IntLiteral() | asts.BoolLiteral():
+            pass
+        case _:
+            reasons.append(f"contains {type(e).__name__}")
@@ -0,0 +1,165 @@
+# Description: Tau-to-Python backend
+#
+# Lowers each typed, offset-resolved FuncDecl into a Python function, so
+# it runs after offsets (in place of codegen).  Parameters and locals
+# become Python locals named after their frame slot, if/while become
+# Python control flow, and print appends to a buffer.  The generated
+# source is built with compile() and run directly.
+#
+# Semantics follow the VM backend: ints are unbounded, / floors, and
+# and/or short-circuit.  Bools stay Python bools and are printed as 1 or
+# 0.  Locals start at 0 (on the vm they start with whatever the slot
+# last held), and a non-void function that falls off its end returns 0.
+#
+# Function f is compiled to the Python function named by pyname(f);
+# calls look it up in the module namespace when they are made.
+
+import sys
+from typing import Dict, List
+
+from tau import asts
+from tau.symbols import *
+
+_ops = {
+    "+": "+",
+    "-": "-",
+    "*": "*",
+    "/": "//",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "==": "==",
+    "!=": "!=",
+    "and": "and",
+    "or": "or",
+}
+
+
+def pyname(name: str) -> str:
+    return "tau_" + name
+
+
+def local(sym: IdSymbol) -> str:
+    if sym.offset < 0:
+        return f"a{-sym.offset}"
+    return f"s{sym.offset}"
+
+
+def generate(ast: asts.Program) -> str:
+    lines = []
+    for decl in ast.decls:
+        lines += funcdecl(decl)
+        lines.append("")
+    return "\n".join(lines)
+
+
+def funcdecl(ast: asts.FuncDecl) -> List[str]:
+    params = ", ".join(local(param.id.symbol) for param in ast.params)
+    lines = [f"def {pyname(ast.id.token.value)}({params}):"]
+    slots = sorted({local(sym) for sym in _locals(ast.body)})
+    if slots:
+        lines.append("    " + " = ".join(slots) + " = 0")
+    lines += compoundstmt(ast.body, 1)
+    if not isinstance(ast.ret_type_ast, asts.VoidType):
+        lines.append("    return 0")
+    elif len(lines) == 1:
+        lines.append("    pass")
+    return lines
+
+
+def _locals(ast: asts.CompoundStmt) -> List[IdSymbol]:
+    syms = [decl.id.symbol for decl in ast.decls]
+    for s in ast.stmts:
+        match s:
+            case asts.CompoundStmt():
+                syms += _locals(s)
+            case asts.IfStmt():
+                syms += _locals(s.thenStmt)
+                if s.elseStmt is not None:
+                    syms += _locals(s.elseStmt)
+            case asts.WhileStmt():
+                syms += _locals(s.stmt)
+    return syms
+
+
+def compoundstmt(ast: asts.CompoundStmt, depth: int) -> List[str]:
+    lines = []
+    for s in ast.stmts:
+        lines += stmt(s, depth)
+    return lines
+
+
+def _block(ast: asts.CompoundStmt, depth: int) -> List[str]:
+    return compoundstmt(ast, depth) or ["    " * depth + "pass"]
+
+
+def stmt(ast: asts.Stmt, depth: int) -> List[str]:
+    pad = "    " * depth
+    match ast:
+        case asts.CompoundStmt():
+            return compoundstmt(ast, depth)
+        case asts.AssignStmt():
+            assert isinstance(ast.lhs, asts.IdExpr), "arrays are not supported"
+            return [f"{pad}{local(ast.lhs.id.symbol)} = {expr(ast.rhs)}"]
+        case asts.IfStmt():
+            lines = [f"{pad}if {expr(ast.expr)}:"] + _block(ast.thenStmt, depth + 1)
+            if ast.elseStmt is not None:
+                lines += [f"{pad}else:"] + _block(ast.elseStmt, depth + 1)
+            return lines
+        case asts.WhileStmt():
+            return [f"{pad}while {expr(ast.expr)}:"] + _block(ast.stmt, depth + 1)
+        case asts.CallStmt():
+            return [f"{pad}{expr(ast.call)}"]
+        case asts.PrintStmt():
+            value = expr(ast.expr)
+            if isinstance(ast.expr.semantic_type, BoolType):
+                value = f"int({value})"
+            return [f"{pad}tau_print(str({value}))"]
+        case asts.ReturnStmt():
+            if ast.expr is None:
+                return [f"{pad}return"]
+            return [f"{pad}return {expr(ast.expr)}"]
+        case _:
+            raise NotImplementedError(f"stmt() not implemented for {type(ast)}")
+
+
+def expr(ast: asts.Expr) -> str:
+    match ast:
+        case asts.IntLiteral():
+            return str(int(ast.token.value))
+        case asts.BoolLiteral():
+            return "True" if ast.value else "False"
+        case asts.IdExpr():
+            return local(ast.id.symbol)
+        case asts.CallExpr():
+            args = ", ".join(expr(arg) for arg in ast.args)
+            return f"{pyname(ast.fn.id.token.value)}({args})"
+        case asts.BinaryOp():
+            return f"({expr(ast.left)} {_ops[ast.op.kind]} {expr(ast.right)})"
+        case asts.UnaryOp():
+            if ast.op.kind == "not":
+                return f"(not {expr(ast.expr)})"
+            return f"(-{expr(ast.expr)})"
+        case _:
+            raise NotImplementedError(f"expr() not implemented for {type(ast)}")
+
+
+# Compile the program and return its namespace; printed lines are
+# appended to out.
+def load(ast: asts.Program, out: List[str]) -> Dict[str, object]:
+    namespace = {"tau_print": out.append}
+    exec(compile(generate(ast), "<tau>", "exec"), namespace)
+    return namespace
+
+
+def run(ast: asts.Program, recursion: int = 20000) -> List[str]:
+    out = []
+    namespace = load(ast, out)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, recursion))
+    try:
+        namespace[pyname("main")]()
+    finally:
+        sys.setrecursionlimit(limit)
+    return out
@@ -0,0 +1,276 @@
+# Description: Code generation for the register VM
+#
+# Runs after offsets, in place of codegen, and produces a regvm.Program.
+# The frame slots that offsets assigned become fixed registers:
+# parameter i (offset -2-i) is register i, and the locals follow in
+# offset order.  Reading a variable therefore costs no instruction, and
+# an assignment computes its right-hand side straight into the
+# variable's register.
+#
+# Intermediate values go to virtual temporaries, a fresh one per value.
+# None of them lives past the statement that computes it, so in the
+# linear code each one has a single live interval.  After a function is
+# generated, a linear scan over those intervals maps the temporaries to
+# the registers after the fixed ones, reusing a register as soon as its
+# interval ends.  The register file is unbounded, so nothing is spilled.
+#
+# Conditions compile to compare-and-branch, and while loops are rotated
+# so each iteration runs a single conditional branch.
+
+import heapq
+from typing import Dict, List
+
+from tau import asts
+from tau.symbols import *
+import regvm
+
+_arith = {
+    "+": "ADD",
+    "-": "SUB",
+    "*": "MUL",
+    "/": "DIV",
+    "<": "LT",
+    "<=": "LE",
+    ">": "GT",
+    ">=": "GE",
+    "==": "EQ",
+    "!=": "NE",
+}
+_branch = {"<": "BLT", "<=": "BLE", ">": "BGT", ">=": "BGE", "==": "BEQ", "!=": "BNE"}
+_negate = {"<": ">=", ">=": "<", "<=": ">", ">": "<=", "==": "!=", "!=": "=="}
+
+
+def generate(ast: asts.Program) -> regvm.Program:
+    funcs = [_Func(decl) for decl in ast.decls]
+    numbers = {f.name: n for n, f in enumerate(funcs)}
+    program = regvm.Program(main=numbers["main"])
+    for f in funcs:
+        f.generate()
+        size = f.allocate()
+        base = len(program.code)
+        program.funcs.append((base, size))
+        program.names.append(f.name)
+        for insn in f.code:
+            kinds = regvm.OPS[insn[0]]
+            args = []
+            for kind, arg in zip(kinds, insn[1:]):
+                match kind:
+                    case "l":
+                        args.append(base + f.labels[arg])
+                    case "f":
+                        args.append(numbers[arg])
+                    case _:
+                        args.append(arg)
+            args += [0] * (3 - len(args))
+            program.code.append((regvm.OPCODE[insn[0]], *args))
+    return program
+
+
+def _locals(ast: asts.CompoundStmt) -> List[IdSymbol]:
+    syms = [decl.id.symbol for decl in ast.decls]
+    for s in ast.stmts:
+        match s:
+            case asts.CompoundStmt():
+                syms += _locals(s)
+            case asts.IfStmt():
+                syms += _locals(s.thenStmt)
+                if s.elseStmt is not None:
+                    syms += _locals(s.elseStmt)
+            case asts.WhileStmt():
+                syms += _locals(s.stmt)
+    return syms
+
+
+class _Func:
+    def __init__(self, ast: asts.FuncDecl):
+        self.ast = ast
+        self.name = ast.id.token.value
+        self.regs: Dict[int, int] = {}  # frame offset -> register
+        for i, param in enumerate(ast.params):
+            self.regs[param.id.symbol.offset] = i
+        for offset in sorted({sym.offset for sym in _locals(ast.body)}):
+            self.regs[offset] = len(self.regs)
+        self.fixed = len(self.regs)
+        self.temps = self.fixed  # next virtual temporary
+        self.code: List[list] = []  # [op name, operand, ...]
+        self.labels: Dict[str, int] = {}  # label -> index into code
+        self.nlabels = 0
+
+    def generate(self):
+        self.stmt(self.ast.body)
+        if not self.code or self.code[-1][0] not in ("RET", "RETV"):
+            self.emit("RETV")
+
+    # Maps the virtual temporaries to registers and returns the number of
+    # registers the function uses.
+    def allocate(self) -> int:
+        start: Dict[int, int] = {}
+        end: Dict[int, int] = {}
+        for i, insn in enumerate(self.code):
+            for reg in self._registers(insn):
+                if reg >= self.fixed:
+                    start.setdefault(reg, i)
+                    end[reg] = i
+        assigned: Dict[int, int] = {}
+        free: List[int] = []
+        active: List[tuple] = []  # (end, register) heap
+        used = 0
+        for temp in sorted(start, key=start.get):
+            # An instruction reads its operands before it writes, so a
+            # register whose interval ends here can be the destination.
+            while active and active[0][0] <= start[temp]:
+                heapq.heappush(free, heapq.heappop(active)[1])
+            if free:
+                reg = heapq.heappop(free)
+            else:
+                reg = self.fixed + used
+                used += 1
+            assigned[temp] = reg
+            heapq.heappush(active, (end[temp], reg))
+        for insn in self.code:
+            for j, kind in enumerate(regvm.OPS[insn[0]], 1):
+                if kind in "ds" and insn[j] >= self.fixed:
+                    insn[j] = assigned[insn[j]]
+                elif kind == "a":
+                    insn[j] = tuple(assigned.get(r, r) for r in insn[j])
+        return self.fixed + used
+
+    def _registers(self, insn: list) -> List[int]:
+        regs = []
+        for kind, arg in zip(regvm.OPS[insn[0]], insn[1:]):
+            if kind in "ds":
+                regs.append(arg)
+            elif kind == "a":
+                regs += arg
+        return regs
+
+    def emit(self, op: str, *args):
+        self.code.append([op, *args])
+
+    def temp(self) -> int:
+        self.temps += 1
+        return self.temps - 1
+
+    def label(self) -> str:
+        self.nlabels += 1
+        return f"L{self.nlabels - 1}"
+
+    def place(self, label: str):
+        self.labels[label] = len(self.code)
+
+    def stmt(self, ast: asts.Stmt):
+        match ast:
+            case asts.CompoundStmt():
+                for s in ast.stmts:
+                    self.stmt(s)
+            case asts.AssignStmt():
+                assert isinstance(ast.lhs, asts.IdExpr), "arrays are not supported"
+                self.expr(ast.rhs, self.regs[ast.lhs.id.symbol.offset])
+            case asts.IfStmt():
+                label_else = self.label()
+                self.control(ast.expr, label_else, False)
+                self.stmt(ast.thenStmt)
+                if ast.elseStmt is not None:
+                    label_exit = self.label()
+                    self.emit("JMP", label_exit)
+                    self.place(label_else)
+                    self.stmt(ast.elseStmt)
+                    self.place(label_exit)
+                else:
+                    self.place(label_else)
+            case asts.WhileStmt():
+                label_top = self.label()
+                label_test = self.label()
+                self.emit("JMP", label_test)
+                self.place(label_top)
+                self.stmt(ast.stmt)
+                self.place(label_test)
+                self.control(ast.expr, label_top, True)
+            case asts.CallStmt():
+                self.expr(ast.call)
+            case asts.PrintStmt():
+                self.emit("PRINT", self.expr(ast.expr))
+            case asts.ReturnStmt():
+                if ast.expr is None:
+                    self.emit("RETV")
+                else:
+                    self.emit("RET", self.expr(ast.expr))
+            case _:
+                raise NotImplementedError(f"stmt() not implemented for {type(ast)}")
+
+    # Jumps to label if e evaluates to sense.
+    def control(self, e: asts.Expr, label: str, sense: bool):
+        match e:
+            case asts.BoolLiteral():
+                if e.value == sense:
+                    self.emit("JMP", label)
+            case asts.UnaryOp() if e.op.kind == "not":
+                self.control(e.expr, label, not sense)
+            case asts.BinaryOp() if e.op.kind == "and":
+                if sense:
+                    exit = self.label()
+                    self.control(e.left, exit, False)
+                    self.control(e.right, label, True)
+                    self.place(exit)
+                else:
+                    self.control(e.left, label, False)
+                    self.control(e.right, label, False)
+            case asts.BinaryOp() if e.op.kind == "or":
+                if sense:
+                    self.control(e.left, label, True)
+                    self.control(e.right, label, True)
+                else:
+                    exit = self.label()
+                    self.control(e.left, exit, True)
+                    self.control(e.right, label, False)
+                    self.place(exit)
+            case asts.BinaryOp() if e.op.kind in _branch:
+                left = self.expr(e.left)
+                right = self.expr(e.right)
+                kind = e.op.kind if sense else _negate[e.op.kind]
+                self.emit(_branch[kind], left, right, label)
+            case _:
+                self.emit("JNZ" if sense else "JZ", self.expr(e), label)
+
+    # Evaluates e and returns the register holding its value, which is
+    # dest when given.
+    def expr(self, e: asts.Expr, dest: int = None) -> int:
+        match e:
+            case asts.IdExpr():
+                reg = self.regs[e.id.symbol.offset]
+                if dest is None or dest == reg:
+                    return reg
+                self.emit("MOV", dest, reg)
+                return dest
+            case asts.IntLiteral():
+                dest = self.temp() if dest is None else dest
+                self.emit("LI", dest, int(e.token.value))
+            case asts.BoolLiteral():
+                dest = self.temp() if dest is None else dest
+                self.emit("LI", dest, 1 if e.value else 0)
+            case asts.CallExpr():
+                args = tuple(self.expr(arg) for arg in e.args)
+                dest = self.temp() if dest is None else dest
+                self.emit("CALL", dest, e.fn.id.token.value, args)
+            case asts.BinaryOp() if e.op.kind in _arith:
+                left = self.expr(e.left)
+                right = self.expr(e.right)
+                dest = self.temp() if dest is None else dest
+                self.emit(_arith[e.op.kind], dest, left, right)
+            case asts.BinaryOp() if e.op.kind in ("and", "or"):
+                dest = self.temp() if dest is None else dest
+                label_false = self.label()
+                label_exit = self.label()
+                self.control(e, label_false, False)
+                self.emit("LI", dest, 1)
+                self.emit("JMP", label_exit)
+                self.place(label_false)
+                self.emit("LI", dest, 0)
+                self.place(label_exit)
+            case asts.UnaryOp():
+                value = self.expr(e.expr)
+                dest = self.temp() if dest is None else dest
+                self.emit("NOT" if e.op.kind == "not" else "NEG", dest, value)
+            case _:
+                raise NotImplementedError(f"expr() not implemented for {type(e)}")
+        return dest
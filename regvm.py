@@ -0,0 +1,202 @@
+# Description: Three-address register VM
+#
+# Code is a flat list of (op, a, b, c) tuples.  Every function call gets
+# a fresh register list of the size its code needs; parameters arrive in
+# registers 0..n-1.  CALL takes the callee's number and a tuple of
+# argument registers and puts the result in its destination register
+# once the callee executes RET.  Running main's RET ends the program.
+#
+# Values follow the stack VM: / floors, comparisons and NOT give 1 or 0.
+# Registers start at 0.
+
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from interp import MachineError
+
+# Operand kinds, per op: d destination register, s source register,
+# i immediate, l code address, f function number, a argument registers.
+OPS = {
+    "LI": "di",
+    "MOV": "ds",
+    "ADD": "dss",
+    "SUB": "dss",
+    "MUL": "dss",
+    "DIV": "dss",
+    "LT": "dss",
+    "LE": "dss",
+    "GT": "dss",
+    "GE": "dss",
+    "EQ": "dss",
+    "NE": "dss",
+    "NEG": "ds",
+    "NOT": "ds",
+    "JMP": "l",
+    "JZ": "sl",
+    "JNZ": "sl",
+    "BLT": "ssl",
+    "BLE": "ssl",
+    "BGT": "ssl",
+    "BGE": "ssl",
+    "BEQ": "ssl",
+    "BNE": "ssl",
+    "CALL": "dfa",
+    "RET": "s",
+    "RETV": "",
+    "PRINT": "s",
+}
+OPCODES = list(OPS)
+OPCODE = {op: i for i, op in enumerate(OPCODES)}
+
+LI = OPCODE["LI"]
+MOV = OPCODE["MOV"]
+ADD = OPCODE["ADD"]
+SUB = OPCODE["SUB"]
+MUL = OPCODE["MUL"]
+DIV = OPCODE["DIV"]
+LT = OPCODE["LT"]
+LE = OPCODE["LE"]
+GT = OPCODE["GT"]
+GE = OPCODE["GE"]
+EQ = OPCODE["EQ"]
+NE = OPCODE["NE"]
+NEG = OPCODE["NEG"]
+NOT = OPCODE["NOT"]
+JMP = OPCODE["JMP"]
+JZ = OPCODE["JZ"]
+JNZ = OPCODE["JNZ"]
+BLT = OPCODE["BLT"]
+BLE = OPCODE["BLE"]
+BGT = OPCODE["BGT"]
+BGE = OPCODE["BGE"]
+BEQ = OPCODE["BEQ"]
+BNE = OPCODE["BNE"]
+CALL = OPCODE["CALL"]
+RET = OPCODE["RET"]
+RETV = OPCODE["RETV"]
+PRINT = OPCODE["PRINT"]
+
+
+@dataclass
+class Program:
+    code: List[Tuple] = field(default_factory=list)
+    funcs: List[Tuple[int, int]] = field(default_factory=list)  # (entry, registers) by number
+    names: List[str] = field(default_factory=list)  # function name by number
+    main: int = 0
+
+
+@dataclass
+class Result:
+    output: List[str] = field(default_factory=list)
+    steps: int = 0  # instructions executed
+    depth: int = 0  # deepest call nesting
+    registers: int = 0  # most registers live at once, over all frames
+
+
+def dump(program: Program) -> str:
+    entries = {entry: n for n, (entry, _) in enumerate(program.funcs)}
+    lines = []
+    for pc, (op, a, b, c) in enumerate(program.code):
+        if pc in entries:
+            n = entries[pc]
+            lines.append(f"{program.names[n]}:  ; {program.funcs[n][1]} registers")
+        name = OPCODES[op]
+        operands = [a, b, c][: len(OPS[name])]
+        lines.append(f"{pc:6}  {name} " + ", ".join(str(x) for x in operands))
+    return "\n".join(lines) + "\n"
+
+
+def run(program: Program) -> Result:
+    code = program.code
+    funcs = program.funcs
+    entry, size = funcs[program.main]
+    r = [0] * size
+    pc = entry
+    frames = []
+    out = []
+    steps = 0
+    live = peak = size
+    deepest = 0
+    while True:
+        op, a, b, c = code[pc]
+        pc += 1
+        steps += 1
+        if op == MOV:
+            r[a] = r[b]
+        elif op == ADD:
+            r[a] = r[b] + r[c]
+        elif op == LI:
+            r[a] = b
+        elif op == BLT:
+            if r[a] < r[b]:
+                pc = c
+        elif op == BGE:
+            if r[a] >= r[b]:
+                pc = c
+        elif op == SUB:
+            r[a] = r[b] - r[c]
+        elif op == MUL:
+            r[a] = r[b] * r[c]
+        elif op == JMP:
+            pc = a
+        elif op == BLE:
+            if r[a] <= r[b]:
+                pc = c
+        elif op == BGT:
+            if r[a] > r[b]:
+                pc = c
+        elif op == BEQ:
+            if r[a] == r[b]:
+                pc = c
+        elif op == BNE:
+            if r[a] != r[b]:
+                pc = c
+        elif op == JZ:
+            if r[a] == 0:
+                pc = b
+        elif op == JNZ:
+            if r[a] != 0:
+                pc = b
+        elif op == CALL:
+            entry, size = funcs[b]
+            regs = [0] * size
+            for i, s in enumerate(c):
+                regs[i] = r[s]
+            frames.append((pc, r, a))
+            r = regs
+            pc = entry
+            live += size
+            if live > peak:
+                peak = live
+            if len(frames) > deepest:
+                deepest = len(frames)
+        elif op == RET or op == RETV:
+            value = r[a] if op == RET else 0
+            if not frames:
+                break
+            live -= len(r)
+            pc, r, dest = frames.pop()
+            r[dest] = value
+        elif op == DIV:
+            r[a] = r[b] // r[c]
+        elif op == LT:
+            r[a] = 1 if r[b] < r[c] else 0
+        elif op == LE:
+            r[a] = 1 if r[b] <= r[c] else 0
+        elif op == GT:
+            r[a] = 1 if r[b] > r[c] else 0
+        elif op == GE:
+            r[a] = 1 if r[b] >= r[c] else 0
+        elif op == EQ:
+            r[a] = 1 if r[b] == r[c] else 0
+        elif op == NE:
+            r[a] = 1 if r[b] != r[c] else 0
+        elif op == NEG:
+            r[a] = -r[b]
+        elif op == NOT:
+            r[a] = 1 if r[b] == 0 else 0
+        elif op == PRINT:
+            out.append(str(r[a]))
+        else:
+            raise MachineError(f"bad register opcode {op}")
+    return Result(out, steps, deepest, peak)
@@ -0,0 +1,149 @@
+# Description: Sethi-Ullman ordering of expression operands
+#
+# codegen evaluates the left operand of a BinaryOp first, and the value
+# stays on the eval stack while the right one is computed, so an
+# expression needs max(need(left), need(right) + 1) stack slots.  When
+# the right operand is the heavier one and the operator lets the
+# operands change places, evaluating it first needs fewer:
+#
+#   + * == !=      operands are swapped
+#   < <= > >=      operands are swapped and the comparison flipped
+#
+# Operands are only reordered when neither contains a call, the one
+# thing whose order can be observed.  and/or are never reordered, since
+# they short-circuit.  Runs on the typed AST anywhere before codegen.
+
+from dataclasses import dataclass
+from typing import List
+
+from tau import asts
+from tau.tokens import Token
+
+# The operator that gives the same result with the operands swapped.
+_swapped = {
+    "+": "+",
+    "*": "*",
+    "==": "==",
+    "!=": "!=",
+    "<": ">",
+    ">": "<",
+    "<=": ">=",
+    ">=": "<=",
+}
+
+
+@dataclass
+class FuncStats:
+    name: str
+    swapped: int = 0
+    flipped: int = 0  # swaps that also flipped a comparison
+    depth_before: int = 0  # deepest expression, in eval-stack slots
+    depth_after: int = 0
+
+
+def process(ast: asts.Program) -> List[FuncStats]:
+    return [funcdecl(decl) for decl in ast.decls]
+
+
+def funcdecl(ast: asts.FuncDecl) -> FuncStats:
+    stats = FuncStats(ast.id.token.value)
+    stmt(ast.body, stats)
+    return stats
+
+
+def report(stats: List[FuncStats]) -> str:
+    lines = [f"{'function':<20} {'swapped':>7} {'flipped':>7} {'depth':>9}"]
+    for s in stats:
+        lines.append(f"{s.name:<20} {s.swapped:>7} {s.flipped:>7} {s.depth_before:>4} {s.depth_after:>4}")
+    return "\n".join(lines)
+
+
+def stmt(ast: asts.Stmt, stats: FuncStats):
+    match ast:
+        case asts.CompoundStmt():
+            for s in ast.stmts:
+                stmt(s, stats)
+        case asts.AssignStmt():
+            _root(ast.lhs, stats)
+            _root(ast.rhs, stats)
+        case asts.IfStmt():
+            _root(ast.expr, stats)
+            stmt(ast.thenStmt, stats)
+            if ast.elseStmt is not None:
+                stmt(ast.elseStmt, stats)
+        case asts.WhileStmt():
+            _root(ast.expr, stats)
+            stmt(ast.stmt, stats)
+        case asts.CallStmt():
+            _root(ast.call, stats)
+        case asts.PrintStmt():
+            _root(ast.expr, stats)
+        case asts.ReturnStmt():
+            if ast.expr is not None:
+                _root(ast.expr, stats)
+        case _:
+            raise NotImplementedError(f"stmt() not implemented for {type(ast)}")
+
+
+def _root(e: asts.Expr, stats: FuncStats):
+    stats.depth_before = max(stats.depth_before, need(e))
+    stats.depth_after = max(stats.depth_after, expr(e, stats))
+
+
+# Reorders the operands below e and returns what e then needs.
+def expr(e: asts.Expr, stats: FuncStats) -> int:
+    match e:
+        case asts.BinaryOp() if e.op.kind in ("and", "or"):
+            return max(expr(e.left, stats), expr(e.right, stats))
+        case asts.BinaryOp():
+            left = expr(e.left, stats)
+            right = expr(e.right, stats)
+            if right > left and e.op.kind in _swapped and not _calls(e.left) and not _calls(e.right):
+                kind = _swapped[e.op.kind]
+                if kind != e.op.kind:
+                    e.op = Token(kind, kind, e.op.span)
+                    stats.flipped += 1
+                e.left, e.right = e.right, e.left
+                left, right = right, left
+                stats.swapped += 1
+            return max(left, right + 1)
+        case asts.UnaryOp():
+            return expr(e.expr, stats)
+        case asts.CallExpr():
+            return max([2] + [1 + expr(arg, stats) for arg in e.args])
+        case asts.ArrayCell():
+            return max(expr(e.arr, stats), expr(e.idx, stats) + 1)
+        case _:
+            return 1
+
+
+# Eval-stack slots codegen needs for e as it stands: a call stores each
+# argument through an address pushed before it.
+def need(e: asts.Expr) -> int:
+    match e:
+        case asts.BinaryOp() if e.op.kind in ("and", "or"):
+            return max(need(e.left), need(e.right))
+        case asts.BinaryOp():
+            return max(need(e.left), need(e.right) + 1)
+        case asts.UnaryOp():
+            return need(e.expr)
+        case asts.CallExpr():
+            return max([2] + [1 + need(arg) for arg in e.args])
+        case asts.ArrayCell():
+            return max(need(e.arr), need(e.idx) + 1)
+        case _:
+            return 1
+
+
+def _calls(e: asts.Expr) -> bool:
+    match e:
+        case asts.CallExpr():
+            return True
+        case asts.BinaryOp():
+            return _calls(e.left) or _calls(e.right)
+        case asts.UnaryOp():
+            return _calls(e.expr)
+        case asts.ArrayCell():
+            return _calls(e.arr) or _calls(e.idx)
+        case _:
+            return False
@@ -0,0 +1,255 @@
+# Description: Compile server
+#
+# A long running process that answers client.py's compile, check and run
+# requests on a Unix socket, so that a compile does not pay for starting
+# the interpreter and importing the compiler.  The protocol is described
+# in client.py.
+#
+# The server is an asyncio loop: every connection is served on its own,
+# and every request on a connection as a task of its own, so a slow
+# request does not hold up the ones behind it; the responses carry the
+# request's id.  The compiling and running is CPU bound and is handed to
+# a pool of worker processes that import the compiler once
+# (tauc.warm()).  Each worker keeps the stage artifacts it built or read
+# in memory, in front of tauc's cache directory, so a program that was
+# compiled before (by this worker, or by any tauc run) is answered from
+# its bytecode, and a change of options starts from its checked AST.
+# The unit is the whole program: functions are bound and checked against
+# the declarations of the whole program, so there is no smaller one.
+#
+# A request line longer than LIMIT, one that is not JSON, or one that is
+# not a JSON object is answered with an error; the connection stays open.
+#
+# usage: python server.py [--socket PATH] [-j N] [--cache-dir DIR] [--no-cache] [--memory N]
+
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import os
+import socket
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import tauc
+from client import SOCKET
+
+MEMORY = 1024  # artifacts each worker keeps in memory
+LIMIT = 1 << 26  # longest request line, in bytes
+
+_cache: Optional["MemoryCache"] = None
+
+
+# tauc's cache with the most recently used artifacts kept in memory, as
+# the pickled bytes, since later stages change the AST they are given.
+class MemoryCache(tauc.Cache):
+    def __init__(self, path: Optional[str], capacity: int = MEMORY):
+        super().__init__(path)
+        self.capacity = capacity
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def has(self, key: str) -> bool:
+        return key in self.entries or super().has(key)
+
+    def load(self, key: str) -> bytes:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        data = super().load(key)
+        self._keep(key, data)
+        return data
+
+    def store(self, key: str, data: bytes):
+        self._keep(key, data)
+        super().store(key, data)
+
+    def _keep(self, key: str, data: bytes):
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+# Runs once in every worker.
+def _start(cache_dir: Optional[str], capacity: int):
+    global _cache
+    _cache = MemoryCache(cache_dir, capacity)
+    tauc.warm()
+
+
+# Runs in a worker.  Never raises: a failure is the response.
+def _work(op: str, source: str, options: tauc.Options) -> dict:
+    import bytecode
+    import interp
+
+    for stage in tauc.STAGES:
+        _cache.hits[stage] = _cache.misses[stage] = 0
+    response = {"ok": True}
+    start = time.perf_counter()
+    try:
+        if op == "check":
+            _, response["started"] = tauc.produce(source, options, _cache, "typecheck")
+        else:
+            built = tauc.build(source, options, _cache)
+            response["started"] = built.started
+            if op == "compile":
+                response["bytecode"] = base64.b64encode(built.data).decode()
+                response["debug"] = base64.b64encode(built.debug).decode() if built.debug is not None else None
+            else:
+                result = interp.run(bytecode.loads(built.data).image())
+                response["output"] = result.output
+                response["steps"] = result.steps
+    except (Exception, SystemExit) as e:
+        response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    response["seconds"] = time.perf_counter() - start
+    response["hits"] = dict(_cache.hits)
+    response["misses"] = dict(_cache.misses)
+    return response
+
+
+class Server:
+    def __init__(self, path: str, cache_dir: Optional[str], jobs: Optional[int] = None, capacity: int = MEMORY):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.jobs = jobs or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(self.jobs, initializer=_start, initargs=(cache_dir, capacity))
+        self.stats: Dict[str, object] = {"requests": {}, "errors": 0, "seconds": 0.0}
+        self.cache = tauc.Cache(cache_dir)  # hits and misses of all workers
+        self.done = asyncio.Event()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            if _listening(self.path):
+                raise RuntimeError(f"a server is already listening on {self.path}")
+            os.remove(self.path)
+        # Start the workers now rather than on the first request.
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, tauc.fingerprint) for _ in range(self.jobs)])
+        server = await asyncio.start_unix_server(self.connection, self.path, limit=LIMIT)
+        try:
+            async with server:
+                await self.done.wait()
+        finally:
+            os.remove(self.path)
+            self.pool.shutdown(cancel_futures=True)
+            self.cache.save_stats()
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:  # the last line may lack its newline
+                    line = e.partial
+                    if not line:
+                        break
+                except asyncio.LimitOverrunError as e:
+                    await _skip_line(reader, e.consumed)
+                    line = None
+                task = asyncio.create_task(self.answer(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:  # the server is shutting down
+            pass
+        finally:
+            writer.close()
+
+    # line is None for a request longer than LIMIT.
+    async def answer(self, line: Optional[bytes], writer: asyncio.StreamWriter, lock: asyncio.Lock):
+        try:
+            if line is None:
+                raise ValueError(f"longer than {LIMIT} bytes")
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise TypeError("not a JSON object")
+            response = await self.handle(message)
+            response["id"] = message.get("id")
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"ok": False, "error": f"bad request: {e}"}
+        async with lock:
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+
+    async def handle(self, message: dict) -> dict:
+        op = message["op"]
+        requests = self.stats["requests"]
+        requests[op] = requests.get(op, 0) + 1
+        match op:
+            case "stats":
+                cache = {
+                    stage: {"hits": self.cache.hits[stage], "misses": self.cache.misses[stage]}
+                    for stage in tauc.STAGES
+                }
+                return {"ok": True, "stats": {**self.stats, "cache": cache}}
+            case "shutdown":
+                self.done.set()
+                return {"ok": True}
+            case "compile" | "check" | "run":
+                options = tauc.Options(**message.get("options", {}))
+                if options.lean and (options.memo or options.profile):
+                    return {"ok": False, "error": "lean cannot be combined with memo or profile"}
+                loop = asyncio.get_running_loop()
+                work = functools.partial(_work, op, message["source"], options)
+                try:
+                    response = await loop.run_in_executor(self.pool, work)
+                except Exception as e:  # the worker died
+                    self.stats["errors"] += 1
+                    return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                for stage in tauc.STAGES:
+                    self.cache.hits[stage] += response["hits"][stage]
+                    self.cache.misses[stage] += response["misses"][stage]
+                self.stats["errors"] += not response["ok"]
+                self.stats["seconds"] += response["seconds"]
+                return response
+        raise ValueError(f"unknown op {op!r}")
+
+
+# Drops the rest of a line readuntil() found too long, consumed bytes of
+# which are buffered.
+async def _skip_line(reader: asyncio.StreamReader, consumed: int):
+    while True:
+        await reader.readexactly(consumed)
+        try:
+            await reader.readuntil(b"\n")
+            return
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+
+
+def _listening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Serve Tau compile requests on a Unix socket.")
+    parser.add_argument("--socket", default=SOCKET)
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--cache-dir", default=tauc.CACHE)
+    parser.add_argument("--no-cache", action="store_true", help="keep artifacts in memory only")
+    parser.add_argument("--memory", type=int, default=MEMORY, help="artifacts each worker keeps in memory")
+    args = parser.parse_args(argv)
+    server = Server(args.socket, None if args.no_cache else args.cache_dir, args.jobs, args.memory)
+    print(f"listening on {args.socket}", file=sys.stderr)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+# Description: Static eval-stack depth analysis
+#
+# Walks every function's instructions from its entry label, following
+# fall-through and jumps, and gives each instruction the eval-stack
+# depth it runs at, counted from the stack the function was called with
+# (whose top is the return address).  The walk checks that the depth
+# never goes negative, that every path reaching a label arrives with the
+# same depth, and that every return leaves exactly the function's result
+# behind (nothing with codegen's usual convention, one value with the
+# lean one).
+#
+# A Frame records a function's maximum depth and, for each call it
+# makes, how many values it holds on the stack across the call.  With
+# those, bound() gives the largest eval stack the whole program can use,
+# unless functions are recursive or called indirectly, and annotate()
+# stores both in a link.Image for the interpreter.
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from tau.vm.vm import Insn
+import insns
+from link import Image
+
+ENTRY = ""  # name of the code before the first function
+
+
+class StackError(Exception):
+    pass
+
+
+@dataclass
+class Frame:
+    name: str
+    depth: int = 0  # maximum eval-stack depth
+    calls: List[Tuple[int, Optional[str]]] = field(default_factory=list)  # (held, callee or None)
+
+
+def analyze(code: List[Insn], effects: Dict[str, Tuple[int, int]] = insns.EFFECTS) -> Dict[str, Frame]:
+    labels = {insns.operand(insn): i for i, insn in enumerate(code) if insns.name(insn) == "Label"}
+    entries = {insns.operand(insn) for insn in code if insns.name(insn) == "PushLabel"}
+    frames = {ENTRY: _walk(code, ENTRY, 0, 0, labels, effects)}
+    for name in sorted(entries, key=labels.get):
+        frames[name] = _walk(code, name, labels[name], 1, labels, effects)
+    return frames
+
+
+def _walk(
+    code: List[Insn],
+    name: str,
+    start: int,
+    depth: int,
+    labels: Dict[str, int],
+    effects: Dict[str, Tuple[int, int]],
+) -> Frame:
+    frame = Frame(name, depth)
+    results = effects["Call"][1]
+    at: Dict[int, int] = {start: depth}
+    work = [start]
+    while work:
+        i = work.pop()
+        depth = at[i]
+        while i < len(code):
+            insn = code[i]
+            op = insns.name(insn)
+            if op not in effects:
+                raise StackError(f"{name}: {op} at {i} is not supported")
+            pops, pushes = effects[op]
+            if depth < pops:
+                raise StackError(f"{name}: {op} at {i} pops an empty stack")
+            if op in ("Call", "MemoCall"):
+                before = insns.name(code[i - 1]) if i > 0 else None
+                callee = insns.operand(code[i - 1]) if before == "PushLabel" else None
+                frame.calls.append((depth - pops, callee))
+            depth += pushes - pops
+            frame.depth = max(frame.depth, depth)
+            if op == "JumpIndirect" and depth != results:
+                raise StackError(f"{name}: returns at {i} with {depth} values on the stack")
+            targets = [labels[insns.operand(insn)]] if op in insns.JUMPS else []
+            if op not in insns.ENDS:
+                targets.append(i + 1)
+            i = None
+            for target in targets:
+                if target not in at:
+                    at[target] = depth
+                    if i is None:
+                        i = target
+                    else:
+                        work.append(target)
+                elif at[target] != depth:
+                    where = insns.operand(code[target]) if target < len(code) else "the end"
+                    raise StackError(f"{name}: depths {at[target]} and {depth} meet at {where}")
+            if i is None:
+                break
+    return frame
+
+
+# The deepest the eval stack gets from the program's entry on, or None
+# if it depends on how deep the calls go.
+def bound(frames: Dict[str, Frame]) -> Optional[int]:
+    total: Dict[str, Optional[int]] = {}
+
+    def need(name: str, active: set) -> Optional[int]:
+        if name in active or name not in frames:
+            return None
+        if name not in total:
+            active.add(name)
+            deepest = frames[name].depth
+            for held, callee in frames[name].calls:
+                inner = need(callee, active) if callee is not None else None
+                if inner is None:
+                    deepest = None
+                    break
+                deepest = max(deepest, held + inner)
+            active.discard(name)
+            total[name] = deepest
+        return total[name]
+
+    return need(ENTRY, set())
+
+
+def annotate(image: Image, frames: Dict[str, Frame]):
+    image.depths = {name: f.depth for name, f in frames.items() if name != ENTRY}
+    image.stack = bound(frames) or 0
+
+
+def report(frames: Dict[str, Frame]) -> str:
+    lines = [f"{'function':<16} {'depth':>5} {'calls':>5}"]
+    for name, f in frames.items():
+        lines.append(f"{name or '(entry)':<16} {f.depth:>5} {len(f.calls):>5}")
+    total = bound(frames)
+    lines.append(f"program stack: {'unbounded (recursive or indirect calls)' if total is None else total}")
+    return "\n".join(lines) + "\n"
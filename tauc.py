@@ -0,0 +1,403 @@
+# Description: Compiler driver with a stage cache
+#
+# tauc runs the stages of the compiler in order,
+#
+#   parse      Scanner and Parser: source -> AST
+#   bindings   bindings.process
+#   typecheck  typecheck.process
+#   optimize   the AST passes of the -O level and the pass flags
+#   offsets    offsets.process, then the late passes
+#   codegen    codegen.generate, or pgo.optimize with a profile
+#   link       the code passes, link, stackdepth and bytecode encoding;
+#              the artifact is the bytecode file and, with -g, its
+#              debuginfo sidecar
+#
+# (passes.py has the passes and the -O levels), and stores every stage's
+# artifact in a cache directory, pickled, under the hash of its inputs:
+# the previous stage's key and the options that change what this stage
+# does.  The first key hashes the source and the .py files of the
+# compiler and of the tau package, so editing either invalidates
+# everything.  Since keys only depend on the source and the options, a
+# build looks for the last stage it has an artifact for and only runs
+# the stages after it: an unchanged program goes straight to its
+# bytecode, and a change of optimizer flags starts from the checked AST.
+#
+# A stage is a hit when the build started from its artifact or a later
+# one, so it did not run, and a miss when it ran.  Both are counted per
+# stage, for this run and, in stats.json in the cache directory, over all
+# runs.  Scanning is not a stage of its own: the scanner is lazy and runs
+# as the parser pulls tokens, so its time shows up as the "scan" phase
+# under "parse" with --time.
+#
+# --pass-stats compiles the program once more, uncached, measuring every
+# pass (passes.report()), and --verify checks that it prints what it
+# prints at -O0 (passes.differential()).
+#
+# usage: python tauc.py [options] file.tau
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import bytecode
+import debuginfo
+import instrument
+import interp
+import link
+import passes
+
+CACHE = ".tauc-cache"
+STAGES = ["parse", "bindings", "typecheck", "optimize", "offsets", "codegen", "link"]
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_fingerprint: Optional[str] = None
+
+
+@dataclass
+class Options:
+    fold: bool = False  # consteval
+    schedule: bool = False
+    lean: bool = False
+    memo: bool = False
+    profile: Optional[str] = None  # pgo profile file
+    fuse: bool = False
+    cfg: bool = False
+    debug: bool = False  # debug info and label names
+    level: int = 0  # -O
+
+    # The passes to run, in order.  With a profile, pgo.optimize() has
+    # laid out the blocks by it already, and cfg would undo that.
+    def selected(self) -> List[str]:
+        extra = [name for name in ("fold", "schedule", "cfg", "fuse") if getattr(self, name)]
+        names = passes.select(self.level, extra)
+        return [name for name in names if not (self.profile and name == "cfg")]
+
+    def _at(self, point: str) -> str:
+        return ",".join(name for name in self.selected() if passes.PASSES[name].point == point)
+
+    # What stage depends on, as text to hash.
+    def key(self, stage: str) -> str:
+        match stage:
+            case "optimize":
+                return self._at("ast")
+            case "offsets":
+                return self._at("late")
+            case "codegen":
+                profile = _digest(_read(self.profile)) if self.profile else None
+                return f"lean={self.lean} memo={self.memo} profile={profile} debug={self.debug}"
+            case "link":
+                return f"{self._at('code')} debug={self.debug}"
+        return ""
+
+    def manager(self) -> passes.Manager:
+        return passes.Manager(self.selected(), self.lean, self.memo)
+
+
+@dataclass
+class Build:
+    data: bytes  # the bytecode file
+    debug: Optional[bytes] = None  # its debuginfo sidecar, with --debug
+    started: Optional[str] = None  # stage whose cached artifact was used
+
+
+class Cache:
+    def __init__(self, path: Optional[str]):
+        self.path = path  # None disables the cache
+        self.hits: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.misses: Dict[str, int] = {stage: 0 for stage in STAGES}
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key[2:] + ".pkl")
+
+    def has(self, key: str) -> bool:
+        return self.path is not None and os.path.exists(self._file(key))
+
+    def get(self, key: str):
+        return pickle.loads(self.load(key))
+
+    def put(self, key: str, artifact):
+        try:
+            data = pickle.dumps(artifact, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+            return
+        self.store(key, data)
+
+    def load(self, key: str) -> bytes:
+        return _read(self._file(key))
+
+    # Written to a temporary file and renamed, so that concurrent builds
+    # never see half an artifact.
+    def store(self, key: str, data: bytes):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self._file(key)), exist_ok=True)
+        tmp = f"{self._file(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._file(key))
+
+    # Adds this run's counts to stats.json and returns the totals.
+    def save_stats(self) -> Dict[str, Dict[str, int]]:
+        totals = {stage: {"hits": 0, "misses": 0} for stage in STAGES}
+        if self.path is None:
+            return totals
+        stats = os.path.join(self.path, "stats.json")
+        if os.path.exists(stats):
+            with open(stats) as f:
+                totals.update(json.load(f))
+        for stage in STAGES:
+            totals[stage]["hits"] += self.hits[stage]
+            totals[stage]["misses"] += self.misses[stage]
+        os.makedirs(self.path, exist_ok=True)
+        with open(stats + ".tmp", "w") as f:
+            json.dump(totals, f, indent=1)
+        os.replace(stats + ".tmp", stats)
+        return totals
+
+    def report(self, totals: Optional[Dict[str, Dict[str, int]]] = None) -> str:
+        lines = [f"{'stage':<10} {'hits':>6} {'misses':>6}" + (f" {'total hit rate':>15}" if totals else "")]
+        for stage in STAGES:
+            line = f"{stage:<10} {self.hits[stage]:>6} {self.misses[stage]:>6}"
+            if totals:
+                n = totals[stage]["hits"] + totals[stage]["misses"]
+                line += f" {totals[stage]['hits'] / n if n else 0.0:>15.1%}"
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# Imports the modules of every stage and hashes the compiler, so that
+# the first build() of a long running process does not pay for it.
+def warm():
+    import bindings
+    import codegen
+    import memo
+    import offsets
+    import parse
+    import pgo
+    import scanner
+    import stackdepth
+    import typecheck
+
+    fingerprint()
+
+
+# Hash of the compiler itself: every .py file next to this one, and
+# those of the tau package the stages import (asts, symbols, the vm).
+def fingerprint() -> str:
+    global _fingerprint
+    if _fingerprint is None:
+        import tau
+
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(_HERE)):
+            if name.endswith(".py"):
+                h.update(name.encode() + b"\0" + _read(os.path.join(_HERE, name)))
+        for top in tau.__path__:
+            for root, dirs, names in os.walk(top):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.endswith(".py"):
+                        path = os.path.join(root, name)
+                        h.update(os.path.relpath(path, top).encode() + b"\0" + _read(path))
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+def keys(source: str, options: Options) -> List[str]:
+    key = _digest(fingerprint().encode() + source.encode())
+    found = []
+    for stage in STAGES:
+        key = _digest(f"{key}\0{stage}\0{options.key(stage)}".encode())
+        found.append(key)
+    return found
+
+
+def _stage(stage: str, artifact, source: str, options: Options):
+    import bindings
+    import codegen
+    import memo
+    import offsets
+    import pgo
+    import stackdepth
+    import typecheck
+    from parse import Parser
+    from scanner import Scanner
+
+    match stage:
+        case "parse":
+            return Parser(instrument.scanner(Scanner(source))).parse()
+        case "bindings":
+            bindings.process(artifact)
+        case "typecheck":
+            typecheck.process(artifact)
+        case "optimize":
+            options.manager().run("ast", artifact)
+        case "offsets":
+            offsets.process(artifact)
+            options.manager().run("late", artifact)
+        case "codegen":
+            ast = artifact
+            spans = [] if options.debug else None
+            if options.profile:
+                code, _ = pgo.optimize(ast, pgo.Profile.load(options.profile), spans)
+            else:
+                code = codegen.generate(ast, options.lean, memo.candidates(ast) if options.memo else (), spans)
+            frames = debuginfo.layouts(ast) if options.debug else None
+            return code, spans, frames
+        case "link":
+            code, spans, frames = artifact
+            manager = options.manager()
+            if spans is not None:
+                # Passes keep the instruction objects they do not replace.
+                by_id = {id(insn): span for insn, span in zip(code, spans)}
+                original = code
+            code = manager.run("code", code)
+            if spans is not None:
+                spans = [by_id.get(id(insn)) for insn in code]
+                del original
+            image = link.link(code, spans)
+            stackdepth.annotate(image, stackdepth.analyze(code, manager.effects))
+            data = bytecode.encode_image(image, options.debug)
+            if not options.debug:
+                return data, None
+            info = debuginfo.DebugInfo(debuginfo.checksum(image), debuginfo.line_table(image.spans), frames)
+            return data, debuginfo.encode(info)
+    return artifact
+
+
+# The artifact of stage (and of the stages before it) for source, and
+# the stage the cached artifact it started from belongs to.
+def produce(source: str, options: Options, cache: Cache, stage: str = "link") -> Tuple[object, Optional[str]]:
+    last = STAGES.index(stage)
+    stage_keys = keys(source, options)
+    start = 0
+    artifact = None
+    started = None
+    for i in reversed(range(last + 1)):
+        if cache.has(stage_keys[i]):
+            artifact = cache.get(stage_keys[i])
+            for skipped in STAGES[: i + 1]:
+                cache.hits[skipped] += 1
+            started = STAGES[i]
+            start = i + 1
+            break
+    for i in range(start, last + 1):
+        with instrument.phase(STAGES[i]) as p:
+            artifact = _stage(STAGES[i], artifact, source, options)
+            p.result(artifact if STAGES[i] != "codegen" else artifact[0])
+        cache.misses[STAGES[i]] += 1
+        cache.put(stage_keys[i], artifact)
+    return artifact, started
+
+
+def build(source: str, options: Options, cache: Cache) -> Build:
+    (data, debug), started = produce(source, options, cache)
+    return Build(data, debug, started)
+
+
+# The compiler options and cache flags, for tauc and the tools that
+# compile through build().
+def add_options(parser: argparse.ArgumentParser):
+    parser.add_argument("-O", dest="level", type=int, choices=sorted(passes.LEVELS), default=0, help="optimization level")
+    parser.add_argument("--fold", action="store_true", help="evaluate pure calls at compile time")
+    parser.add_argument("--schedule", action="store_true", help="reorder operands to save stack")
+    parser.add_argument("--lean", action="store_true", help="use the lean calling convention")
+    parser.add_argument("--memo", action="store_true", help="memoize pure recursive functions")
+    parser.add_argument("--profile", metavar="FILE", help="optimize with a pgo profile")
+    parser.add_argument("--fuse", action="store_true", help="select superinstructions")
+    parser.add_argument("--cfg", action="store_true", help="thread jumps and lay out blocks")
+    parser.add_argument("--cache-dir", default=CACHE)
+    parser.add_argument("--no-cache", action="store_true")
+
+
+def parse_options(parser: argparse.ArgumentParser, args: argparse.Namespace) -> Options:
+    if args.lean and (args.memo or args.profile):
+        parser.error("--lean cannot be combined with --memo or --profile")
+    return Options(
+        args.fold,
+        args.schedule,
+        args.lean,
+        args.memo,
+        args.profile,
+        args.fuse,
+        args.cfg,
+        getattr(args, "debug", False),
+        args.level,
+    )
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Compile a Tau program.")
+    parser.add_argument("file")
+    parser.add_argument("-o", "--output", help="bytecode file to write (default: file with .taub)")
+    parser.add_argument("--run", action="store_true", help="run the program instead of writing it")
+    parser.add_argument("-g", "--debug", action="store_true", help="write debug info next to the bytecode")
+    add_options(parser)
+    parser.add_argument("--stats", action="store_true", help="report cache hits and misses")
+    parser.add_argument("--time", action="store_true", help="report the time each stage took")
+    parser.add_argument("--trace", metavar="FILE", help="write Chrome trace events of the stages to FILE")
+    parser.add_argument("--pass-stats", action="store_true", help="measure every optimization pass")
+    parser.add_argument("--verify", action="store_true", help="check that the program prints what it does at -O0")
+    args = parser.parse_args(argv)
+    options = parse_options(parser, args)
+    cache = Cache(None if args.no_cache else args.cache_dir)
+    with open(args.file) as f:
+        source = f.read()
+    with instrument.recording(memory=False) if args.time or args.trace else _nothing() as rec:
+        result = build(source, options, cache)
+    if args.run:
+        module = bytecode.loads(result.data)
+        for line in interp.run(module.image()).output:
+            print(line)
+    else:
+        output = args.output or os.path.splitext(args.file)[0] + ".taub"
+        with open(output, "wb") as f:
+            f.write(result.data)
+        if result.debug is not None:
+            with open(debuginfo.sidecar(output), "wb") as f:
+                f.write(result.debug)
+    if args.pass_stats:
+        ast, _ = produce(source, options, Cache(cache.path), "typecheck")
+        _, manager = passes.compile(ast, options.selected(), options.lean, options.memo, measure=True)
+        print(passes.report(manager.stats), end="", file=sys.stderr)
+    if args.verify:
+        problems = passes.differential(source, options.selected(), options.lean, options.memo)
+        for problem in problems:
+            print(f"{args.file}: {problem}", file=sys.stderr)
+        if problems:
+            return 1
+    totals = cache.save_stats()
+    if args.stats:
+        print(cache.report(totals), end="", file=sys.stderr)
+    if rec is not None:
+        if args.time:
+            print(rec.report(), end="", file=sys.stderr)
+        if args.trace:
+            rec.write_trace(args.trace)
+    return 0
+
+
+class _nothing:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+# Description: Tiered execution of a Tau program
+#
+# Every function starts out interpreted, by an interp.Machine whose
+# Hooks count calls and taken backward jumps per function.  Once a
+# function's count reaches the threshold it is compiled by pyback from
+# the same FuncDecl and used for every later call.  Frames that are
+# already running keep running interpreted.
+#
+# Compiled and interpreted code share one calling convention, the one
+# codegen uses: the caller reserves the return slot and the argument
+# slots below the callee's frame, the callee reads argument i at FP-2-i
+# and leaves its result at FP-1.  An interpreted Call to a compiled
+# function reads the arguments from those slots, calls it, and stores
+# the result back.  A compiled function calls a function that is still
+# interpreted through a trampoline that builds the same frame and runs
+# the interpreter until the callee returns.
+#
+# Functions that are never called have no entry label in the image, so
+# they are neither counted nor compiled.  As with pyback, locals of
+# compiled functions start at 0.
+
+import sys
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from tau import asts
+from interp import MEMORY, STACK, Hooks, Machine
+import codegen
+import link
+import pyback
+
+THRESHOLD = 1000
+_RETURN = -1  # return address that ends a trampoline's interpreter run
+
+
+@dataclass
+class Result:
+    output: List[str] = field(default_factory=list)
+    steps: int = 0  # instructions interpreted
+    promoted: List[str] = field(default_factory=list)  # in the order they were compiled
+
+
+class Tiered(Hooks):
+    def __init__(self, ast: asts.Program, threshold: int = THRESHOLD, memory: int = MEMORY, stack: int = STACK):
+        self.image = link.link(codegen.generate(ast))
+        self.threshold = threshold
+        self.decls = {decl.id.token.value: decl for decl in ast.decls}
+        self.names = {self.image.address(name): name for name in self.decls if name in self.image.entries}
+        self.nargs = {addr: len(self.decls[name].params) for addr, name in self.names.items()}
+        # Entry address of the function each instruction belongs to.
+        self.owner = [0] * len(self.image)
+        entry = 0
+        for pc in range(len(self.image)):
+            entry = pc if pc in self.names else entry
+            self.owner[pc] = entry
+        self.heat = [0] * len(self.image)  # calls plus back edges, by entry address
+        self.native: Dict[int, Callable] = {}
+        self.machine = Machine(self.image, memory, stack, hooks=self)
+        self.result = Result(self.machine.out)
+        self.namespace = {"tau_print": self.machine.out.append}
+        for addr, name in self.names.items():
+            self.namespace[pyback.pyname(name)] = self._trampoline(addr)
+
+    def run(self, recursion: int = 20000) -> Result:
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, recursion))
+        try:
+            self.machine.execute()
+        finally:
+            sys.setrecursionlimit(limit)
+        self.result.steps = self.machine.steps
+        return self.result
+
+    def _heat(self, addr: int):
+        self.heat[addr] += 1
+        if self.heat[addr] == self.threshold:
+            self._promote(addr)
+
+    def _promote(self, addr: int):
+        if addr not in self.native:
+            name = self.names[addr]
+            source = "\n".join(pyback.funcdecl(self.decls[name]))
+            exec(compile(source, f"<tau {name}>", "exec"), self.namespace)
+            self.native[addr] = self.namespace[pyback.pyname(name)]
+            self.result.promoted.append(name)
+
+    # An interpreted Call: compiled callees are called here.
+    def call(self, pc: int, target: int, steps: int) -> bool:
+        self._heat(target)
+        fn = self.native.get(target)
+        if fn is None:
+            return False
+        m = self.machine
+        m.top -= 1
+        values = [m.mem[m.sp - 2 - i] for i in range(self.nargs[target])]
+        result = fn(*values)
+        m.mem[m.sp - 1] = 0 if result is None else int(result)
+        return True
+
+    def jump(self, pc: int, target: int, steps: int):
+        if target <= pc:
+            self._heat(self.owner[pc])
+
+    # Calls the interpreted function at addr from compiled code.
+    def _trampoline(self, addr: int) -> Callable:
+        def call(*args):
+            self._heat(addr)
+            if addr in self.native:
+                return self.native[addr](*args)
+            m = self.machine
+            sp = m.sp
+            base = sp + 1 + len(args)
+            for i, arg in enumerate(args):
+                m.mem[base - 2 - i] = int(arg)
+            m.sp = base
+            m.top += 1
+            m.st[m.top] = _RETURN
+            m.execute(addr)
+            m.sp = sp
+            return m.mem[base - 1]
+
+        return call
+
+
+def run(ast: asts.Program, threshold: int = THRESHOLD) -> Result:
+    return Tiered(ast, threshold).run()
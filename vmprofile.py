@@ -0,0 +1,272 @@
+# Description: Execution profiler for linked images
+#
+# run() executes an image like interp.run() does and counts, as it goes,
+#   - how often each instruction runs,
+#   - the calls of each function (the labels codegen names after
+#     ast.id.token.value) and their inclusive wall time, taken from the
+#     outermost activation so recursion is not counted twice,
+#   - how often each conditional branch is taken,
+#   - the taken back edges (jumps to an earlier or the same address) of
+#     each loop, keyed by the address jumped to, and
+#   - the instructions executed under each call stack, and
+#   - the deepest the eval stack got and the highest SP, i.e. the frame
+#     memory the program used.
+# The image runs on an interp.Machine whose Hooks see every call,
+# return and taken jump; the instruction counts are rebuilt from those
+# transfers, since control falls through everywhere else.  The hooks
+# make calls and branches much slower than in interp, so the times are
+# only meaningful relative to each other.
+#
+# With an image linked from codegen.generate(ast, spans=...), or with
+# the image's debuginfo.DebugInfo, the counts are attributed to the
+# source positions of the AST nodes that emitted the instructions:
+# hot_lines() sums them per source line.  folded() writes the call
+# stacks in the folded format flamegraph.pl and speedscope read,
+# weighted by instructions executed.
+#
+# The file to profile is a Tau program, or a bytecode file, whose debug
+# info is used if it has any.
+#
+# usage: python vmprofile.py [--folded FILE] [--top N] file.tau|file
+
+import argparse
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from interp import (
+    JUMPIFEQUAL,
+    JUMPIFGREATERTHAN,
+    JUMPIFGREATERTHANEQUAL,
+    JUMPIFLESSTHAN,
+    JUMPIFLESSTHANEQUAL,
+    JUMPIFNOTEQUAL,
+    JUMPIFNOTZERO,
+    JUMPIFZERO,
+    MEMORY,
+    Hooks,
+    Machine,
+)
+from debuginfo import DebugInfo
+from link import Image
+from memo import Memo
+
+ENTRY = "(entry)"  # the code before the first function
+
+# Jumps that are counted in Profile.taken.
+_CONDITIONAL = {
+    JUMPIFZERO,
+    JUMPIFNOTZERO,
+    JUMPIFEQUAL,
+    JUMPIFNOTEQUAL,
+    JUMPIFLESSTHAN,
+    JUMPIFLESSTHANEQUAL,
+    JUMPIFGREATERTHAN,
+    JUMPIFGREATERTHANEQUAL,
+}
+
+
+@dataclass
+class Profile:
+    image: Image
+    output: List[str] = field(default_factory=list)
+    steps: int = 0
+    counts: List[int] = field(default_factory=list)  # executions of each instruction
+    calls: Dict[str, int] = field(default_factory=dict)
+    inclusive: Dict[str, float] = field(default_factory=dict)  # seconds
+    backedges: Dict[int, int] = field(default_factory=dict)  # loop head address -> taken back edges
+    taken: Dict[int, int] = field(default_factory=dict)  # conditional branch address -> times taken
+    stacks: Dict[Tuple[str, ...], int] = field(default_factory=dict)  # call stack -> instructions in its top frame
+    depth: int = 0  # most eval-stack entries in use at once
+    frame: int = 0  # highest SP
+    debug: Optional[DebugInfo] = None
+
+    # Name of the function each instruction belongs to.
+    def owners(self) -> List[str]:
+        starts = sorted((self.image.address(name), name) for name in self.image.entries)
+        owner = []
+        name = ENTRY
+        for pc in range(len(self.image)):
+            while starts and starts[0][0] == pc:
+                name = starts.pop(0)[1]
+            owner.append(name)
+        return owner
+
+    # The source line instruction pc came from, or None.
+    def line(self, pc: int) -> Optional[int]:
+        if pc < len(self.image.spans):
+            span = self.image.spans[pc]
+            return span.start.line if span is not None else None
+        if self.debug is not None:
+            where = self.debug.location(pc)
+            return where[0] if where is not None else None
+        return None
+
+
+class _Counter(Hooks):
+    def __init__(self, prof: Profile, ops: List[int]):
+        self.prof = prof
+        self.ops = ops
+        self.names = {prof.image.address(name): name for name in prof.image.entries}
+        # Straight runs of instructions start where control goes to and
+        # end where it leaves, so the counts are the running sum of this.
+        self.delta = [0] * (len(ops) + 1)
+        self.delta[0] = 1
+        self.frames: List[Tuple[str, float]] = []  # (function, when it was called)
+        self.active: Dict[str, int] = {}  # activations of each function on frames
+        self.mark = 0  # steps when frames last changed
+        self.highest = 0
+
+    def _transfer(self, pc: int, target: int):
+        self.delta[pc + 1] -= 1
+        self.delta[target] += 1
+
+    def _stack(self, steps: int):
+        key = tuple(f for f, _ in self.frames)
+        self.prof.stacks[key] = self.prof.stacks.get(key, 0) + steps - self.mark
+        self.mark = steps
+
+    def call(self, pc: int, target: int, steps: int) -> bool:
+        self._transfer(pc, target)
+        self._stack(steps)
+        name = self.names.get(target, str(target))
+        self.frames.append((name, time.perf_counter()))
+        self.active[name] = self.active.get(name, 0) + 1
+        self.prof.calls[name] = self.prof.calls.get(name, 0) + 1
+        return False
+
+    def ret(self, pc: int, target: int, steps: int):
+        self._transfer(pc, target)
+        self._stack(steps)
+        name, start = self.frames.pop()
+        self.active[name] -= 1
+        if self.active[name] == 0:
+            self.prof.inclusive[name] = self.prof.inclusive.get(name, 0.0) + time.perf_counter() - start
+
+    def jump(self, pc: int, target: int, steps: int):
+        self._transfer(pc, target)
+        if self.ops[pc] in _CONDITIONAL:
+            self.prof.taken[pc] = self.prof.taken.get(pc, 0) + 1
+        if target <= pc:
+            self.prof.backedges[target] = self.prof.backedges.get(target, 0) + 1
+
+    def frame(self, sp: int):
+        if sp > self.highest:
+            self.highest = sp
+
+
+def run(
+    image: Image,
+    memory: int = MEMORY,
+    stack: Optional[int] = None,
+    memo: Optional[Memo] = None,
+    debug: Optional[DebugInfo] = None,
+) -> Profile:
+    prof = Profile(image, debug=debug)
+    counter = _Counter(prof, list(image.ops))
+    machine = Machine(image, memory, stack, memo, counter)
+    # Entries still None afterwards were never pushed to.
+    machine.st = [None] * len(machine.st)
+    machine.execute()
+    counter.delta[machine.pc] -= 1  # the last run ends at the Halt
+    counter._stack(machine.steps)
+    n = 0
+    for delta in counter.delta[: len(image)]:
+        n += delta
+        prof.counts.append(n)
+    prof.output = machine.out
+    prof.steps = machine.steps
+    prof.depth = next((i + 1 for i in range(len(machine.st) - 1, -1, -1) if machine.st[i] is not None), 0)
+    prof.frame = counter.highest
+    return prof
+
+
+# One "f;g;h count" line per call stack, outermost function first.
+def folded(prof: Profile) -> str:
+    lines = []
+    for key, n in sorted(prof.stacks.items()):
+        if n:
+            lines.append(f"{';'.join((ENTRY,) + key)} {n}")
+    return "\n".join(lines) + "\n"
+
+
+def functions(prof: Profile) -> str:
+    own: Dict[str, int] = {}
+    for name, n in zip(prof.owners(), prof.counts):
+        own[name] = own.get(name, 0) + n
+    lines = [f"{'function':<16} {'calls':>10} {'incl ms':>10} {'insns':>12} {'%':>6}"]
+    for name in sorted(own, key=own.get, reverse=True):
+        ms = prof.inclusive.get(name, 0.0) * 1e3
+        share = own[name] / prof.steps if prof.steps else 0.0
+        lines.append(f"{name:<16} {prof.calls.get(name, 0):>10} {ms:>10.1f} {own[name]:>12} {share:>6.1%}")
+    return "\n".join(lines) + "\n"
+
+
+def loops(prof: Profile) -> str:
+    owner = prof.owners()
+    lines = [f"{'loop head':<24} {'function':<16} {'back edges':>10}"]
+    for pc in sorted(prof.backedges, key=prof.backedges.get, reverse=True):
+        line = prof.line(pc)
+        where = f"line {line}" if line is not None else f"insn {pc}"
+        lines.append(f"{where:<24} {owner[pc]:<16} {prof.backedges[pc]:>10}")
+    return "\n".join(lines) + "\n"
+
+
+# The source lines whose instructions ran most, with the text of each
+# line if the source is given.
+def hot_lines(prof: Profile, source: Optional[str] = None, top: int = 20) -> str:
+    per_line: Dict[int, int] = {}
+    for pc, n in enumerate(prof.counts):
+        line = prof.line(pc)
+        if n and line is not None:
+            per_line[line] = per_line.get(line, 0) + n
+    text = source.splitlines() if source is not None else []
+    lines = [f"{'line':>6} {'insns':>12} {'%':>6}"]
+    for line in sorted(per_line, key=per_line.get, reverse=True)[:top]:
+        share = per_line[line] / prof.steps if prof.steps else 0.0
+        code = text[line - 1].strip() if 0 < line <= len(text) else ""
+        lines.append(f"{line:>6} {per_line[line]:>12} {share:>6.1%}  {code}")
+    return "\n".join(lines) + "\n"
+
+
+def main(argv: List[str]) -> int:
+    import bytecode
+    import codegen
+    import debuginfo
+    import link
+    import offsets
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Profile a Tau program on the interpreter.")
+    parser.add_argument("file")
+    parser.add_argument("--folded", metavar="FILE", help="write folded call stacks to FILE")
+    parser.add_argument("--top", type=int, default=20, help="number of hot lines to show")
+    args = parser.parse_args(argv)
+    if args.file.endswith(".tau"):
+        with open(args.file) as f:
+            source = f.read()
+        ast = pipeline.front(source)
+        offsets.process(ast)
+        spans = []
+        code = codegen.generate(ast, spans=spans)
+        prof = run(link.link(code, spans))
+    else:
+        source = None
+        module = bytecode.load(args.file)
+        prof = run(module.image(), debug=debuginfo.load_for(args.file, module))
+    for line in prof.output:
+        print(line)
+    print(f"\n{prof.steps} instructions\n")
+    print(functions(prof))
+    if prof.backedges:
+        print(loops(prof))
+    print(hot_lines(prof, source, args.top), end="")
+    if args.folded:
+        with open(args.folded, "w") as f:
+            f.write(folded(prof))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))